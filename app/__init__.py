@@ -1,17 +1,75 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 import os
 import pickle
 
 app = Flask(__name__)
 basedir = os.path.abspath(os.path.dirname(__file__))
 db_path = os.path.join(basedir, 'pantry.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('CHEF_DATABASE_URI', f'sqlite:///{db_path}')
+if ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI']:
+    # in-memory SQLite lives in a single connection and can't be pooled
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('CHEF_DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('CHEF_DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': 30,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+app.config['COOKBOOK_PATH'] = os.path.join(basedir, 'cookbook.json')
+app.config['KNOWLEDGE_BANK_PATH'] = os.path.join(basedir, 'knowledge_bank.json')
+# cost per unit of money spent, for knowledge bank ingredients that list priced purchase options;
+# it has no effect until some do (create_knowledge_bank.py --prices adds them)
+app.config['SPEND_WEIGHT'] = float(os.environ.get('CHEF_SPEND_WEIGHT', 0.25))
+# background refresh of expiry alerts and meal plans in each process; CHEF_SCHEDULER=0 turns it off
+app.config['SCHEDULER'] = os.environ.get('CHEF_SCHEDULER', '1') != '0'
+# meal plan prewarming runs in just one of the processes, whichever holds this lock file;
+# CHEF_PREWARM=0 keeps a process from taking it
+app.config['PREWARM'] = os.environ.get('CHEF_PREWARM', '1') != '0'
+app.config['PREWARM_LOCK'] = os.environ.get('CHEF_PREWARM_LOCK', os.path.join(basedir, 'prewarm.lock'))
 db = SQLAlchemy(app)
 
-from app import app, db
+def _configure_sqlite(dbapi_connection, connection_record):
+    # WAL lets page reads carry on while a plan is being written; NORMAL sync is durable under WAL
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-16000')
+    cursor.execute('PRAGMA mmap_size=67108864')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.close()
 
-with app.app_context():
-    db.create_all()
+_configured = False
 
-from app import routes
+def create_app(warmup=None, config=None):
+    # sets up the package's app and returns it; warmup is one of startup.WARMUP_MODES and
+    # defaults to $CHEF_WARMUP, else 'lazy'. Safe to call again, e.g. to preload an app that
+    # importing the package already set up lazily.
+    global _configured
+    from app import startup
+    from app.metrics import instrument_app, metrics
+
+    if warmup is None:
+        warmup = os.environ.get('CHEF_WARMUP', 'lazy')
+    if warmup not in startup.WARMUP_MODES:
+        raise ValueError(f'Unknown warmup mode {warmup}')
+    if config:
+        app.config.update(config)
+    if not _configured:
+        with app.app_context():
+            # only this app's engine, and only when it is SQLite
+            if db.engine.dialect.name == 'sqlite':
+                event.listen(db.engine, 'connect', _configure_sqlite)
+        instrument_app(app)
+        app.before_request(startup.prepare_database)
+        app.before_request(startup.start_background_tasks)
+        with metrics.timer('chef_startup_seconds', phase='routes'):
+            from app import routes
+        _configured = True
+    if warmup == 'preload':
+        startup.preload()
+    return app
+
+create_app()
@@ -0,0 +1,304 @@
+import gzip
+import hashlib
+import json
+from datetime import date
+
+from flask import request, jsonify, Response
+
+try:
+    import orjson
+except ImportError:
+    # the standard library encoder writes the same JSON, just several times slower
+    orjson = None
+
+from app import app
+from app.meal_planner import OPTIMIZERS, generate_meal_plans, distinct_plans, prune_pantry
+from app.cookbook_cache import get_raw_cookbook, get_recipes, get_knowledge_bank, get_recipe_ids, get_recipe_index, cookbook_version, file_version
+from app.plan_cache import cached_shopping_list, cached_cost
+from app.recipe_index import recipe_query, search_recipes, page_of
+from app.constraints import constraints_from_params
+from app.pantry_events import pantry_snapshot
+from app.expiry import expiry_alerts
+from app.households import current_household_id, get_staged_plan
+from app.planning_views import planning_inputs, planning_weights, prewarmed_seed, MAX_RESTARTS, PLANS_SHOWN, MEAL_PLAN_ITERATIONS, MEAL_PLAN_RESTARTS, RECIPES_PER_PAGE, MAX_RECIPES_PER_PAGE
+from app.metrics import metrics
+from app.purchasing import priced_ingredients
+
+# /api/v1: the planning results as compact JSON for scripts and apps. Recipes are referred to
+# by id (their index in the cookbook, listed under /api/v1/recipes), shopping list and pantry
+# entries are flattened, and dates are plain YYYY-MM-DD. Every endpoint takes ?fields= to pick
+# the keys of the objects it returns, answers If-None-Match with a 304 and gzips large bodies
+# for clients that accept it. `cookbook` in each response changes whenever recipe ids might.
+
+RECIPE_FIELDS = ('id', 'name', 'cooking_time', 'total_calories', 'grams_carbs', 'grams_fat', 'grams_protein', 'ingredients')
+# a listing leaves out ingredients unless asked for them
+RECIPE_LISTING_FIELDS = RECIPE_FIELDS[:-1]
+PLAN_FIELDS = ('recipe_ids', 'cost', 'shopping_list', 'pantry')
+MAX_RECIPE_IDS = 200
+# smaller bodies aren't worth compressing
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def digest(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def cookbook_tag(cookbook_path):
+    return digest(file_version(cookbook_path))[:12]
+
+def revalidate(etag):
+    # a 304 when the client already has this version of the response, else None. Tags are weak
+    # because the gzipped and plain bodies of one response share them.
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+def api_response(payload, etag=None):
+    # etag, when the caller could work it out before building the payload, else from the body
+    with metrics.timer('chef_phase_seconds', phase='serialize'):
+        body = dumps(payload)
+    if etag is None:
+        etag = hashlib.sha1(body).hexdigest()
+        not_modified = revalidate(etag)
+        if not_modified is not None:
+            return not_modified
+    response = Response(body, mimetype='application/json')
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        with metrics.timer('chef_phase_seconds', phase='compress'):
+            response.set_data(gzip.compress(body, GZIP_LEVEL, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag, weak=True)
+    return response
+
+def api_error(message, status=400):
+    return jsonify(success=False, message=message), status
+
+
+def requested_fields(allowed, default):
+    fields = request.args.get('fields')
+    if not fields:
+        return default
+    fields = tuple(field.strip() for field in fields.split(',') if field.strip())
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown field {unknown[0]}, expected some of {', '.join(allowed)}")
+    return fields
+
+def requested_ids(param, num_recipes):
+    # a comma-separated list of distinct recipe ids
+    try:
+        ids = [int(value) for value in request.args.get(param, '').split(',') if value.strip()]
+    except ValueError:
+        raise ValueError(f'{param} must be comma-separated recipe ids')
+    if not ids:
+        raise ValueError(f'{param} is required')
+    if len(ids) > MAX_RECIPE_IDS:
+        raise ValueError(f'At most {MAX_RECIPE_IDS} recipe ids at a time')
+    if len(set(ids)) != len(ids):
+        raise ValueError(f'{param} repeats a recipe')
+    for recipe_id in ids:
+        if not 0 <= recipe_id < num_recipes:
+            raise ValueError(f'No recipe {recipe_id}')
+    return ids
+
+def pick(view, fields):
+    return {field: view[field] for field in fields if field in view}
+
+
+def recipe_view(recipe_id, recipe, fields):
+    view = {'id': recipe_id}
+    for field in fields:
+        if field == 'ingredients':
+            view[field] = [[item['quantity'], item['unit'], item['name']] for item in recipe['ingredients']]
+        elif field != 'id':
+            view[field] = recipe.get(field)
+    return view
+
+def shopping_list_view(shopping_list):
+    # name -> {count, quantity, unit} of the purchase increment, with [count, quantity, unit,
+    # price] per package and the total price for ingredients bought in priced packages
+    view = {}
+    for name, item in shopping_list.items():
+        entry = {'count': item['count'], 'quantity': item['increment']['quantity'], 'unit': item['increment']['unit']}
+        if 'packages' in item:
+            entry['packages'] = [[package['count'], package['quantity'], package['unit'], package['price']]
+                                 for package in item['packages']]
+            entry['price'] = item['price']
+        view[name] = entry
+    return view
+
+def pantry_view(new_pantry):
+    # name -> [quantity in standard units, expiry date] of what a plan leaves behind
+    return {name: [round(float(item['quantity']), 3), item['expiry_date'].strftime('%Y-%m-%d')]
+            for name, item in prune_pantry(new_pantry).items()}
+
+def plan_view(recipe_ids, cost, all_recipes, digital_pantry, knowledge_bank, versions, fields):
+    view = {'recipe_ids': list(recipe_ids), 'cost': cost}
+    # the shopping list only gets built (or fetched from the plan cache) when it's asked for
+    if 'shopping_list' in fields or 'pantry' in fields:
+        shopping_list, new_pantry = cached_shopping_list(recipe_ids, all_recipes, digital_pantry, knowledge_bank, *versions)
+        view['shopping_list'] = shopping_list_view(shopping_list)
+        view['pantry'] = pantry_view(new_pantry)
+    return pick(view, fields)
+
+
+def api_recipes():
+    # ?ids=1,2,3 for particular recipes, otherwise a page of the cookbook with the /recipes filters
+    cookbook_path = app.config['COOKBOOK_PATH']
+    version = file_version(cookbook_path)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', RECIPES_PER_PAGE, type=int), 1), MAX_RECIPES_PER_PAGE)
+    query = recipe_query(request.args)
+    try:
+        fields = requested_fields(RECIPE_FIELDS, RECIPE_LISTING_FIELDS)
+    except ValueError as e:
+        return api_error(str(e))
+
+    etag = digest(('recipes', version, request.args.get('ids'), query, page, per_page, fields))
+    not_modified = revalidate(etag)
+    if not_modified is not None:
+        return not_modified
+
+    cookbook = get_raw_cookbook(cookbook_path)
+    if request.args.get('ids'):
+        try:
+            recipe_ids = requested_ids('ids', len(cookbook))
+        except ValueError as e:
+            return api_error(str(e))
+        payload = {'cookbook': cookbook_tag(cookbook_path)}
+    else:
+        index = get_recipe_index(cookbook_path)
+        recipe_ids, total = page_of(index, search_recipes(index, query, version), page, per_page)
+        payload = {'cookbook': cookbook_tag(cookbook_path), 'total': total, 'page': page, 'per_page': per_page}
+    payload['recipes'] = [recipe_view(i, cookbook[i], fields) for i in recipe_ids]
+    return api_response(payload, etag)
+
+def api_recipe(recipe_id):
+    cookbook_path = app.config['COOKBOOK_PATH']
+    try:
+        fields = requested_fields(RECIPE_FIELDS, RECIPE_FIELDS)
+    except ValueError as e:
+        return api_error(str(e))
+    etag = digest(('recipe', file_version(cookbook_path), recipe_id, fields))
+    not_modified = revalidate(etag)
+    if not_modified is not None:
+        return not_modified
+
+    cookbook = get_raw_cookbook(cookbook_path)
+    if recipe_id >= len(cookbook):
+        return api_error("No such recipe.", 404)
+    return api_response({'cookbook': cookbook_tag(cookbook_path), 'recipe': recipe_view(recipe_id, cookbook[recipe_id], fields)}, etag)
+
+def api_meal_plans():
+    # the /meal_plans search, with the same parameters; an unknown optimizer is an error here
+    # rather than quietly replaced
+    restarts = min(max(request.args.get('restarts', MEAL_PLAN_RESTARTS, type=int), 1), MAX_RESTARTS)
+    optimizer = request.args.get('optimizer', 'hill_climb')
+    if optimizer not in OPTIMIZERS:
+        return api_error(f"Unknown optimizer {optimizer}.")
+    seed = request.args.get('seed', type=int)
+    try:
+        fields = requested_fields(PLAN_FIELDS, PLAN_FIELDS)
+        constraints = constraints_from_params(request.args)
+    except ValueError as e:
+        return api_error(str(e))
+
+    all_recipes, digital_pantry, knowledge_bank, matrix, versions = planning_inputs()
+    wastage_weight, pantry_weight, spend_weight = planning_weights(digital_pantry)
+    etag = None
+    if seed is None:
+        seed = prewarmed_seed(current_household_id(), versions, restarts, optimizer, constraints)
+    else:
+        # a seeded search always finds the same plans, so a client holding them needn't wait for it
+        etag = digest(('meal_plans', versions, date.today(), wastage_weight, pantry_weight, spend_weight, restarts, optimizer,
+                       constraints.key(), seed, fields))
+        not_modified = revalidate(etag)
+        if not_modified is not None:
+            return not_modified
+
+    runs = []
+    try:
+        generate_meal_plans(all_recipes, digital_pantry, knowledge_bank, MEAL_PLAN_ITERATIONS, wastage_weight,
+                            pantry_weight, num_plans=restarts, matrix=matrix, optimizer=optimizer, cache_versions=versions,
+                            constraints=constraints, seed=seed, records=runs, spend_weight=spend_weight)
+    except ValueError as e:
+        return api_error(str(e))
+    plans = [plan_view(plan, round(cost, 1), all_recipes, digital_pantry, knowledge_bank, versions, fields)
+             for plan, cost in distinct_plans([(run.plan, run.cost) for run in runs])[:PLANS_SHOWN]]
+    # spend only counts for ingredients with priced purchase options; 0 means it played no part
+    return api_response({'cookbook': cookbook_tag(app.config['COOKBOOK_PATH']), 'seed': seed,
+                         'priced_ingredients': priced_ingredients(knowledge_bank), 'plans': plans}, etag)
+
+def api_shopping_list():
+    # shopping list, leftover pantry and cost of any set of recipes, e.g. one picked from /meal_plans
+    try:
+        fields = requested_fields(PLAN_FIELDS, PLAN_FIELDS)
+    except ValueError as e:
+        return api_error(str(e))
+    all_recipes, digital_pantry, knowledge_bank, _, versions = planning_inputs()
+    try:
+        recipe_ids = requested_ids('recipe_ids', len(all_recipes))
+    except ValueError as e:
+        return api_error(str(e))
+    weights = planning_weights(digital_pantry)
+    etag = digest(('shopping_list', versions, date.today(), weights, recipe_ids, fields))
+    not_modified = revalidate(etag)
+    if not_modified is not None:
+        return not_modified
+
+    cost = round(cached_cost(recipe_ids, all_recipes, digital_pantry, knowledge_bank, *weights, *versions), 1)
+    view = plan_view(recipe_ids, cost, all_recipes, digital_pantry, knowledge_bank, versions, fields)
+    return api_response({'cookbook': cookbook_tag(app.config['COOKBOOK_PATH']), **view}, etag)
+
+def api_current_meal_plan():
+    try:
+        fields = requested_fields(PLAN_FIELDS, PLAN_FIELDS)
+    except ValueError as e:
+        return api_error(str(e))
+    cookbook_path = app.config['COOKBOOK_PATH']
+    kb_path = app.config['KNOWLEDGE_BANK_PATH']
+    household_id = current_household_id()
+    staged = get_staged_plan(household_id)
+    if staged is None or not staged.recipes:
+        return api_response({'cookbook': cookbook_tag(cookbook_path), 'staged': False})
+
+    snapshot = pantry_snapshot(household_id)
+    digital_pantry = snapshot.pantry
+    versions = (snapshot.key, cookbook_version(cookbook_path, kb_path))
+    weights = planning_weights(digital_pantry)
+    # the staged plan's version moves on every restage and execution
+    etag = digest(('current_meal_plan', household_id, staged.version, versions, date.today(), weights, fields))
+    not_modified = revalidate(etag)
+    if not_modified is not None:
+        return not_modified
+
+    recipe_ids = get_recipe_ids(cookbook_path, set(staged.recipes))
+    payload = {'cookbook': cookbook_tag(cookbook_path), 'staged': True, 'executed': staged.executed}
+    if staged.executed:
+        # what it bought and left behind is already in the pantry
+        payload.update(pick({'recipe_ids': recipe_ids}, fields))
+    else:
+        all_recipes = get_recipes(cookbook_path, kb_path)
+        knowledge_bank = get_knowledge_bank(kb_path)
+        cost = round(cached_cost(recipe_ids, all_recipes, digital_pantry, knowledge_bank, *weights, *versions), 1)
+        payload.update(plan_view(recipe_ids, cost, all_recipes, digital_pantry, knowledge_bank, versions, fields))
+    return api_response(payload, etag)
+
+def api_use_soon():
+    # the household's expired and soon-expiring stock and the recipes that would use it, as the
+    # background scheduler last worked them out
+    alerts = expiry_alerts(current_household_id())
+    etag = digest(('use_soon', alerts.key, alerts.cookbook, alerts.valid_until))
+    not_modified = revalidate(etag)
+    if not_modified is not None:
+        return not_modified
+    return api_response({'cookbook': cookbook_tag(app.config['COOKBOOK_PATH']), **alerts.to_dict()}, etag)
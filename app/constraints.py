@@ -0,0 +1,114 @@
+import numpy as np
+
+from app.cookbook_matrix import NUTRITION_FIELDS
+
+# request parameter -> nutrition field for the per-plan totals, each with a min_ and max_ variant
+PLAN_TOTALS = {
+    'calories': 'total_calories',
+    'carbs': 'grams_carbs',
+    'fat': 'grams_fat',
+    'protein': 'grams_protein',
+}
+
+
+class PlanConstraints:
+    # what a plan must satisfy: each nutrition total over the whole plan within its (low, high)
+    # range (either end may be None), no recipe taking longer than max_cooking_time minutes,
+    # and no recipe using an excluded ingredient
+    def __init__(self, ranges=None, max_cooking_time=None, excluded_ingredients=()):
+        # floats throughout, so equal limits give equal keys however they were passed in
+        self.ranges = {field: (_number(low), _number(high)) for field, (low, high) in (ranges or {}).items()
+                       if low is not None or high is not None}
+        self.max_cooking_time = _number(max_cooking_time)
+        self.excluded_ingredients = frozenset(name.strip().lower() for name in excluded_ingredients if name.strip())
+
+    def __bool__(self):
+        return bool(self.ranges or self.max_cooking_time is not None or self.excluded_ingredients)
+
+    def key(self):
+        # hashable and order-independent, for job and result cache keys
+        return (tuple(sorted(self.ranges.items())), self.max_cooking_time, tuple(sorted(self.excluded_ingredients)))
+
+    def limits(self):
+        # (columns of matrix.nutrition, lows, highs) for the plan totals, open ends as infinities
+        fields = sorted(self.ranges)
+        columns = np.array([NUTRITION_FIELDS.index(field) for field in fields], dtype=np.int64)
+        lows = np.array([-np.inf if self.ranges[field][0] is None else self.ranges[field][0] for field in fields])
+        highs = np.array([np.inf if self.ranges[field][1] is None else self.ranges[field][1] for field in fields])
+        return columns, lows, highs
+
+    def to_dict(self):
+        params = {}
+        for param, field in PLAN_TOTALS.items():
+            low, high = self.ranges.get(field, (None, None))
+            if low is not None:
+                params[f'min_{param}'] = low
+            if high is not None:
+                params[f'max_{param}'] = high
+        if self.max_cooking_time is not None:
+            params['max_time'] = self.max_cooking_time
+        if self.excluded_ingredients:
+            params['exclude'] = ','.join(sorted(self.excluded_ingredients))
+        return params
+
+
+def _number(value):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Constraint {value!r} is not a number')
+
+def constraints_from_params(params):
+    # from query args, a form or a JSON body; exclude is a list or a comma-separated string
+    ranges = {field: (_number(params.get(f'min_{param}')), _number(params.get(f'max_{param}')))
+              for param, field in PLAN_TOTALS.items()}
+    excluded = params.get('exclude') or []
+    if isinstance(excluded, str):
+        excluded = excluded.split(',')
+    return PlanConstraints(ranges, _number(params.get('max_time')), excluded)
+
+
+def feasible_recipes(matrix, constraints, num_meals):
+    # cookbook indices of the recipes that can appear in some plan meeting the constraints, as a
+    # handful of whole-cookbook array operations. Recipe-level limits are exact; for the plan
+    # totals a recipe is dropped when even the num_meals - 1 most favourable other recipes can't
+    # bring the plan into range, which repeats until nothing more drops out.
+    num_recipes = matrix.num_recipes
+    keep = np.ones(num_recipes, dtype=bool)
+    if constraints.max_cooking_time is not None:
+        keep &= matrix.nutrition[:, NUTRITION_FIELDS.index('cooking_time')] <= constraints.max_cooking_time
+
+    excluded = [col for name, col in matrix.ingredient_index.items() if name.strip().lower() in constraints.excluded_ingredients]
+    if excluded:
+        rows = np.repeat(np.arange(num_recipes), np.diff(matrix.recipe_offsets))
+        uses = np.bincount(rows[np.isin(matrix.columns, excluded)], minlength=num_recipes)
+        keep &= uses == 0
+
+    if constraints.ranges:
+        columns, lows, highs = constraints.limits()
+        values = matrix.nutrition[:, columns]
+        # a recipe that doesn't report a limited figure can't be checked against it
+        keep &= ~np.isnan(values).any(axis=1)
+        others = num_meals - 1
+        while keep.sum() >= num_meals:
+            candidates = values[keep]
+            ordered = np.sort(candidates, axis=0)
+            smallest = ordered[:others].sum(axis=0)
+            largest = ordered[len(ordered) - others:].sum(axis=0) if others else 0
+            reachable = np.all((values + smallest <= highs) & (values + largest >= lows), axis=1)
+            still = keep & reachable
+            if still.sum() == keep.sum():
+                break
+            keep = still
+    return np.flatnonzero(keep)
+
+def constrained_matrix(matrix, constraints, num_meals):
+    # (matrix to search, cookbook index of each of its recipes or None when unconstrained)
+    if not constraints:
+        return matrix, None
+    recipes = feasible_recipes(matrix, constraints, num_meals)
+    if len(recipes) < num_meals:
+        raise ValueError(f'Only {len(recipes)} recipes meet the constraints, a plan needs {num_meals}')
+    return matrix.subset(recipes), recipes
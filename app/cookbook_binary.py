@@ -0,0 +1,152 @@
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from app.models import Ingredient
+from app.cookbook_matrix import CookbookMatrix, NUTRITION_FIELDS
+from app.meal_planner import knowledge_bank_vectors
+from app.purchasing import column_purchases
+from app.units import registry as units
+
+# layout: magic, little-endian u64 header length, JSON header, then 64-byte aligned arrays
+MAGIC = b'CHEFCB01'
+ALIGNMENT = 64
+INTEGER_FIELDS = ('cooking_time', 'total_calories')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_binary_cookbook(recipes, path, unit_registry=units):
+    # recipes as stored in cookbook.json, from any iterable and in one pass, so a caller can
+    # stream them in; only the arrays are kept. Quantities are written already in standard units,
+    # as unit_registry (the knowledge bank's) converts them.
+    columns = {}
+    names = []
+    recipe_rows = []
+    item_columns = []
+    item_quantities = []
+    item_units = []
+    nutrition = []
+    encoded_names = []
+    for row, recipe in enumerate(recipes):
+        for item in recipe['ingredients']:
+            col = columns.get(item['name'])
+            if col is None:
+                col = columns[item['name']] = len(names)
+                names.append(item['name'])
+            recipe_rows.append(row)
+            item_columns.append(col)
+            item_quantities.append(item['quantity'])
+            item_units.append(item['unit'])
+        nutrition.append([recipe[field] for field in NUTRITION_FIELDS])
+        encoded_names.append(recipe['name'].encode('utf-8'))
+    num_recipes = len(encoded_names)
+
+    # columns in name order, as build_cookbook_matrix has them
+    ingredient_names = sorted(names)
+    order = np.empty(len(names), dtype=np.int64)
+    order[[columns[name] for name in ingredient_names]] = np.arange(len(names))
+    item_columns = np.array(item_columns, dtype=np.int64)
+    standard = unit_registry.to_standard_bulk([names[col] for col in item_columns.tolist()], item_quantities, item_units)
+    # a recipe may list the same ingredient more than once; each row holds it once, summed in
+    # the order listed, with its columns ascending
+    width = max(len(names), 1)
+    cells, position = np.unique(np.array(recipe_rows, dtype=np.int64) * width + order[item_columns], return_inverse=True)
+    quantities = np.bincount(position, weights=standard, minlength=len(cells))
+    recipe_offsets = np.concatenate(([0], np.cumsum(np.bincount(cells // width, minlength=num_recipes))))
+
+    arrays = {
+        'recipe_offsets': recipe_offsets.astype(np.int64),
+        'ingredient_ids': (cells % width).astype(np.int32),
+        'quantities': quantities.astype(np.float64),
+        'nutrition': np.array(nutrition, dtype=np.float64).reshape(num_recipes, len(NUTRITION_FIELDS)),
+        'name_offsets': np.cumsum([0] + [len(name) for name in encoded_names], dtype=np.int64),
+        'names': np.frombuffer(b''.join(encoded_names), dtype=np.uint8),
+    }
+
+    specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({'ingredients': ingredient_names, 'nutrition_fields': NUTRITION_FIELDS, 'arrays': specs}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    # write beside the target and rename, so processes with the old file mapped keep a valid view
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + specs[name]['offset'])
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+def load_binary_cookbook(path):
+    return BinaryCookbook(path)
+
+
+class BinaryCookbook:
+    # a compiled cookbook mapped read-only into memory; the arrays are views onto the mapping,
+    # so loading allocates nothing per recipe and processes mapping the same file share pages.
+    # Indexing builds the same recipe dicts as load_all_recipes, one recipe at a time.
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a binary cookbook')
+        header_length, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+        header_start = len(MAGIC) + 8
+        header = json.loads(self._mmap[header_start:header_start + header_length])
+        data_start = _align(header_start + header_length)
+
+        self.ingredient_names = header['ingredients']
+        self.nutrition_fields = header['nutrition_fields']
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape']))
+            arrays[name] = np.frombuffer(self._mmap, dtype, count, data_start + spec['offset']).reshape(spec['shape'])
+        self.recipe_offsets = arrays['recipe_offsets']
+        self.ingredient_ids = arrays['ingredient_ids']
+        self.quantities = arrays['quantities']
+        self.nutrition = arrays['nutrition']
+        self.name_offsets = arrays['name_offsets']
+        self.names = arrays['names']
+
+    def __len__(self):
+        return len(self.recipe_offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('recipe index out of range')
+        return self.recipe(index)
+
+    def recipe_name(self, index):
+        return self.names[self.name_offsets[index]:self.name_offsets[index + 1]].tobytes().decode('utf-8')
+
+    def recipe(self, index):
+        recipe = {'name': self.recipe_name(index)}
+        for field, value in zip(self.nutrition_fields, self.nutrition[index]):
+            recipe[field] = int(value) if field in INTEGER_FIELDS else float(value)
+        start, end = self.recipe_offsets[index], self.recipe_offsets[index + 1]
+        recipe['ingredients'] = [Ingredient(float(quantity), 'stan', self.ingredient_names[col])
+                                 for col, quantity in zip(self.ingredient_ids[start:end], self.quantities[start:end])]
+        return recipe
+
+    def to_matrix(self, knowledge_bank):
+        # the matrix uses the mapped arrays directly rather than copying them
+        increment_quantity, purchase_factor, shelf_life = knowledge_bank_vectors(self.ingredient_names, knowledge_bank)
+        nutrition = self.nutrition
+        if tuple(self.nutrition_fields) != NUTRITION_FIELDS:
+            nutrition = nutrition[:, [self.nutrition_fields.index(field) for field in NUTRITION_FIELDS]]
+        return CookbookMatrix(self.ingredient_names, self.recipe_offsets, self.ingredient_ids, self.quantities,
+                              increment_quantity, purchase_factor, shelf_life, nutrition,
+                              column_purchases(self.ingredient_names, knowledge_bank))
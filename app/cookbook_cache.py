@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+
+from app.meal_planner import load_all_recipes, load_knowledge_bank, build_cookbook_matrix
+from app.cookbook_binary import load_binary_cookbook
+from app.recipe_index import RecipeIndex
+from app.units import knowledge_bank_units
+
+
+class FileCache:
+    # keeps whatever `loader` builds from a set of files in memory until any of them
+    # changes on disk, judged by mtime and size
+    def __init__(self, loader):
+        self.loader = loader
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, *paths):
+        stamp = file_version(*paths)
+        entry = self.entries.get(paths)
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            return entry[1]
+
+        with self.lock:
+            # another thread may have loaded it while we waited
+            entry = self.entries.get(paths)
+            if entry is not None and entry[0] == stamp:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            value = self.loader(*paths)
+            self.entries[paths] = (stamp, value)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+def file_version(*paths):
+    version = []
+    for path in paths:
+        stat = os.stat(path)
+        version.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+def _load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def binary_cookbook_path(cookbook_path):
+    return os.path.splitext(cookbook_path)[0] + '.bin'
+
+def cookbook_source(cookbook_path, kb_path=None):
+    # prefer the compiled binary cookbook when it is at least as new as the JSON it was built from
+    # and, as its quantities were converted with that knowledge bank's units, the knowledge bank
+    binary_path = binary_cookbook_path(cookbook_path)
+    try:
+        built = os.stat(binary_path).st_mtime_ns
+        if built >= os.stat(cookbook_path).st_mtime_ns and (kb_path is None or built >= os.stat(kb_path).st_mtime_ns):
+            return binary_path
+    except FileNotFoundError:
+        pass
+    return cookbook_path
+
+def _load_unit_registry(kb_path):
+    return knowledge_bank_units(knowledge_bank_cache.get(kb_path))
+
+def _load_recipes(cookbook_path, kb_path):
+    return load_all_recipes(cookbook_path, unit_registry_cache.get(kb_path))
+
+def _load_cookbook_matrix(source_path, kb_path):
+    knowledge_bank = knowledge_bank_cache.get(kb_path)
+    if source_path.endswith('.bin'):
+        return binary_cookbook_cache.get(source_path).to_matrix(knowledge_bank)
+    return build_cookbook_matrix(recipe_cache.get(source_path, kb_path), knowledge_bank)
+
+def _load_recipe_names(source_path):
+    if source_path.endswith('.bin'):
+        cookbook = binary_cookbook_cache.get(source_path)
+        return [cookbook.recipe_name(i) for i in range(len(cookbook))]
+    return [recipe['name'] for recipe in raw_cookbook_cache.get(source_path)]
+
+def _load_recipe_index(cookbook_path):
+    return RecipeIndex(raw_cookbook_cache.get(cookbook_path))
+
+# cookbook as stored, for display
+raw_cookbook_cache = FileCache(_load_json)
+# cookbook with every ingredient already standardized by the knowledge bank's units, for planning
+recipe_cache = FileCache(_load_recipes)
+binary_cookbook_cache = FileCache(load_binary_cookbook)
+knowledge_bank_cache = FileCache(load_knowledge_bank)
+unit_registry_cache = FileCache(_load_unit_registry)
+matrix_cache = FileCache(_load_cookbook_matrix)
+recipe_names_cache = FileCache(_load_recipe_names)
+# filter columns over the stored cookbook, for the recipe listing
+recipe_index_cache = FileCache(_load_recipe_index)
+
+CACHES = {
+    'raw_cookbook': raw_cookbook_cache,
+    'recipes': recipe_cache,
+    'binary_cookbook': binary_cookbook_cache,
+    'knowledge_bank': knowledge_bank_cache,
+    'unit_registry': unit_registry_cache,
+    'cookbook_matrix': matrix_cache,
+    'recipe_names': recipe_names_cache,
+    'recipe_index': recipe_index_cache,
+}
+
+# callers share these objects and must not mutate them
+def get_raw_cookbook(cookbook_path):
+    return raw_cookbook_cache.get(cookbook_path)
+
+def get_recipes(cookbook_path, kb_path):
+    source_path = cookbook_source(cookbook_path, kb_path)
+    if source_path != cookbook_path:
+        return binary_cookbook_cache.get(source_path)
+    return recipe_cache.get(cookbook_path, kb_path)
+
+def get_recipe_index(cookbook_path):
+    return recipe_index_cache.get(cookbook_path)
+
+def get_knowledge_bank(kb_path):
+    return knowledge_bank_cache.get(kb_path)
+
+def get_unit_registry(kb_path):
+    # the same registry object for as long as the knowledge bank file is unchanged
+    return unit_registry_cache.get(kb_path)
+
+def get_cookbook_matrix(cookbook_path, kb_path):
+    return matrix_cache.get(cookbook_source(cookbook_path, kb_path), kb_path)
+
+def get_recipe_ids(cookbook_path, names):
+    # cookbook indices of the recipes with the given names
+    names = set(names)
+    return [i for i, name in enumerate(recipe_names_cache.get(cookbook_source(cookbook_path))) if name in names]
+
+def cookbook_version(cookbook_path, kb_path):
+    return file_version(cookbook_source(cookbook_path, kb_path), kb_path)
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in CACHES.items()}
@@ -0,0 +1,390 @@
+import hashlib
+from datetime import datetime
+
+import numpy as np
+
+# pantry stock expiring within this many days counts as wastage
+WASTAGE_WINDOW_DAYS = 15
+# per-recipe figures kept alongside the ingredient rows, in this column order
+NUTRITION_FIELDS = ('cooking_time', 'total_calories', 'grams_carbs', 'grams_fat', 'grams_protein')
+
+
+class PantryVectors:
+    # digital pantry laid out along the columns of a CookbookMatrix
+    def __init__(self, stock, expiring, base_wastage):
+        self.stock = stock
+        self.expiring = expiring
+        # stock of items no recipe uses never changes, so it only adds a constant to the wastage
+        self.base_wastage = base_wastage
+        self.mass = float(stock.sum())
+        # swap proposal distribution, built by the optimizers on first use and shared by restarts
+        self.candidates = None
+
+
+class CookbookMatrix:
+    # the cookbook compiled once into a recipe x ingredient quantity matrix (standard units),
+    # with the knowledge bank flattened into vectors aligned with its columns. Rows are kept
+    # sparse (CSR: recipe offsets into flat column/value arrays) so a single recipe can be added
+    # or removed in time proportional to its size, and so the arrays can be memory-mapped.
+    def __init__(self, ingredient_names, recipe_offsets, columns, values, increment_quantity, purchase_factor, shelf_life, nutrition=None, purchases=None):
+        self.ingredient_names = list(ingredient_names)
+        self.ingredient_index = {name: i for i, name in enumerate(self.ingredient_names)}
+        self.recipe_offsets = np.asarray(recipe_offsets)
+        self.columns = np.asarray(columns)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.increment_quantity = np.asarray(increment_quantity, dtype=np.float64)
+        # multiply standard units by this to get purchase units
+        self.purchase_factor = np.asarray(purchase_factor, dtype=np.float64)
+        # shelf life is in weeks; freshly bought stock expires 7 * shelf_life days from now
+        self.shelf_life = np.asarray(shelf_life, dtype=np.float64)
+        self.short_shelf_life = 7 * self.shelf_life <= WASTAGE_WINDOW_DAYS
+        # recipe x NUTRITION_FIELDS; NaN where a recipe doesn't say
+        if nutrition is None:
+            nutrition = np.full((len(self.recipe_offsets) - 1, len(NUTRITION_FIELDS)), np.nan)
+        self.nutrition = np.asarray(nutrition, dtype=np.float64)
+        # purchasing.ColumnPurchases for ingredients sold in priced package sizes, None if none are
+        self.purchases = purchases
+        self._quantities = None
+        self._inverted = None
+        self._fingerprint = None
+
+    @property
+    def num_recipes(self):
+        return len(self.recipe_offsets) - 1
+
+    @property
+    def num_ingredients(self):
+        return len(self.ingredient_names)
+
+    @property
+    def quantities(self):
+        # dense recipe x ingredient matrix, built on first use; only small cookbooks need it
+        if self._quantities is None:
+            self._quantities = self.dense_rows(range(self.num_recipes))
+        return self._quantities
+
+    @property
+    def inverted_index(self):
+        # the same matrix by column (CSC): ingredient offsets into flat recipe/value arrays
+        if self._inverted is None:
+            order = np.argsort(self.columns, kind='stable')
+            recipes = np.repeat(np.arange(self.num_recipes), np.diff(self.recipe_offsets))
+            offsets = np.zeros(self.num_ingredients + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.columns, minlength=self.num_ingredients), out=offsets[1:])
+            self._inverted = (offsets, recipes[order], self.values[order])
+        return self._inverted
+
+    def fingerprint(self):
+        # content hash of everything a search reads from the matrix, computed once; dtypes are
+        # normalized so a matrix built from JSON and one mapped from the binary cookbook agree
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for array in (self.recipe_offsets, self.columns):
+                digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+            for array in (self.values, self.increment_quantity, self.purchase_factor, self.shelf_life, self.nutrition):
+                digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+            if self.purchases is not None:
+                for array in self.purchases.fingerprint_arrays():
+                    digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def ingredient_column(self, col):
+        # recipes using an ingredient and how much of it each one needs
+        offsets, recipes, values = self.inverted_index
+        start, end = offsets[col], offsets[col + 1]
+        return recipes[start:end], values[start:end]
+
+    def candidate_weights(self, pantry, exploration=0.25):
+        # how much soon-to-expire pantry stock each recipe would use up, as a distribution over
+        # recipes; `exploration` of the mass stays uniform so every recipe can still be proposed
+        scores = np.zeros(self.num_recipes)
+        for col in np.flatnonzero(pantry.expiring & (pantry.stock > 0)):
+            recipes, values = self.ingredient_column(col)
+            scores[recipes] += np.minimum(values, pantry.stock[col])
+        uniform = np.full(self.num_recipes, 1 / self.num_recipes)
+        total = scores.sum()
+        if total <= 0:
+            return uniform
+        return (1 - exploration) * scores / total + exploration * uniform
+
+    def subset(self, recipes):
+        # the matrix of just `recipes` (ascending cookbook indices) over the same ingredient columns;
+        # recipe i of the subset is recipes[i] of this matrix
+        recipes = np.asarray(recipes, dtype=np.int64)
+        starts = self.recipe_offsets[recipes]
+        lengths = self.recipe_offsets[recipes + 1] - starts
+        offsets = np.zeros(len(recipes) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        entries = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return CookbookMatrix(self.ingredient_names, offsets, self.columns[entries], self.values[entries],
+                              self.increment_quantity, self.purchase_factor, self.shelf_life, self.nutrition[recipes],
+                              self.purchases)
+
+    def recipe_row(self, recipe):
+        start, end = self.recipe_offsets[recipe], self.recipe_offsets[recipe + 1]
+        return self.columns[start:end], self.values[start:end]
+
+    def dense_rows(self, recipes):
+        rows = np.zeros((len(recipes), self.num_ingredients))
+        for i, recipe in enumerate(recipes):
+            columns, values = self.recipe_row(recipe)
+            rows[i, columns] = values
+        return rows
+
+    def pantry_vectors(self, digital_pantry, now=None):
+        if now is None:
+            now = datetime.now()
+        stock = np.zeros(self.num_ingredients)
+        expiring = np.zeros(self.num_ingredients, dtype=bool)
+        base_wastage = 0
+        for name, item in digital_pantry.items():
+            expiring_soon = (item['expiry_date'] - now).days < WASTAGE_WINDOW_DAYS
+            col = self.ingredient_index.get(name)
+            if col is None:
+                if expiring_soon and item['quantity'] > 0:
+                    base_wastage += item['quantity']
+            else:
+                stock[col] = item['quantity']
+                expiring[col] = expiring_soon
+        return PantryVectors(stock, expiring, base_wastage)
+
+    def requirements(self, plan):
+        need = np.zeros(self.num_ingredients)
+        for recipe in plan:
+            columns, values = self.recipe_row(recipe)
+            need[columns] += values
+        return need
+
+    def settle(self, need, stock, expiring, columns=slice(None)):
+        # vectorized generate_shopping_list: purchase counts, leftover stock, expiry mask and spend
+        # (None when nothing has a price), optionally restricted to a subset of columns (need,
+        # stock and expiring already sliced)
+        increment_quantity = self.increment_quantity[columns]
+        purchase_factor = self.purchase_factor[columns]
+        shortfall = need - stock
+        buying = shortfall > 0
+        required = np.where(buying, shortfall, 0) * purchase_factor
+        count = np.ceil(np.round(required / increment_quantity, 3))
+        leftover = np.maximum(0, count * increment_quantity - required) / purchase_factor
+        spend = None
+        if self.purchases is not None:
+            # priced ingredients: the cheapest mix of packages, looked up from precomputed tables
+            if isinstance(columns, slice):
+                columns = np.arange(self.num_ingredients)[columns]
+            shortfall = np.where(buying, shortfall, 0)
+            priced, bought = self.purchases.buy(columns, shortfall)
+            spend = np.zeros(np.shape(shortfall))
+            if bought is not None:
+                packages, bought, price = bought
+                count[..., priced] = packages
+                leftover[..., priced] = np.maximum(0, bought - shortfall[..., priced])
+                spend[..., priced] = price
+        new_stock = np.where(buying, leftover, stock - np.minimum(stock, need))
+        new_expiring = np.where(buying, self.short_shelf_life[columns], expiring)
+        return count, new_stock, new_expiring, spend
+
+    def evaluate(self, plan, pantry):
+        return self.settle(self.requirements(plan), pantry.stock, pantry.expiring)
+
+    def calculate_cost(self, plan, pantry, wastage_weight, pantry_change_weight, spend_weight=0):
+        _, new_stock, new_expiring, spend = self.evaluate(plan, pantry)
+        wastage_cost = new_stock[new_expiring].sum() + pantry.base_wastage
+        pantry_change_cost = new_stock.sum() - pantry.mass
+        spend_cost = spend.sum() if spend is not None else 0
+        return float((wastage_weight * wastage_cost) + (pantry_change_weight * pantry_change_cost) + (spend_weight * spend_cost))
+
+
+class PlanEvaluator:
+    # incremental calculate_cost for one plan: keeps the aggregated ingredient totals and the
+    # per-column leftover stock and spend, and rescores only the columns a swap touches. With
+    # constraints, it also keeps the plan's nutrition totals so a swap can be bounds-checked
+    # before scoring.
+    def __init__(self, matrix, pantry, wastage_weight, pantry_change_weight, plan=(), constraints=None, spend_weight=0):
+        self.matrix = matrix
+        self.pantry = pantry
+        self.wastage_weight = wastage_weight
+        self.pantry_change_weight = pantry_change_weight
+        self.spend_weight = spend_weight
+        self.constraints = constraints
+        self.limits = None
+        if constraints is not None and constraints.ranges:
+            columns, self.lows, self.highs = constraints.limits()
+            # recipe x limited field, so a swap's effect on the totals is one row difference
+            self.limits = matrix.nutrition[:, columns]
+            self.totals = np.zeros(len(columns))
+            self.violation = self._violation(self.totals)
+        self.plan = []
+        self.need = np.zeros(matrix.num_ingredients)
+        self.column_count, self.column_stock, expiring, column_spend = matrix.settle(self.need, pantry.stock, pantry.expiring)
+        self.column_wastage = np.where(expiring, self.column_stock, 0)
+        self.wastage = float(self.column_wastage.sum()) + pantry.base_wastage
+        self.final_mass = float(self.column_stock.sum())
+        # only tracked when the matrix has prices
+        self.column_spend = column_spend
+        self.spend = 0.0 if column_spend is None else float(column_spend.sum())
+        # packages (or increments) bought, which only the Pareto search looks at
+        self.purchase_count = 0.0
+        self._pending = None
+        self.accepted = 0
+        for recipe in plan:
+            self.add(recipe)
+
+    @property
+    def cost(self):
+        return self._cost(self.wastage, self.final_mass, self.spend)
+
+    def _cost(self, wastage, final_mass, spend):
+        pantry_change = final_mass - self.pantry.mass
+        return (self.wastage_weight * wastage) + (self.pantry_change_weight * pantry_change) + (self.spend_weight * spend)
+
+    @property
+    def objectives(self):
+        # the plan's unweighted (wastage, pantry change, purchases, spend)
+        return (self.wastage, self.final_mass - self.pantry.mass, self.purchase_count, self.spend)
+
+    def pending_objectives(self):
+        # objectives for the plan try_swap last scored
+        scored = self._pending[3]
+        return (scored[4], scored[5] - self.pantry.mass, scored[8], scored[6])
+
+    def _score(self, columns, need):
+        # leftover stock, wastage, spend and purchases on the given columns if their totals were `need`
+        need = np.where(np.abs(need) < 1e-9, 0, need)
+        count, stock, expiring, spend = self.matrix.settle(need, self.pantry.stock[columns],
+                                                           self.pantry.expiring[columns], columns)
+        wastage = np.where(expiring, stock, 0)
+        new_wastage = self.wastage - self.column_wastage[columns].sum() + wastage.sum()
+        new_mass = self.final_mass - self.column_stock[columns].sum() + stock.sum()
+        new_spend = self.spend
+        if spend is not None:
+            new_spend = self.spend - self.column_spend[columns].sum() + spend.sum()
+        new_count = self.purchase_count - self.column_count[columns].sum() + count.sum()
+        return (need, stock, wastage, spend, float(new_wastage), float(new_mass), float(new_spend),
+                count, float(new_count))
+
+    def _commit(self, columns, scored):
+        need, stock, wastage, spend, self.wastage, self.final_mass, self.spend, count, self.purchase_count = scored
+        self.need[columns] = need
+        self.column_count[columns] = count
+        self.column_stock[columns] = stock
+        self.column_wastage[columns] = wastage
+        if spend is not None:
+            self.column_spend[columns] = spend
+
+    def _swap_columns(self, outgoing, incoming):
+        out_columns, out_values = self.matrix.recipe_row(outgoing)
+        in_columns, in_values = self.matrix.recipe_row(incoming)
+        columns = np.union1d(out_columns, in_columns)
+        need = self.need[columns]
+        need[np.searchsorted(columns, out_columns)] -= out_values
+        need[np.searchsorted(columns, in_columns)] += in_values
+        return columns, need
+
+    def _violation(self, totals):
+        # how far nutrition totals are outside their ranges, summed over fields; 0 when within,
+        # allowing for the rounding the running totals pick up
+        excess = float(np.maximum(self.lows - totals, 0).sum() + np.maximum(totals - self.highs, 0).sum())
+        return excess if excess > 1e-9 else 0.0
+
+    def _retotal(self, outgoing=None, incoming=None):
+        if self.limits is None:
+            return
+        if outgoing is not None:
+            self.totals -= self.limits[outgoing]
+        if incoming is not None:
+            self.totals += self.limits[incoming]
+        self.violation = self._violation(self.totals)
+
+    def add(self, recipe):
+        columns, values = self.matrix.recipe_row(recipe)
+        self._commit(columns, self._score(columns, self.need[columns] + values))
+        self.plan.append(recipe)
+        self._retotal(incoming=recipe)
+
+    def remove(self, slot):
+        recipe = self.plan.pop(slot)
+        columns, values = self.matrix.recipe_row(recipe)
+        self._commit(columns, self._score(columns, self.need[columns] - values))
+        self._retotal(outgoing=recipe)
+        return recipe
+
+    def add_costs(self, recipes):
+        # cost of the plan plus each one of `recipes`, scored as a batch without changing the plan
+        matrix = self.matrix
+        _, stock, expiring, spend = matrix.settle(self.need + matrix.dense_rows(recipes),
+                                                  self.pantry.stock, self.pantry.expiring)
+        wastage = np.where(expiring, stock, 0).sum(axis=1) + self.pantry.base_wastage
+        return self._cost(wastage, stock.sum(axis=1), 0 if spend is None else spend.sum(axis=1))
+
+    def allows(self, slot, recipe):
+        # a plan never repeats a recipe, and a swap never takes the nutrition totals further out
+        # of range: once a plan meets its limits it keeps meeting them
+        if recipe in self.plan:
+            return False
+        if self.limits is None:
+            return True
+        totals = self.totals + self.limits[recipe] - self.limits[self.plan[slot]]
+        return self._violation(totals) <= self.violation
+
+    def allowed_swaps(self):
+        # (slots, recipes) of every swap allows() accepts, for when sampling keeps missing them
+        allowed = np.ones((len(self.plan), self.matrix.num_recipes), dtype=bool)
+        allowed[:, self.plan] = False
+        if self.limits is not None:
+            totals = self.totals + self.limits[None, :, :] - self.limits[self.plan][:, None, :]
+            excess = np.maximum(self.lows - totals, 0).sum(axis=2) + np.maximum(totals - self.highs, 0).sum(axis=2)
+            allowed &= np.where(excess > 1e-9, excess, 0.0) <= self.violation
+        return np.nonzero(allowed)
+
+    def within_limits(self, recipes, complete=True):
+        # which of `recipes` could be added to the plan: a complete plan must be within every
+        # range, a partial one only under the upper ends, as totals never shrink when adding
+        if self.limits is None:
+            return np.ones(len(recipes), dtype=bool)
+        totals = self.totals + self.limits[recipes]
+        fits = np.all(totals <= self.highs, axis=1)
+        if complete:
+            fits &= np.all(totals >= self.lows, axis=1)
+        return fits
+
+    def repair(self):
+        # swap recipes in until the plan meets its nutrition limits, taking for each slot in turn
+        # the recipe that most reduces the violation; False if it gets stuck short of that
+        if self.limits is None:
+            return True
+        stalled = 0
+        slot = 0
+        while self.violation > 0 and stalled < len(self.plan):
+            totals = self.totals - self.limits[self.plan[slot]] + self.limits
+            violation = np.maximum(self.lows - totals, 0).sum(axis=1) + np.maximum(totals - self.highs, 0).sum(axis=1)
+            violation[self.plan] = np.inf
+            recipe = int(np.argmin(violation))
+            if violation[recipe] < self.violation - 1e-9:
+                self.try_swap(slot, recipe)
+                self.accept()
+                stalled = 0
+            else:
+                stalled += 1
+            slot = (slot + 1) % len(self.plan)
+        return self.violation <= 0
+
+    def try_swap(self, slot, recipe):
+        # cost of the plan with `recipe` in `slot`; call accept() to keep it
+        columns, need = self._swap_columns(self.plan[slot], recipe)
+        scored = self._score(columns, need)
+        self._pending = (slot, recipe, columns, scored)
+        return self._cost(*scored[4:7])
+
+    @property
+    def pending_swap(self):
+        # the swap try_swap last scored, to accept later while nothing else has been accepted
+        return self._pending
+
+    def accept(self, swap=None):
+        slot, recipe, columns, scored = swap or self._pending
+        self._commit(columns, scored)
+        self._retotal(self.plan[slot], recipe)
+        self.plan[slot] = recipe
+        self._pending = None
+        self.accepted += 1
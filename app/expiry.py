@@ -0,0 +1,127 @@
+import bisect
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app import app, db
+from app.cookbook_matrix import WASTAGE_WINDOW_DAYS
+from app.cookbook_cache import get_raw_cookbook, get_recipe_index, file_version
+from app.metrics import metrics
+from app.models import PantryItem
+from app.pantry_events import latest_version, pantry_snapshot
+
+USE_SOON_RECIPES = 5
+
+
+class ExpiryTimeline:
+    # one pantry snapshot's rows ordered by expiry date, built once per pantry version, so what
+    # goes off before a given moment is a bisect and a slice rather than a scan of the pantry
+    def __init__(self, key, items):
+        # items: (item id, name, expiry date or None)
+        rows = sorted((expiry_date or datetime.max, item_id, name) for item_id, name, expiry_date in items)
+        self.key = key
+        self.expiry = [expiry for expiry, _, _ in rows]
+        self.rows = [(item_id, name, expiry) for expiry, item_id, name in rows]
+
+    @classmethod
+    def for_snapshot(cls, snapshot):
+        return cls(snapshot.key, [(item_id, name, entry['expiry_date']) for item_id, (name, entry) in snapshot.items.items()])
+
+    def before(self, moment):
+        # (item id, name, expiry date) of the rows expiring before `moment`, soonest first
+        return self.rows[:bisect.bisect_left(self.expiry, moment)]
+
+
+class ExpiryAlerts:
+    # a household's expired and soon-expiring stock as of one pantry version, with the recipes
+    # that would use most of it. Good until valid_until, the next time a row crosses into the
+    # window or past its date, or until the pantry or cookbook changes.
+    def __init__(self, timeline, cookbook, now, errors=()):
+        self.timeline = timeline
+        self.key = timeline.key
+        # rows left out because the planner can't convert their unit
+        self.errors = list(errors)
+        self.cookbook = cookbook
+        self.computed_at = now
+        window_end = now + timedelta(days=WASTAGE_WINDOW_DAYS)
+        soon = timeline.before(window_end)
+        split = bisect.bisect_right(timeline.expiry, now, hi=len(soon))
+        self.expired = soon[:split]
+        self.expiring = soon[split:]
+        self.ids = frozenset(item_id for item_id, _, _ in soon)
+        # the next row to go off, and the next to come within the window; rows that never
+        # expire sort last as datetime.max and change nothing
+        changes = [timeline.expiry[i] - delay for i, delay in ((split, timedelta()), (len(soon), timedelta(days=WASTAGE_WINDOW_DAYS)))
+                   if i < len(timeline.expiry) and timeline.expiry[i] != datetime.max]
+        self.valid_until = min(changes, default=datetime.max)
+        self.use_soon = use_soon_recipes([name for _, name, _ in self.expiring])
+
+    def fresh(self, key, cookbook, now):
+        return self.key == key and self.cookbook == cookbook and now < self.valid_until
+
+    def to_dict(self):
+        def rows(items):
+            return [{'id': item_id, 'name': name, 'expiry_date': expiry.strftime('%Y-%m-%d')} for item_id, name, expiry in items]
+        return {'expired': rows(self.expired), 'expiring': rows(self.expiring), 'use_soon': self.use_soon, 'errors': self.errors,
+                'valid_until': None if self.valid_until == datetime.max else self.valid_until.isoformat(timespec='seconds')}
+
+
+def use_soon_recipes(names, limit=USE_SOON_RECIPES):
+    # [{'id', 'name', 'uses'}] of the recipes using the most of `names`, soonest-expiring first in
+    # `names`; ties keep cookbook order
+    if not names:
+        return []
+    cookbook_path = app.config['COOKBOOK_PATH']
+    index = get_recipe_index(cookbook_path)
+    uses = {}
+    for name in dict.fromkeys(name.strip().lower() for name in names):
+        for recipe_id in index.ingredient_recipes.get(name, ()):
+            uses.setdefault(int(recipe_id), []).append(name)
+    ranked = sorted(uses.items(), key=lambda entry: (-len(entry[1]), entry[0]))[:limit]
+    cookbook = get_raw_cookbook(cookbook_path)
+    return [{'id': recipe_id, 'name': cookbook[recipe_id]['name'], 'uses': used} for recipe_id, used in ranked]
+
+
+# household id -> latest ExpiryAlerts this process has built
+_alerts = {}
+_alerts_lock = threading.Lock()
+
+def expiry_alerts(household_id, now=None):
+    # the household's current alerts: the stored ones while nothing they depend on has moved,
+    # otherwise rebuilt, reusing the timeline when only the clock has
+    if now is None:
+        now = datetime.now()
+    cookbook = file_version(app.config['COOKBOOK_PATH'])
+    try:
+        snapshot = pantry_snapshot(household_id)
+    except NotImplementedError:
+        return unconverted_alerts(household_id, cookbook, now)
+    alerts = _alerts.get(household_id)
+    if alerts is not None and alerts.fresh(snapshot.key, cookbook, now):
+        return alerts
+    with _alerts_lock:
+        alerts = _alerts.get(household_id)
+        if alerts is not None and alerts.fresh(snapshot.key, cookbook, now):
+            return alerts
+        timeline = alerts.timeline if alerts is not None and alerts.key == snapshot.key else ExpiryTimeline.for_snapshot(snapshot)
+        alerts = ExpiryAlerts(timeline, cookbook, now)
+        _alerts[household_id] = alerts
+        metrics.increment('chef_expiry_alerts_builds_total')
+    return alerts
+
+def unconverted_alerts(household_id, cookbook, now):
+    # a pantry with a row in a unit the planner can't convert has no snapshot. Alerts only need
+    # names and dates, so they're built straight from the rows, leaving those ones out and
+    # naming them in `errors`; not kept, as the pantry needs fixing anyway.
+    from app.cookbook_cache import get_unit_registry
+
+    units = get_unit_registry(app.config['KNOWLEDGE_BANK_PATH'])
+    version = latest_version(household_id)
+    rows = db.session.execute(select(PantryItem.id, PantryItem.name, PantryItem.unit, PantryItem.expiry_date)
+                              .where(PantryItem.household_id == household_id)).all()
+    errors = [f'Unit {unit} for item {name} not converted!' for _, name, unit, _ in rows if not units.knows(name, unit)]
+    timeline = ExpiryTimeline(('pantry', household_id, version, tuple(errors)),
+                              [(item_id, name, expiry_date) for item_id, name, unit, expiry_date in rows if units.knows(name, unit)])
+    metrics.increment('chef_expiry_alerts_builds_total')
+    return ExpiryAlerts(timeline, cookbook, now, errors)
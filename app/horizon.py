@@ -0,0 +1,248 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from app.cookbook_matrix import WASTAGE_WINDOW_DAYS
+from app.meal_planner import build_cookbook_matrix, get_optimizer
+from app.purchasing import purchase_options, priced_purchase
+
+DAYS_PER_WEEK = 7
+
+
+class HorizonPantry:
+    # the digital pantry as columns of a CookbookMatrix, with expiry kept as days from the start
+    # of the horizon rather than the single expiring-soon flag PantryVectors has
+    def __init__(self, matrix, digital_pantry, weeks, now=None):
+        if now is None:
+            now = datetime.now()
+        self.now = now
+        self.stock = np.zeros(matrix.num_ingredients)
+        # stock nobody has is treated as never expiring
+        self.expiry = np.full(matrix.num_ingredients, np.inf)
+        window_end = DAYS_PER_WEEK * (weeks - 1) + WASTAGE_WINDOW_DAYS
+        self.base_wastage = 0
+        for name, item in digital_pantry.items():
+            days = (item['expiry_date'] - now).total_seconds() / 86400
+            col = matrix.ingredient_index.get(name)
+            if col is None:
+                # no recipe touches it, so it just sits there until it expires
+                if days < window_end and item['quantity'] > 0:
+                    self.base_wastage += item['quantity']
+            else:
+                self.stock[col] = item['quantity']
+                self.expiry[col] = days
+        self.mass = float(self.stock.sum())
+        # what the optimizers' candidate sampler looks at: stock going off in the first week
+        self.expiring = self.expiry < WASTAGE_WINDOW_DAYS
+        self.candidates = None
+
+
+class HorizonEvaluator:
+    # cost of `weeks` consecutive plans, simulating the pantry from week to week: each week
+    # stock past its expiry is thrown out (wastage), the week's recipes are cooked, shortfalls
+    # are bought fresh (and paid for, where the ingredient has a price), and whatever is left
+    # carries over. Stock still around at the end that expires within the usual window after the
+    # last week counts as wastage too, so a one-week horizon costs exactly what
+    # CookbookMatrix.calculate_cost says.
+    #
+    # Ingredients never interact, so a swap in week j only re-simulates the columns the two
+    # recipes use, from week j on, against the stored per-week snapshots.
+    def __init__(self, matrix, pantry, weeks, num_meals, wastage_weight, pantry_change_weight, plans, spend_weight=0):
+        self.matrix = matrix
+        self.pantry = pantry
+        self.weeks = weeks
+        self.num_meals = num_meals
+        self.wastage_weight = wastage_weight
+        self.pantry_change_weight = pantry_change_weight
+        self.spend_weight = spend_weight
+        # flat over weeks: slot s is meal s % num_meals of week s // num_meals
+        self.plan = [recipe for plan in plans for recipe in plan]
+        self.accepted = 0
+        self._pending = None
+
+        n = matrix.num_ingredients
+        self.need = np.zeros((weeks, n))
+        for week, plan in enumerate(plans):
+            self.need[week] = matrix.requirements(plan)
+        # snapshots at the start of each week, and after the last one
+        self.stock = np.zeros((weeks + 1, n))
+        self.expiry = np.zeros((weeks + 1, n))
+        self.stock[0] = pantry.stock
+        self.expiry[0] = pantry.expiry
+        self.discarded = np.zeros((weeks, n))
+        self.count = np.zeros((weeks, n))
+        # standard units bought each week, and what that cost
+        self.bought = np.zeros((weeks, n))
+        self.spent = np.zeros((weeks, n))
+
+        all_columns = np.arange(n)
+        self._commit(0, all_columns, self._simulate(0, all_columns, self.need[:, all_columns]))
+        self.column_wastage = self._column_wastage(self.discarded, self.stock[weeks], self.expiry[weeks])
+        self.wastage = float(self.column_wastage.sum()) + pantry.base_wastage
+        self.final_mass = float(self.stock[weeks].sum())
+        self.column_spend = self.spent.sum(axis=0)
+        self.spend = float(self.column_spend.sum())
+
+    @property
+    def cost(self):
+        return self._cost(self.wastage, self.final_mass, self.spend)
+
+    def _cost(self, wastage, final_mass, spend):
+        pantry_change = final_mass - self.pantry.mass
+        return (self.wastage_weight * wastage) + (self.pantry_change_weight * pantry_change) + (self.spend_weight * spend)
+
+    def week_plans(self):
+        return [self.plan[week * self.num_meals:(week + 1) * self.num_meals] for week in range(self.weeks)]
+
+    def _simulate(self, start_week, columns, need):
+        # run `columns` forward from the snapshot at `start_week`; need is (weeks, len(columns))
+        matrix = self.matrix
+        shelf_days = DAYS_PER_WEEK * matrix.shelf_life[columns]
+        stock = self.stock[start_week, columns].copy()
+        expiry = self.expiry[start_week, columns].copy()
+        weeks = self.weeks - start_week
+        stocks = np.empty((weeks, len(columns)))
+        expiries = np.empty((weeks, len(columns)))
+        discarded = np.zeros((weeks, len(columns)))
+        counts = np.empty((weeks, len(columns)))
+        bought = np.empty((weeks, len(columns)))
+        spent = np.zeros((weeks, len(columns)))
+        for i in range(weeks):
+            week = start_week + i
+            day = DAYS_PER_WEEK * week
+            if week > 0:
+                # anything that went off since last week is thrown out before cooking
+                gone = expiry <= day
+                discarded[i] = np.where(gone, stock, 0)
+                stock = np.where(gone, 0, stock)
+            week_need = np.where(np.abs(need[week]) < 1e-9, 0, need[week])
+            buying = week_need - stock > 0
+            bought[i] = np.where(buying, week_need - stock, 0)
+            counts[i], stock, _, spend = matrix.settle(week_need, stock, buying, columns)
+            if spend is not None:
+                spent[i] = spend
+            expiry = np.where(buying, day + shelf_days, expiry)
+            stocks[i] = stock
+            expiries[i] = expiry
+        return discarded, counts, stocks, expiries, bought, spent
+
+    def _column_wastage(self, discarded, final_stock, final_expiry):
+        # discarded is (weeks, len(columns)) in full-horizon order
+        window_end = DAYS_PER_WEEK * (self.weeks - 1) + WASTAGE_WINDOW_DAYS
+        return discarded.sum(axis=0) + np.where(final_expiry < window_end, final_stock, 0)
+
+    def _commit(self, start_week, columns, simulated):
+        discarded, counts, stocks, expiries, bought, spent = simulated
+        self.discarded[start_week:, columns] = discarded
+        self.count[start_week:, columns] = counts
+        self.bought[start_week:, columns] = bought
+        self.spent[start_week:, columns] = spent
+        self.stock[start_week + 1:, columns] = stocks
+        self.expiry[start_week + 1:, columns] = expiries
+
+    def allows(self, slot, recipe):
+        # a recipe may come back in another week, just not twice in one
+        start = slot - slot % self.num_meals
+        return recipe not in self.plan[start:start + self.num_meals]
+
+    def allowed_swaps(self):
+        # (slots, recipes) of every swap allows() accepts
+        allowed = np.ones((len(self.plan), self.matrix.num_recipes), dtype=bool)
+        for slot in range(len(self.plan)):
+            start = slot - slot % self.num_meals
+            allowed[slot, self.plan[start:start + self.num_meals]] = False
+        return np.nonzero(allowed)
+
+    def try_swap(self, slot, recipe):
+        # cost of the horizon with `recipe` in `slot`; call accept() to keep it
+        week = slot // self.num_meals
+        out_columns, out_values = self.matrix.recipe_row(self.plan[slot])
+        in_columns, in_values = self.matrix.recipe_row(recipe)
+        columns = np.union1d(out_columns, in_columns)
+        need = self.need[:, columns]
+        need[week, np.searchsorted(columns, out_columns)] -= out_values
+        need[week, np.searchsorted(columns, in_columns)] += in_values
+
+        simulated = self._simulate(week, columns, need)
+        discarded = self.discarded[:, columns].copy()
+        discarded[week:] = simulated[0]
+        wastage = self._column_wastage(discarded, simulated[2][-1], simulated[3][-1])
+        new_wastage = self.wastage - self.column_wastage[columns].sum() + wastage.sum()
+        new_mass = self.final_mass - self.stock[self.weeks, columns].sum() + simulated[2][-1].sum()
+        spend = self.column_spend[columns] - self.spent[week:, columns].sum(axis=0) + simulated[5].sum(axis=0)
+        new_spend = self.spend - self.column_spend[columns].sum() + spend.sum()
+        self._pending = (slot, recipe, week, columns, need, simulated, wastage, spend,
+                         float(new_wastage), float(new_mass), float(new_spend))
+        return self._cost(new_wastage, new_mass, new_spend)
+
+    @property
+    def pending_swap(self):
+        # the swap try_swap last scored, to accept later while nothing else has been accepted
+        return self._pending
+
+    def accept(self, swap=None):
+        slot, recipe, week, columns, need, simulated, wastage, spend, self.wastage, self.final_mass, self.spend = swap or self._pending
+        self.need[:, columns] = need
+        self._commit(week, columns, simulated)
+        self.column_wastage[columns] = wastage
+        self.column_spend[columns] = spend
+        self.plan[slot] = recipe
+        self._pending = None
+        self.accepted += 1
+
+
+def random_week_plans(num_recipes, weeks, num_meals, rng):
+    return [rng.sample(range(num_recipes), num_meals) for _ in range(weeks)]
+
+def optimize_horizon(matrix, pantry, weeks, iterations, wastage_weight, pantry_change_weight, num_meals=6, rng=None, optimizer='annealing', time_limit=None, spend_weight=0):
+    # (one plan of recipe indices per week, total cost); iterations are spread over the whole horizon
+    if rng is None:
+        rng = random.Random()
+    optimizer = get_optimizer(optimizer, iterations, time_limit)
+    if optimizer.name == 'exact':
+        raise ValueError('The exact optimizer plans a single week only')
+    evaluator = HorizonEvaluator(matrix, pantry, weeks, num_meals, wastage_weight, pantry_change_weight,
+                                 random_week_plans(matrix.num_recipes, weeks, num_meals, rng), spend_weight)
+    if matrix.num_recipes <= num_meals:
+        return evaluator.week_plans(), evaluator.cost
+    # annealing and tabu hand back the best plan seen, which needn't be the evaluator's current one
+    plan, cost = optimizer.run(evaluator, num_meals, rng)
+    return [plan[week * num_meals:(week + 1) * num_meals] for week in range(weeks)], cost
+
+def horizon_shopping_lists(matrix, evaluator, knowledge_bank):
+    # per-week purchases from the simulation, in generate_shopping_list's format
+    shopping_lists = []
+    for week in range(evaluator.weeks):
+        shopping_list = {}
+        for col in np.flatnonzero(evaluator.count[week] > 0):
+            name = matrix.ingredient_names[col]
+            increment = knowledge_bank[name]['increment']
+            options = purchase_options(name, knowledge_bank[name])
+            if options is None:
+                shopping_list[name] = {'count': int(evaluator.count[week, col]), 'increment': increment}
+            else:
+                shopping_list[name], _ = priced_purchase(options, evaluator.bought[week, col], increment)
+        shopping_lists.append(shopping_list)
+    return shopping_lists
+
+def plan_horizon(all_recipes, digital_pantry, knowledge_bank, weeks, iterations, wastage_weight, pantry_change_weight, num_meals=6, matrix=None, rng=None, optimizer='annealing', time_limit=None, now=None, seed=None, spend_weight=0):
+    # returns a list of weeks, each {'start', 'recipes', 'shopping_list'}, and the horizon's cost
+    if rng is None:
+        rng = random.Random(seed)
+    if matrix is None:
+        matrix = build_cookbook_matrix(all_recipes, knowledge_bank)
+    pantry = HorizonPantry(matrix, digital_pantry, weeks, now)
+    week_plans, _ = optimize_horizon(matrix, pantry, weeks, iterations, wastage_weight, pantry_change_weight,
+                                     num_meals, rng, optimizer, time_limit, spend_weight)
+
+    # rescore from scratch so incremental rounding never reaches the caller
+    evaluator = HorizonEvaluator(matrix, pantry, weeks, num_meals, wastage_weight, pantry_change_weight, week_plans,
+                                 spend_weight)
+    shopping_lists = horizon_shopping_lists(matrix, evaluator, knowledge_bank)
+    schedule = []
+    for week, plan in enumerate(week_plans):
+        schedule.append({'start': pantry.now + timedelta(days=DAYS_PER_WEEK * week),
+                         'recipes': [all_recipes[i] for i in plan],
+                         'shopping_list': shopping_lists[week]})
+    return schedule, round(evaluator.cost, 1)
@@ -0,0 +1,118 @@
+import json
+import threading
+from datetime import datetime
+
+from flask import g, request
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import Household, PantryItem, StagedPlan, DEFAULT_HOUSEHOLD_ID, DEFAULT_HOUSEHOLD_NAME
+
+# requests pick their household with this header or cookie; neither means the default one.
+# Either can be set by any client, so on their own households only keep pantries apart, they don't
+# protect one from another. Behind a server or proxy that authenticates users (and sets
+# REMOTE_USER), each user's household is their username and the header and cookie are ignored.
+HOUSEHOLD_HEADER = 'X-Household'
+HOUSEHOLD_COOKIE = 'household'
+MAX_NAME_LENGTH = 100
+
+# name -> id; households are never renamed or deleted, so this never goes stale
+_household_ids = {DEFAULT_HOUSEHOLD_NAME: DEFAULT_HOUSEHOLD_ID}
+_household_ids_lock = threading.Lock()
+
+
+def household_id_for(name):
+    household_id = _household_ids.get(name)
+    if household_id is not None:
+        return household_id
+
+    household = Household.query.filter_by(name=name).first()
+    if household is None:
+        try:
+            household = Household(name=name)
+            db.session.add(household)
+            db.session.commit()
+        except IntegrityError:
+            # created by a concurrent request first
+            db.session.rollback()
+            household = Household.query.filter_by(name=name).one()
+    with _household_ids_lock:
+        _household_ids[name] = household.id
+    return household.id
+
+def authenticated_household():
+    return request.remote_user
+
+def requested_household():
+    user = authenticated_household()
+    if user:
+        return user[:MAX_NAME_LENGTH]
+    name = request.headers.get(HOUSEHOLD_HEADER) or request.cookies.get(HOUSEHOLD_COOKIE) or DEFAULT_HOUSEHOLD_NAME
+    name = name.strip()[:MAX_NAME_LENGTH]
+    return name or DEFAULT_HOUSEHOLD_NAME
+
+def current_household_id():
+    if 'household_id' not in g:
+        g.household_id = household_id_for(requested_household())
+    return g.household_id
+
+def household_items(household_id=None):
+    if household_id is None:
+        household_id = current_household_id()
+    return PantryItem.query.filter_by(household_id=household_id)
+
+def household_item_or_404(item_id):
+    # another household's item is as good as missing
+    return household_items().filter_by(id=item_id).first_or_404()
+
+
+def get_staged_plan(household_id=None):
+    if household_id is None:
+        household_id = current_household_id()
+    return StagedPlan.query.filter_by(household_id=household_id).first()
+
+def stage_plan(recipe_names, household_id=None):
+    # replaces whatever the household had staged; the version bump makes any execution that
+    # read the old plan fail its compare-and-set
+    if household_id is None:
+        household_id = current_household_id()
+    values = {'recipes': list(recipe_names), 'executed': False, 'staged_at': datetime.now()}
+    for _ in range(2):
+        result = db.session.execute(update(StagedPlan).where(StagedPlan.household_id == household_id)
+                                    .values(version=StagedPlan.version + 1, **values))
+        if result.rowcount:
+            db.session.commit()
+            return
+        try:
+            db.session.add(StagedPlan(household_id=household_id, version=1, **values))
+            db.session.commit()
+            return
+        except IntegrityError:
+            # another request staged the first plan at the same moment; update that one instead
+            db.session.rollback()
+    raise RuntimeError('Could not stage the meal plan, please retry.')
+
+def claim_execution(staged_plan):
+    # mark the plan executed only if nobody executed or restaged it since it was read.
+    # Runs in the caller's transaction, so losing the race rolls back the pantry writes too.
+    result = db.session.execute(update(StagedPlan)
+                                .where(StagedPlan.id == staged_plan.id,
+                                       StagedPlan.version == staged_plan.version,
+                                       StagedPlan.executed.is_(False))
+                                .values(executed=True, version=StagedPlan.version + 1)
+                                .execution_options(synchronize_session=False))
+    return result.rowcount == 1
+
+def import_staged_plan_file(path):
+    # one-off move of the old global staged_meal_plan.json into the default household
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return
+    if not data.get('recipes') or get_staged_plan(DEFAULT_HOUSEHOLD_ID) is not None:
+        return
+    db.session.add(StagedPlan(household_id=DEFAULT_HOUSEHOLD_ID, recipes=data['recipes'],
+                              executed=bool(data.get('executed')), version=1))
+    db.session.commit()
@@ -0,0 +1,234 @@
+import csv
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from app.cookbook_binary import write_binary_cookbook
+from app.meal_planner import load_knowledge_bank
+from app.units import registry as units, knowledge_bank_units
+
+MANIFEST_VERSION = 2
+# below this many files, starting worker processes costs more than it saves
+PARALLEL_THRESHOLD = 64
+# files handed to the worker processes at a time, so only a batch of parses is held in memory
+PARSE_BATCH = 1024
+
+
+def manifest_path_for(folder_path):
+    return os.path.normpath(folder_path) + '.manifest.json'
+
+def load_manifest(path):
+    # from the last run: {'output': {path, mtime_ns, size}, 'units': digest, 'files': {filename:
+    # {mtime_ns, size, sha1, errors[, offset, length]}}}, where offset and length locate a recipe
+    # that made it into the output
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'output': None, 'units': None, 'files': {}}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'output': None, 'units': None, 'files': {}}
+    return manifest
+
+def save_manifest(path, output, units_digest, files):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'output': output, 'units': units_digest, 'files': files}, f)
+    os.replace(tmp_path, path)
+
+def output_stamp(cache_file):
+    stat = os.stat(cache_file)
+    return {'path': os.path.abspath(cache_file), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+def valid_output(manifest):
+    # the output the manifest's offsets point into, if it is still the file that run wrote
+    output = manifest['output']
+    try:
+        return output is not None and output_stamp(output['path']) == output
+    except FileNotFoundError:
+        return False
+
+def units_digest(unit_registry):
+    # which recipes pass the unit check depends on these, so a change means checking them all again
+    return hashlib.sha1(json.dumps([unit_registry.factors, unit_registry.overrides], sort_keys=True).encode('utf-8')).hexdigest()
+
+def parse_recipe_text(text):
+    # one recipe CSV: a header row of recipe details, then quantity,unit,name rows.
+    # Returns (recipe dict as stored in cookbook.json, list of problems); recipe is None if unusable
+    reader = csv.reader(io.StringIO(text))
+    try:
+        header = next(reader)
+        recipe = {
+            'name': header[0],
+            'cooking_time': int(header[1]),
+            'total_calories': int(header[2]),
+            'grams_carbs': float(header[3]),
+            'grams_fat': float(header[4]),
+            'grams_protein': float(header[5]),
+        }
+    except (StopIteration, IndexError, ValueError) as e:
+        return None, [f'bad recipe header: {e}']
+
+    ingredients = []
+    errors = []
+    for line, row in enumerate(reader, start=2):
+        if not row:
+            continue
+        try:
+            ingredients.append({'quantity': float(row[0]), 'unit': row[1], 'name': row[2]})
+        except (IndexError, ValueError) as e:
+            errors.append(f'line {line}: bad ingredient row {row}: {e}')
+    recipe['ingredients'] = ingredients
+    return recipe, errors
+
+def parse_recipe_path(path):
+    # worker entry point: read, hash and parse one file
+    with open(path, 'rb') as f:
+        data = f.read()
+    recipe, errors = parse_recipe_text(data.decode('utf-8'))
+    return hashlib.sha1(data).hexdigest(), recipe, errors
+
+def parse_recipe_paths(paths, processes=None):
+    # lazily, in order; large sets are parsed in worker processes a batch at a time
+    workers = processes or os.cpu_count() or 1
+    if len(paths) < PARALLEL_THRESHOLD or workers == 1:
+        yield from map(parse_recipe_path, paths)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(paths), PARSE_BATCH):
+            batch = paths[start:start + PARSE_BATCH]
+            yield from executor.map(parse_recipe_path, batch, chunksize=max(1, len(batch) // (workers * 8)))
+
+def file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha1').hexdigest()
+
+def unit_errors(recipe, unit_registry=units):
+    return [f"unit {item['unit']} for {item['name']} has no conversion" for item in recipe['ingredients']
+            if not unit_registry.knows(item['name'], item['unit'])]
+
+def scan_cookbook(folder_path, manifest_files):
+    # stat every recipe CSV in a folder against the last run's entries. Returns (files, edited):
+    # entries in filename order, reused for files whose mtime and size (or, failing that, content
+    # hash) are unchanged, and the names of files that are new or were edited
+    files = {}
+    edited = set()
+    for entry in sorted(os.scandir(folder_path), key=lambda entry: entry.name):
+        if not entry.name.endswith('.csv'):
+            continue
+        stat = entry.stat()
+        previous = manifest_files.get(entry.name)
+        if previous is not None and (previous['mtime_ns'], previous['size']) == (stat.st_mtime_ns, stat.st_size):
+            files[entry.name] = previous
+        elif previous is not None and previous['sha1'] == file_sha1(entry.path):
+            # touched but not edited
+            files[entry.name] = dict(previous, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        else:
+            files[entry.name] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+            edited.add(entry.name)
+    return files, edited
+
+def read_recipe(f, entry):
+    f.seek(entry['offset'])
+    chunk = f.read(entry['length'])
+    return chunk, json.loads(chunk)
+
+def encode_recipe(recipe):
+    # as json.dump(recipes, f, indent=4) lays out one element
+    return json.dumps(recipe, indent=4).replace('\n', '\n    ').encode('utf-8')
+
+def folder_recipes(folder_path):
+    # every parsed recipe in a folder, including those the unit check skipped: from the last
+    # ingest's output where a file is unchanged, parsed otherwise
+    manifest = load_manifest(manifest_path_for(folder_path))
+    files, edited = scan_cookbook(folder_path, manifest['files'] if valid_output(manifest) else {})
+    reparse = [name for name, entry in files.items() if name in edited or 'offset' not in entry]
+    parsed = parse_recipe_paths([os.path.join(folder_path, name) for name in reparse])
+    output = open(manifest['output']['path'], 'rb') if len(reparse) < len(files) else None
+    try:
+        for name, entry in files.items():
+            if name in edited or 'offset' not in entry:
+                recipe = next(parsed)[1]
+            else:
+                recipe = read_recipe(output, entry)[1]
+            if recipe is not None:
+                yield recipe
+    finally:
+        if output is not None:
+            output.close()
+
+def write_cookbook(folder_path, cache_file, files, edited, reuse, unit_registry=units, processes=None):
+    # stream the recipes that pass every check to cache_file, byte-identical to json.dump(recipes,
+    # f, indent=4), yielding each as it's written. Entries in `files` are completed in place: a
+    # file is reparsed if edited or missing from the old output, otherwise copied from it; with
+    # `reuse` false (knowledge bank units changed) copied recipes are checked for units again
+    reparse = [name for name, entry in files.items() if name in edited or 'offset' not in entry]
+    parsed = parse_recipe_paths([os.path.join(folder_path, name) for name in reparse], processes)
+    tmp_path = f'{cache_file}.tmp'
+    old = open(cache_file, 'rb') if len(reparse) < len(files) else None
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(b'[')
+            for name, entry in files.items():
+                if name in edited or 'offset' not in entry:
+                    sha1, recipe, errors = next(parsed)
+                    chunk = None
+                else:
+                    chunk, recipe = read_recipe(old, entry)
+                    sha1, errors = entry['sha1'], []
+                problems = errors + (unit_errors(recipe, unit_registry) if recipe is not None and (chunk is None or not reuse) else [])
+                files[name] = {'mtime_ns': entry['mtime_ns'], 'size': entry['size'], 'sha1': sha1, 'errors': problems}
+                if problems:
+                    continue
+                if chunk is None:
+                    chunk = encode_recipe(recipe)
+                f.write(b',\n    ' if f.tell() > 1 else b'\n    ')
+                files[name].update(offset=f.tell(), length=len(chunk))
+                f.write(chunk)
+                yield recipe
+            f.write(b'\n]' if f.tell() > 1 else b']')
+    finally:
+        if old is not None:
+            old.close()
+    os.replace(tmp_path, cache_file)
+
+def ingest_cookbook(folder_path, cache_file, binary_file=None, manifest_path=None, processes=None, knowledge_bank_file=None):
+    # rebuild cookbook.json (and the binary cookbook) from a folder of recipe CSVs, reparsing
+    # only files that changed since the last run. Recipes with problems are left out and reported.
+    # Recipes are streamed from the parses to the outputs; the manifest keeps only where each
+    # one sits in cookbook.json.
+    unit_registry = units
+    has_knowledge_bank = knowledge_bank_file and os.path.exists(knowledge_bank_file)
+    if has_knowledge_bank:
+        # its unit overrides, for the unit check and the binary cookbook's quantities
+        unit_registry = knowledge_bank_units(load_knowledge_bank(knowledge_bank_file))
+    if manifest_path is None:
+        manifest_path = manifest_path_for(folder_path)
+    manifest = load_manifest(manifest_path)
+    # offsets are only good for the output that run wrote
+    reuse_output = valid_output(manifest) and manifest['output']['path'] == os.path.abspath(cache_file)
+    files, edited = scan_cookbook(folder_path, manifest['files'] if reuse_output else {})
+    # a knowledge bank edit can change which recipes pass the unit check without touching any file
+    digest = units_digest(unit_registry)
+    changed = bool(edited) or set(files) != set(manifest['files']) or digest != manifest['units']
+
+    outputs = [cache_file] + ([binary_file] if binary_file else [])
+    # the binary cookbook holds converted quantities, so a knowledge bank edit also dates it
+    stale_binary = (binary_file and has_knowledge_bank and os.path.exists(binary_file)
+                    and os.stat(binary_file).st_mtime_ns < os.stat(knowledge_bank_file).st_mtime_ns)
+    rebuild = changed or stale_binary or not reuse_output or not all(os.path.exists(path) for path in outputs)
+    if rebuild:
+        recipes = write_cookbook(folder_path, cache_file, files, edited, digest == manifest['units'], unit_registry, processes)
+        if binary_file:
+            # fed from the same pass, and renamed into place after the JSON, so the app sees it
+            # as current and memory-maps it instead
+            write_binary_cookbook(recipes, binary_file, unit_registry)
+        else:
+            for _ in recipes:
+                pass
+        # only after the outputs, so an interrupted run is redone next time
+        save_manifest(manifest_path, output_stamp(cache_file), digest, files)
+    errors = {name: entry['errors'] for name, entry in files.items() if entry['errors']}
+    return {'recipes': len(files) - len(errors), 'files': len(files), 'errors': errors, 'rebuilt': rebuild}
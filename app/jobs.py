@@ -0,0 +1,246 @@
+import multiprocessing
+import queue
+import random
+import threading
+import uuid
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from app.meal_planner import get_optimizer, optimize_meal_plan, rank_meal_plans, make_run_record, planning_params
+from app.runs import inputs_fingerprint
+from app.constraints import constrained_matrix
+from app.metrics import record_search
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+FINISHED = (DONE, CANCELLED, FAILED)
+# how often a job's thread checks its search process for progress and cancellation, in seconds
+POLL_SECONDS = 0.1
+
+
+def _best_of(meal_plans):
+    if not meal_plans:
+        return {'best_recipes': None, 'best_cost': None}
+    plan, cost, _, _ = meal_plans[0]
+    return {'best_recipes': [recipe['name'] for recipe in plan], 'best_cost': cost}
+
+def summarize_meal_plans(meal_plans):
+    # JSON-friendly view of rank_meal_plans output
+    return [{'recipes': [recipe['name'] for recipe in plan], 'cost': cost, 'shopping_list': shopping_list}
+            for plan, cost, shopping_list, _ in meal_plans]
+
+
+class PlanningJob:
+    # one background planning run; watchers block on `changed` until `version` moves
+    def __init__(self, key, num_plans, seed=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.num_plans = num_plans
+        self.seed = seed
+        # a RunRecord per finished restart
+        self.runs = []
+        self.status = QUEUED
+        self.completed_plans = 0
+        self.best_recipes = None
+        self.best_cost = None
+        self.meal_plans = None
+        self.error = None
+        self.version = 0
+        self.changed = threading.Condition()
+        self._cancel = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def update(self, **fields):
+        with self.changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait(self, version, timeout=None):
+        # block until there is news past `version` (or the job ends); returns the current version
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version or self.finished, timeout)
+            return self.version
+
+    def to_dict(self):
+        job = {
+            'job_id': self.id,
+            'status': self.status,
+            'completed_plans': self.completed_plans,
+            'num_plans': self.num_plans,
+            'best_cost': None if self.best_cost is None else round(self.best_cost, 1),
+            'best_recipes': self.best_recipes,
+            'seed': self.seed,
+            'runs': [run.to_dict() for run in self.runs],
+        }
+        if self.meal_plans is not None:
+            job['meal_plans'] = summarize_meal_plans(self.meal_plans)
+        if self.error is not None:
+            job['error'] = self.error
+        return job
+
+
+# state of a job's search process, set once when it starts
+_worker_state = {}
+
+def _init_job_worker(matrix, pantry, progress, cancelled):
+    _worker_state.update(matrix=matrix, pantry=pantry, progress=progress, cancelled=cancelled)
+
+def _run_job_search(run_seed, iterations, wastage_weight, pantry_change_weight, num_meals, optimizer, time_limit,
+                    constraints, spend_weight):
+    # one restart in the search process; new best plans go back over the progress queue, and the
+    # search stops at its next evaluation once the job's thread sets `cancelled`
+    progress = _worker_state['progress']
+    cancelled = _worker_state['cancelled']
+    search = get_optimizer(optimizer, iterations, time_limit)
+    search.callback = lambda plan, cost, evaluations: progress.put((list(plan), cost))
+    finished = threading.Event()
+
+    def watch():
+        while not finished.wait(POLL_SECONDS):
+            if cancelled.is_set() and search.budget is not None:
+                search.budget.stop()
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    try:
+        plan, cost = optimize_meal_plan(_worker_state['matrix'], _worker_state['pantry'], iterations, wastage_weight,
+                                        pantry_change_weight, num_meals, random.Random(run_seed), search,
+                                        constraints=constraints, spend_weight=spend_weight)
+    finally:
+        finished.set()
+        watcher.join()
+    return plan, cost, search.name, search.stats
+
+
+class JobManager:
+    # runs planning jobs in the background so requests return immediately. Each job's searches
+    # run in a process of its own, as they are CPU-bound and would hold the GIL against the
+    # web threads; a small thread pool only follows them and caps how many run at once.
+    # Finished results are kept in an LRU keyed by the planning inputs and reused by identical
+    # requests.
+    def __init__(self, max_workers=2, max_jobs=100, max_results=32):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='planner')
+        self.max_jobs = max_jobs
+        self.max_results = max_results
+        self.jobs = OrderedDict()
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def status_counts(self):
+        counts = dict.fromkeys((QUEUED, RUNNING) + FINISHED, 0)
+        for job in list(self.jobs.values()):
+            counts[job.status] += 1
+        return counts
+
+    def submit(self, key, all_recipes, digital_pantry, knowledge_bank, matrix, iterations, wastage_weight,
+               pantry_change_weight, num_plans=5, num_meals=6, optimizer='hill_climb', time_limit=None, seed=None,
+               cache_versions=None, constraints=None, spend_weight=0):
+        with self.lock:
+            # an identical job already running is shared rather than started twice
+            for job in self.jobs.values():
+                if job.key == key and not job.finished:
+                    return job
+
+            # an unseeded job still gets a seed, so its runs can be reproduced
+            if seed is None:
+                seed = random.SystemRandom().getrandbits(32)
+            job = PlanningJob(key, num_plans, seed)
+            self.jobs[job.id] = job
+            self._evict()
+            if key in self.results:
+                self.results.move_to_end(key)
+                # the stored result came from its own seed, which is the one that reproduces it
+                meal_plans, runs, seed = self.results[key]
+                job.update(status=DONE, completed_plans=num_plans, meal_plans=meal_plans, runs=runs, seed=seed,
+                           **_best_of(meal_plans))
+                return job
+
+        self.executor.submit(self._run, job, all_recipes, digital_pantry, knowledge_bank, matrix, iterations,
+                             wastage_weight, pantry_change_weight, num_meals, optimizer, time_limit, seed,
+                             cache_versions, constraints, spend_weight)
+        return job
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def _run(self, job, all_recipes, digital_pantry, knowledge_bank, matrix, iterations, wastage_weight,
+             pantry_change_weight, num_meals, optimizer, time_limit, seed, cache_versions, constraints, spend_weight):
+        job.update(status=RUNNING)
+        try:
+            now = datetime.now()
+            matrix, recipe_ids = constrained_matrix(matrix, constraints, num_meals)
+            pantry = matrix.pantry_vectors(digital_pantry, now)
+            fingerprint = inputs_fingerprint(matrix, pantry, wastage_weight, pantry_change_weight, num_meals, constraints,
+                                             spend_weight)
+            params = planning_params(wastage_weight, pantry_change_weight, num_meals, constraints, spend_weight)
+            seed_rng = random.Random(seed)
+            results = []
+
+            def cookbook_plan(plan):
+                return list(plan) if recipe_ids is None else [int(recipe_ids[i]) for i in plan]
+
+            def progress(plan, cost):
+                if job.best_cost is None or cost < job.best_cost:
+                    job.update(best_cost=cost, best_recipes=[all_recipes[i]['name'] for i in cookbook_plan(plan)])
+
+            improvements = multiprocessing.Queue()
+            cancelled = multiprocessing.Event()
+            with ProcessPoolExecutor(max_workers=1, initializer=_init_job_worker,
+                                     initargs=(matrix, pantry, improvements, cancelled)) as executor:
+                for _ in range(job.num_plans):
+                    if job.cancelled:
+                        break
+                    run_seed = seed_rng.getrandbits(64)
+                    future = executor.submit(_run_job_search, run_seed, iterations, wastage_weight, pantry_change_weight,
+                                             num_meals, optimizer, time_limit, constraints, spend_weight)
+                    while not future.done():
+                        if job.cancelled:
+                            cancelled.set()
+                        try:
+                            progress(*improvements.get(timeout=POLL_SECONDS))
+                        except queue.Empty:
+                            pass
+                    plan, cost, name, stats = future.result()
+                    # improvements still in flight are no better than the run's result
+                    progress(plan, cost)
+                    results.append((cookbook_plan(plan), cost))
+                    record_search(name, stats)
+                    run = make_run_record(run_seed, fingerprint, iterations, time_limit, name, stats,
+                                          cookbook_plan(plan), cost, now, params)
+                    job.update(completed_plans=len(results), runs=job.runs + [run])
+
+            meal_plans = rank_meal_plans(all_recipes, digital_pantry, knowledge_bank, results, cache_versions)
+            if job.cancelled:
+                job.update(status=CANCELLED, meal_plans=meal_plans, **_best_of(meal_plans))
+                return
+            with self.lock:
+                self.results[job.key] = (meal_plans, job.runs, job.seed)
+                while len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
+            job.update(status=DONE, meal_plans=meal_plans, **_best_of(meal_plans))
+        except Exception as e:
+            job.update(status=FAILED, error=str(e))
+
+
+planning_jobs = JobManager()
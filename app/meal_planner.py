@@ -1,94 +1,118 @@
+import hashlib
 import json
-import copy
 import math
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 import random
 
+import numpy as np
 
 from app.models import Ingredient
+from app.units import registry as units, entry_units
+from app.cookbook_matrix import CookbookMatrix, NUTRITION_FIELDS
+from app.optimizers import OPTIMIZERS
+from app.constraints import constrained_matrix
+from app.purchasing import purchase_options, column_purchases, priced_purchase
+from app.metrics import metrics, record_search
 
 def standardize_units(name, quantity, unit):
-    # assume standard unit is 4 oz == 4 fl oz == 1 unit (of tomato, zucchini, lime, etc.)
-    if unit == 'unit':
-        return Ingredient(quantity, 'stan', name)
-    elif unit == 'oz':
-        return Ingredient(quantity/4, 'stan', name)
-    elif unit == 'lb':
-        return Ingredient(quantity*16/4, 'stan', name)
-    elif unit == 'cup':
-        return Ingredient(quantity*8/4, 'stan', name)
-    elif unit == 'tbsp':
-        return Ingredient(quantity/2/4, 'stan', name)
-    elif unit == 'tsp':
-        return Ingredient(quantity/6/4, 'stan', name)
-    elif unit == 'ml':
-        return Ingredient(quantity/30/4, 'stan', name)
-    elif unit == 'clove':
-        return Ingredient(quantity/10, 'stan', name)
-    else:
-        raise NotImplementedError(f'Unit {unit} for item {name} not converted!')
-
-def to_purchase_unit(quantity, purchase_unit):
-    if purchase_unit == 'unit':
-        return quantity
-    elif purchase_unit == 'oz':
-        return quantity*4
-    elif purchase_unit == 'lb':
-        return quantity*4/16
-    elif purchase_unit == 'cup':
-        return quantity*4/8
-    elif purchase_unit == 'tbsp':
-        return quantity*4*2
-    elif purchase_unit == 'tsp':
-        return quantity*4*6
-    elif purchase_unit == 'ml':
-        return quantity*4*30
-    elif purchase_unit == 'clove':
-        return quantity*10
-    else:
-        raise NotImplementedError(f'Unit {purchase_unit} not converted!')
+    return Ingredient(units.to_standard(name, quantity, unit), 'stan', name)
 
-def load_all_recipes(path):
+def to_purchase_unit(quantity, purchase_unit, name=None, unit_registry=units):
+    return unit_registry.from_standard(name, quantity, purchase_unit)
+
+def load_all_recipes(path, unit_registry=units):
+    # unit_registry should be the knowledge bank's (units.knowledge_bank_units), so recipes and
+    # pantry convert its overridden units alike
     with open(path, 'r') as f:
         recipes = json.load(f)
-    
+
+    # convert the whole cookbook's quantities as one column
+    items = [item for recipe in recipes for item in recipe['ingredients']]
+    names = [item['name'] for item in items]
+    quantities = unit_registry.to_standard_bulk(names, [item['quantity'] for item in items], [item['unit'] for item in items]).tolist()
+
+    start = 0
     for recipe in recipes:
-        ingredients = []
-        for item in recipe['ingredients']:
-            ingredients.append(standardize_units(item['name'], item['quantity'], item['unit']))
-        recipe['ingredients'] = ingredients
+        end = start + len(recipe['ingredients'])
+        recipe['ingredients'] = [Ingredient(quantity, 'stan', name)
+                                 for quantity, name in zip(quantities[start:end], names[start:end])]
+        start = end
     return recipes
 
-def load_digital_pantry(pantry_items):
+def load_digital_pantry(pantry_items, unit_registry=units):
     # Create a deep copy of the pantry items to manipulate separately from the database
     copied_pantry = {}
     for item in pantry_items:
-        ingredient = standardize_units(item.name, item.quantity, item.unit)
-        copied_pantry[item.name] = {'quantity': ingredient.quantity, 'unit': ingredient.unit, 'expiry_date': item.expiry_date}
+        quantity = unit_registry.to_standard(item.name, item.quantity, item.unit)
+        copied_pantry[item.name] = {'quantity': quantity, 'unit': 'stan', 'expiry_date': item.expiry_date}
         # copied_pantry.append(PantryItem(item.name, ingredient.quantity, ingredient.unit, item.expiry_date))
 
     return copied_pantry
 
+def pantry_fingerprint(digital_pantry):
+    # content hash of a digital pantry, for keying cached results on pantry state
+    entries = sorted((name, item['quantity'], item['expiry_date'].isoformat())
+                     for name, item in digital_pantry.items())
+    return hashlib.sha1(json.dumps(entries).encode('utf-8')).hexdigest()
+
 def load_knowledge_bank(path):
+    # per-ingredient unit overrides under 'conversions' are left to units.knowledge_bank_units
     with open(path, 'r') as f:
-        knowledge_bank = json.load(f)
+        return json.load(f)
+
+def build_cookbook_matrix(all_recipes, knowledge_bank):
+    names = sorted({ingredient.name for recipe in all_recipes for ingredient in recipe['ingredients']})
+    index = {name: i for i, name in enumerate(names)}
 
-    return knowledge_bank
+    offsets = [0]
+    columns = []
+    values = []
+    for recipe in all_recipes:
+        # a recipe may list the same ingredient more than once; each row holds it once
+        row = {}
+        for ingredient in recipe['ingredients']:
+            col = index[ingredient.name]
+            row[col] = row.get(col, 0) + ingredient.quantity
+        for col in sorted(row):
+            columns.append(col)
+            values.append(row[col])
+        offsets.append(len(columns))
+
+    nutrition = [[recipe.get(field) for field in NUTRITION_FIELDS] for recipe in all_recipes]
+    increment_quantity, purchase_factor, shelf_life = knowledge_bank_vectors(names, knowledge_bank)
+    return CookbookMatrix(names, np.array(offsets, dtype=np.int64), np.array(columns, dtype=np.int32),
+                          values, increment_quantity, purchase_factor, shelf_life,
+                          np.array(nutrition, dtype=np.float64).reshape(len(all_recipes), len(NUTRITION_FIELDS)),
+                          column_purchases(names, knowledge_bank))
 
-def generate_shopping_list(meal_plan, digital_pantry, knowledge_bank):
+def knowledge_bank_vectors(ingredient_names, knowledge_bank):
+    increments = [knowledge_bank[name]['increment'] for name in ingredient_names]
+    increment_quantity = [increment['quantity'] for increment in increments]
+    purchase_factor = [entry_units(name, knowledge_bank[name]).factor(name, increment['unit'])
+                       for name, increment in zip(ingredient_names, increments)]
+    shelf_life = [knowledge_bank[name]['shelf_life'] for name in ingredient_names]
+    return increment_quantity, purchase_factor, shelf_life
 
-    # aggregate the ingredients in the meal plan
+def generate_shopping_list(meal_plan, digital_pantry, knowledge_bank, now=None):
+    if now is None:
+        now = datetime.now()
+
+    # aggregate the ingredients in the meal plan, copying each recipe's entry once
     ingredients = {}
     for recipe in meal_plan:
         for ingredient in recipe['ingredients']:
-            if ingredient.name not in ingredients:
-                ingredients[ingredient.name] = ingredient
+            total = ingredients.get(ingredient.name)
+            if total is None:
+                ingredients[ingredient.name] = Ingredient(ingredient.quantity, ingredient.unit, ingredient.name)
             else:
-                ingredients[ingredient.name] = ingredients[ingredient.name] + ingredient
+                total.accumulate(ingredient)
 
-    # create shopping list and update pantry
+    # create shopping list and update pantry; entries hold only numbers and datetimes,
+    # so copying each entry is as good as a deep copy
     shopping_list = {}
-    new_pantry = copy.deepcopy(digital_pantry)
+    new_pantry = {name: dict(item) for name, item in digital_pantry.items()}
     for name in ingredients:
         if name in digital_pantry:
             purchase_amt = max(0, ingredients[name].quantity-digital_pantry[name]['quantity'])
@@ -102,20 +126,28 @@ def generate_shopping_list(meal_plan, digital_pantry, knowledge_bank):
             increment_unit = increment['unit']
             shelf_life = knowledge_bank[name]['shelf_life']
 
-            reqd_amt = to_purchase_unit(purchase_amt, increment_unit)
-            purchase_ct = int(math.ceil(round(reqd_amt / increment_quantity, 3)))
-            shopping_list[name] = {'count': purchase_ct, 'increment': increment}
+            options = purchase_options(name, knowledge_bank[name])
+            if options is None:
+                unit_registry = entry_units(name, knowledge_bank[name])
+                reqd_amt = to_purchase_unit(purchase_amt, increment_unit, name, unit_registry)
+                purchase_ct = int(math.ceil(round(reqd_amt / increment_quantity, 3)))
+                shopping_list[name] = {'count': purchase_ct, 'increment': increment}
+                remaining_amt = unit_registry.to_standard(name, max(0, purchase_ct*increment_quantity - reqd_amt), increment_unit)
+            else:
+                # the cheapest mix of the package sizes on offer
+                shopping_list[name], bought = priced_purchase(options, purchase_amt, increment)
+                remaining_amt = max(0, bought - purchase_amt)
 
-            remaining_amt = standardize_units(name, max(0, purchase_ct*increment_quantity - reqd_amt), increment_unit).quantity
-            new_pantry[name] = {'quantity': remaining_amt, 'unit': 'stan', 'expiry_date': datetime.now() + timedelta(7*shelf_life)}
+            new_pantry[name] = {'quantity': remaining_amt, 'unit': 'stan', 'expiry_date': now + timedelta(7*shelf_life)}
     
     return shopping_list, new_pantry
 
-def calculate_wastage_cost(new_pantry):
+def calculate_wastage_cost(new_pantry, now=None):
 
     # calculate how much food goes to waste in the pantry over the next two weeks
     wastage = 0
-    now = datetime.now()
+    if now is None:
+        now = datetime.now()
     for name in new_pantry:
         if (new_pantry[name]['expiry_date'] - now).days < 15 and new_pantry[name]['quantity'] > 0:
             wastage += new_pantry[name]['quantity']
@@ -132,11 +164,15 @@ def calculate_pantry_change_cost(old_pantry, new_pantry):
     
     return (final_mass - initial_mass)
 
-def calculate_cost(digital_pantry, new_pantry, wastage_weight, pantry_change_weight):
+def shopping_spend(shopping_list):
+    # what a shopping list costs, counting only the ingredients with known prices
+    return sum(item.get('price', 0) for item in shopping_list.values())
+
+def calculate_cost(digital_pantry, new_pantry, wastage_weight, pantry_change_weight, now=None, spend=0, spend_weight=0):
     
-    wastage_cost = calculate_wastage_cost(new_pantry)
+    wastage_cost = calculate_wastage_cost(new_pantry, now)
     pantry_change_cost = calculate_pantry_change_cost(digital_pantry, new_pantry)
-    total_cost = (wastage_weight * wastage_cost) + (pantry_change_weight * pantry_change_cost)
+    total_cost = (wastage_weight * wastage_cost) + (pantry_change_weight * pantry_change_cost) + (spend_weight * spend)
     return total_cost
 
 def prune_pantry(future_pantry):
@@ -148,36 +184,198 @@ def prune_pantry(future_pantry):
 
     return pruned_pantry
 
-def generate_meal_plan(all_recipes, digital_pantry, knowledge_bank, iterations, wastage_weight, pantry_change_weight, num_meals=6):
-
-    all_recipe_dict = {recipe['name']: recipe for recipe in all_recipes}
+def get_optimizer(optimizer='hill_climb', iterations=100, time_limit=None):
+    # accepts a backend name from OPTIMIZERS or an already configured Optimizer
+    if isinstance(optimizer, str):
+        if optimizer not in OPTIMIZERS:
+            raise ValueError(f'Unknown optimizer {optimizer}, expected one of {sorted(OPTIMIZERS)}')
+        return OPTIMIZERS[optimizer](iterations, time_limit)
+    return optimizer
 
-    # current_plan = random.sample(all_recipes, num_meals)[:]
-    current_plan = random.sample(range(len(all_recipes)), num_meals)[:]
-    current_shopping_list, current_pantry = generate_shopping_list([all_recipes[i] for i in current_plan], digital_pantry, knowledge_bank)
-    current_cost = calculate_cost(digital_pantry, current_pantry, wastage_weight, pantry_change_weight)
+def optimize_meal_plan(matrix, pantry, iterations, wastage_weight, pantry_change_weight, num_meals=6, rng=None, optimizer='hill_climb', time_limit=None, constraints=None, spend_weight=0):
+    # rng is a random.Random owned by this run; never the shared module-level generator
+    if rng is None:
+        rng = random.Random()
+    optimizer = get_optimizer(optimizer, iterations, time_limit)
+    current_plan, _ = optimizer.optimize(matrix, pantry, wastage_weight, pantry_change_weight, num_meals, rng, constraints,
+                                         spend_weight)
 
-    for _ in range(iterations):
-        # the following swap does not allow repeats
-        new_plan = current_plan[:]
-        idx = random.randint(0, 5)
-        all_recipes_copy = set(range(len(all_recipes))).difference(set(new_plan))
+    # rescore from scratch so incremental rounding never reaches the caller
+    current_cost = matrix.calculate_cost(current_plan, pantry, wastage_weight, pantry_change_weight, spend_weight)
+    return current_plan, current_cost
 
-        new_plan[idx] = random.choice(list(all_recipes_copy))
+def planning_params(wastage_weight, pantry_change_weight, num_meals, constraints, spend_weight=0):
+    # the settings a RunRecord needs to be replayed, in JSON-friendly form
+    return {'wastage_weight': wastage_weight, 'pantry_change_weight': pantry_change_weight, 'spend_weight': spend_weight,
+            'num_meals': num_meals, 'constraints': constraints.to_dict() if constraints else {}}
 
-        # the following swap allows repeats
-        # new_plan = current_plan[:]
-        # new_plan[random.randint(0, num_meals-1)] = random.choice(all_recipes)
-        new_shopping_list, new_pantry = generate_shopping_list([all_recipes[i] for i in new_plan], digital_pantry, knowledge_bank)
+def make_run_record(seed, fingerprint, iterations, time_limit, optimizer_name, stats, plan, cost, now, params):
+    from app.runs import RunRecord
+    # under a time limit, a search whose schedule reads the clock can't be followed exactly
+    reproducible = time_limit is None or not getattr(OPTIMIZERS.get(optimizer_name), 'uses_clock', True)
+    return RunRecord(seed, fingerprint, optimizer_name, iterations, time_limit, stats['evaluations'], plan, cost,
+                     stats['trajectory'], stats['seconds'], now, params, reproducible)
 
-        new_cost = calculate_cost(digital_pantry, new_pantry, wastage_weight, pantry_change_weight)
+def generate_meal_plan(all_recipes, digital_pantry, knowledge_bank, iterations, wastage_weight, pantry_change_weight, num_meals=6, matrix=None, rng=None, optimizer='hill_climb', time_limit=None, constraints=None, seed=None, now=None, records=None, spend_weight=0):
+    from app.runs import inputs_fingerprint
 
-        # If the new plan has a lower cost, accept the swap
-        if new_cost < current_cost:
-            current_plan = new_plan
-            current_cost = new_cost
-            current_shopping_list = new_shopping_list
-            current_pantry = new_pantry
+    if matrix is None:
+        matrix = build_cookbook_matrix(all_recipes, knowledge_bank)
+    # a caller-supplied rng can't be reseeded, so its runs are recorded as not reproducible
+    seeded = rng is None
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+    if rng is None:
+        rng = random.Random(seed)
+    if now is None:
+        now = datetime.now()
+    # with constraints the search only ever sees the recipes that can take part in a valid plan
+    matrix, recipe_ids = constrained_matrix(matrix, constraints, num_meals)
+    pantry = matrix.pantry_vectors(digital_pantry, now)
+    optimizer = get_optimizer(optimizer, iterations, time_limit)
+    current_plan, current_cost = optimize_meal_plan(matrix, pantry, iterations, wastage_weight,
+                                                    pantry_change_weight, num_meals, rng,
+                                                    optimizer, time_limit, constraints, spend_weight)
+    if recipe_ids is not None:
+        current_plan = [int(recipe_ids[i]) for i in current_plan]
+    if records is not None:
+        fingerprint = inputs_fingerprint(matrix, pantry, wastage_weight, pantry_change_weight, num_meals, constraints,
+                                         spend_weight)
+        record = make_run_record(seed if seeded else None, fingerprint, iterations, time_limit, optimizer.name,
+                                 optimizer.stats, current_plan, current_cost, now,
+                                 planning_params(wastage_weight, pantry_change_weight, num_meals, constraints, spend_weight))
+        record.reproducible = record.reproducible and seeded
+        records.append(record)
 
+    # only the winning plan needs the full shopping list and pantry dicts
+    plan = [all_recipes[i] for i in current_plan]
+    current_shopping_list, current_pantry = generate_shopping_list(plan, digital_pantry, knowledge_bank)
     current_pantry = prune_pantry(current_pantry)
-    return [all_recipes[i] for i in current_plan], round(current_cost,1), current_shopping_list, current_pantry
+    return plan, round(current_cost,1), current_shopping_list, current_pantry
+
+def _run_plan(matrix, pantry, seed, iterations, wastage_weight, pantry_change_weight, num_meals, optimizer, time_limit, constraints, spend_weight):
+    # the search stats travel back with the plan, since metrics recorded in a worker would stay there
+    optimizer = get_optimizer(optimizer, iterations, time_limit)
+    plan, cost = optimize_meal_plan(matrix, pantry, iterations, wastage_weight, pantry_change_weight, num_meals,
+                                    random.Random(seed), optimizer, time_limit, constraints, spend_weight)
+    return plan, cost, optimizer.name, optimizer.stats
+
+# state shared with each pool worker once, by the initializer, instead of pickled per task. Only
+# ever set in a pool worker's own process; planning on the calling thread passes the matrix and
+# pantry along instead, since requests and the scheduler plan concurrently
+_worker_state = {}
+
+def _init_plan_worker(matrix, pantry):
+    _worker_state['matrix'] = matrix
+    _worker_state['pantry'] = pantry
+
+def _run_plan_worker(seed, *task_args):
+    return _run_plan(_worker_state['matrix'], _worker_state['pantry'], seed, *task_args)
+
+def generate_meal_plans(all_recipes, digital_pantry, knowledge_bank, iterations, wastage_weight, pantry_change_weight, num_plans=5, num_meals=6, matrix=None, processes=None, seed=None, optimizer='hill_climb', time_limit=None, cache_versions=None, constraints=None, now=None, records=None, spend_weight=0, isolate=False):
+    # `records`, if given, receives a RunRecord per restart, in seed order. With `isolate` the
+    # searches run in a worker process even when there's only one, off the caller's GIL
+    from app.runs import inputs_fingerprint, run_cache, run_key
+
+    if matrix is None:
+        matrix = build_cookbook_matrix(all_recipes, knowledge_bank)
+    if now is None:
+        now = datetime.now()
+    with metrics.timer('chef_phase_seconds', phase='feasible_recipes'):
+        matrix, recipe_ids = constrained_matrix(matrix, constraints, num_meals)
+    with metrics.timer('chef_phase_seconds', phase='pantry_vectors'):
+        pantry = matrix.pantry_vectors(digital_pantry, now)
+    fingerprint = inputs_fingerprint(matrix, pantry, wastage_weight, pantry_change_weight, num_meals, constraints, spend_weight)
+    params = planning_params(wastage_weight, pantry_change_weight, num_meals, constraints, spend_weight)
+
+    # every restart gets its own seeded generator, so runs never share RNG state
+    seed_rng = random.Random(seed)
+    seeds = [seed_rng.getrandbits(64) for _ in range(num_plans)]
+    task_args = (iterations, wastage_weight, pantry_change_weight, num_meals, optimizer, time_limit, constraints, spend_weight)
+
+    # without a time limit a run is a pure function of its seed and inputs, so it only runs once
+    cacheable = time_limit is None and isinstance(optimizer, str)
+    run_records = {}
+    if cacheable:
+        for run_seed in seeds:
+            record = run_cache.get(run_key(fingerprint, run_seed, optimizer, iterations))
+            if record is not None:
+                run_records[run_seed] = record
+    pending = [run_seed for run_seed in seeds if run_seed not in run_records]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(pending))
+
+    if pending and (processes > 1 or isolate):
+        with ProcessPoolExecutor(max_workers=max(processes, 1), initializer=_init_plan_worker,
+                                 initargs=(matrix, pantry)) as executor:
+            results = list(executor.map(_run_plan_worker, pending, *[[arg] * len(pending) for arg in task_args]))
+    else:
+        results = [_run_plan(matrix, pantry, run_seed, *task_args) for run_seed in pending]
+
+    for run_seed, (plan, cost, name, stats) in zip(pending, results):
+        record_search(name, stats)
+        if recipe_ids is not None:
+            plan = [int(recipe_ids[i]) for i in plan]
+        record = make_run_record(run_seed, fingerprint, iterations, time_limit, name, stats, plan, cost, now, params)
+        run_records[run_seed] = record
+        if cacheable:
+            run_cache.put(run_key(fingerprint, run_seed, optimizer, iterations), record)
+    if records is not None:
+        records.extend(run_records[run_seed] for run_seed in seeds)
+    results = [(run_records[run_seed].plan, run_records[run_seed].cost) for run_seed in seeds]
+    with metrics.timer('chef_phase_seconds', phase='shopping_lists'):
+        return rank_meal_plans(all_recipes, digital_pantry, knowledge_bank, results, cache_versions)
+
+def replay_meal_plan(record, all_recipes, digital_pantry, knowledge_bank, matrix=None):
+    # rerun a RunRecord from its seed, stopping at the evaluation it stopped at, and return the
+    # new run's record; raises ValueError if the inputs no longer match the recorded fingerprint
+    from app.constraints import constraints_from_params
+    from app.runs import inputs_fingerprint
+
+    if record.seed is None:
+        raise ValueError('This run used a generator it was handed rather than a seed, so it cannot be replayed')
+    if matrix is None:
+        matrix = build_cookbook_matrix(all_recipes, knowledge_bank)
+    params = record.params
+    wastage_weight, pantry_change_weight, num_meals = params['wastage_weight'], params['pantry_change_weight'], params['num_meals']
+    spend_weight = params.get('spend_weight', 0)
+    constraints = constraints_from_params(params['constraints'])
+    matrix, recipe_ids = constrained_matrix(matrix, constraints, num_meals)
+    pantry = matrix.pantry_vectors(digital_pantry, record.now)
+    fingerprint = inputs_fingerprint(matrix, pantry, wastage_weight, pantry_change_weight, num_meals, constraints, spend_weight)
+    if fingerprint != record.fingerprint:
+        raise ValueError('The cookbook, pantry or settings have changed since this run, so it cannot be replayed')
+
+    optimizer = get_optimizer(record.optimizer, record.iterations)
+    optimizer.stop_after = record.evaluations
+    plan, cost = optimize_meal_plan(matrix, pantry, record.iterations, wastage_weight, pantry_change_weight, num_meals,
+                                    random.Random(record.seed), optimizer, None, constraints, spend_weight)
+    if recipe_ids is not None:
+        plan = [int(recipe_ids[i]) for i in plan]
+    return make_run_record(record.seed, fingerprint, record.iterations, record.time_limit, optimizer.name, optimizer.stats,
+                           plan, cost, record.now, params)
+
+def distinct_plans(results):
+    # restarts often converge on the same recipes; keep each plan once, cheapest first
+    unique_plans = {}
+    for plan, cost in results:
+        key = tuple(sorted(plan))
+        if key not in unique_plans or cost < unique_plans[key][1]:
+            unique_plans[key] = (plan, cost)
+    return sorted(unique_plans.values(), key=lambda result: result[1])
+
+def rank_meal_plans(all_recipes, digital_pantry, knowledge_bank, results, cache_versions=None):
+    meal_plans = []
+    for plan, cost in distinct_plans(results):
+        recipes = [all_recipes[i] for i in plan]
+        if cache_versions is None:
+            shopping_list, new_pantry = generate_shopping_list(recipes, digital_pantry, knowledge_bank)
+        else:
+            # (pantry version, cookbook version): reuse shopping lists other requests already built
+            from app.plan_cache import cached_shopping_list
+            shopping_list, new_pantry = cached_shopping_list(plan, all_recipes, digital_pantry, knowledge_bank,
+                                                             *cache_versions)
+        meal_plans.append((recipes, round(cost,1), shopping_list, prune_pantry(new_pantry)))
+    return meal_plans
@@ -0,0 +1,229 @@
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+# seconds; request and phase timers share these
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COST_BUCKETS = (0, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, TIME_BUCKETS, **self.labels)
+        return False
+
+
+class Metrics:
+    # process-wide counters and histograms, rendered in the Prometheus text format. When disabled
+    # every call returns straight away, so instrumented code can stay in place in production.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        # with metrics.timer('chef_phase_seconds', phase='render'): ...
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self, samples=()):
+        # `samples` adds point-in-time values as (name, type, labels, value), e.g. cache sizes
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            for (name, labels), value in counters:
+                header(name, 'counter')
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+            for (name, labels), histogram in histograms:
+                header(name, 'histogram')
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else _number(bound)
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(histogram.sum)}')
+                lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+        for name, kind, labels, value in samples:
+            header(name, kind)
+            lines.append(f'{name}{_labels(tuple(sorted(labels.items())))} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+# on unless CHEF_METRICS=0
+metrics = Metrics(enabled=os.environ.get('CHEF_METRICS', '1') != '0')
+metrics.describe('chef_request_seconds', 'Time spent handling a request, by endpoint.')
+metrics.describe('chef_phase_seconds', 'Time spent in each phase of request handling and planning.')
+metrics.describe('chef_planner_runs_total', 'Optimizer runs (restarts) completed.')
+metrics.describe('chef_planner_evaluations_total', 'Plans scored by the optimizers.')
+metrics.describe('chef_planner_accepted_swaps_total', 'Swaps the optimizers accepted.')
+metrics.describe('chef_planner_improvements_total', 'Times an optimizer found a new best plan.')
+metrics.describe('chef_planner_initial_cost', 'Cost of the random plan each run starts from.')
+metrics.describe('chef_planner_final_cost', 'Cost of the plan each run returns.')
+metrics.describe('chef_startup_seconds', 'Time spent starting up: importing routes, preparing the database and preloading.')
+metrics.describe('chef_pantry_snapshot_loads_total', 'Pantry snapshots built by reading every row of a household.')
+metrics.describe('chef_pantry_snapshot_events_total', 'Pantry change events applied to existing snapshots.')
+metrics.describe('chef_expiry_alerts_builds_total', 'Expiry alerts rebuilt after the pantry, cookbook or date moved on.')
+metrics.describe('chef_scheduler_seconds', 'Time spent running each scheduled background task.')
+metrics.describe('chef_scheduler_runs_total', 'Scheduled background task runs that completed.')
+metrics.describe('chef_scheduler_errors_total', 'Scheduled background task runs that raised.')
+
+def record_search(optimizer, stats):
+    # stats as left on an Optimizer by its last run; may come back from a worker process
+    if not metrics.enabled:
+        return
+    metrics.increment('chef_planner_runs_total', optimizer=optimizer)
+    metrics.increment('chef_planner_evaluations_total', stats['evaluations'], optimizer=optimizer)
+    metrics.increment('chef_planner_accepted_swaps_total', stats['accepted'], optimizer=optimizer)
+    metrics.increment('chef_planner_improvements_total', len(stats['trajectory']), optimizer=optimizer)
+    metrics.observe('chef_planner_initial_cost', stats['initial_cost'], COST_BUCKETS, optimizer=optimizer)
+    metrics.observe('chef_planner_final_cost', stats['final_cost'], COST_BUCKETS, optimizer=optimizer)
+    metrics.observe('chef_phase_seconds', stats['seconds'], phase='optimize')
+
+
+def collapsed_stacks(profile):
+    # caller;callee edges weighted by inclusive microseconds, in the "collapsed" text format that
+    # flamegraph.pl and speedscope read. cProfile keeps one level of callers, so these are
+    # two-frame stacks rather than full ones.
+    stats = pstats.Stats(profile).stats
+    lines = []
+    for (filename, line, function), (_, _, _, _, callers) in stats.items():
+        callee = f'{function} ({os.path.basename(filename)}:{line})'
+        for (caller_file, caller_line, caller_function), caller_stats in callers.items():
+            caller = f'{caller_function} ({os.path.basename(caller_file)}:{caller_line})'
+            microseconds = int(caller_stats[3] * 1e6)
+            if microseconds:
+                lines.append(f'{caller};{callee} {microseconds}')
+    return '\n'.join(sorted(lines)) + '\n'
+
+def instrument_app(app):
+    # request timing for every endpoint, plus opt-in profiling: with PROFILING set, a request
+    # carrying ?profile=1 writes <endpoint>-<time>.prof (pstats) and .folded (flame graph input)
+    # to PROFILE_DIR, and ?profile=text returns the top of the profile instead of the page
+    from flask import g, request
+
+    app.config.setdefault('PROFILING', os.environ.get('CHEF_PROFILE') == '1')
+    app.config.setdefault('PROFILE_DIR', os.environ.get('CHEF_PROFILE_DIR', tempfile.gettempdir()))
+
+    @app.before_request
+    def _start_request():
+        g.request_start = time.perf_counter()
+        if app.config['PROFILING'] and request.args.get('profile'):
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    @app.after_request
+    def _finish_request(response):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+            response = _profile_response(app, profile, response)
+        start = g.pop('request_start', None)
+        if start is not None:
+            metrics.observe('chef_request_seconds', time.perf_counter() - start,
+                            endpoint=request.endpoint or 'unknown', status=response.status_code)
+        return response
+
+def _profile_response(app, profile, response):
+    from flask import request
+
+    if request.args.get('profile') == 'text':
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(60)
+        return app.response_class(report.getvalue(), mimetype='text/plain')
+
+    base = os.path.join(app.config['PROFILE_DIR'], f"{request.endpoint or 'request'}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+    profile.dump_stats(f'{base}.prof')
+    with open(f'{base}.folded', 'w') as f:
+        f.write(collapsed_stacks(profile))
+    response.headers['X-Profile'] = f'{base}.prof'
+    return response
@@ -1,23 +1,109 @@
 from app import db
 from datetime import datetime
+from sqlalchemy import inspect, text
+
+# pantries created before households existed belong to this one
+DEFAULT_HOUSEHOLD_ID = 1
+DEFAULT_HOUSEHOLD_NAME = 'default'
+
+class Household(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    # the version of the household's latest PantryEvent; see pantry_events.record_events
+    pantry_version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<Household {self.name}>"
 
 class PantryItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'), nullable=False, default=DEFAULT_HOUSEHOLD_ID)
+    # not unique: the same ingredient can be stocked in batches with different expiry dates
+    name = db.Column(db.String(100), nullable=False, index=True)
     quantity = db.Column(db.Float, nullable=False)
     unit = db.Column(db.String(50))
-    expiry_date = db.Column(db.DateTime, default=datetime.max)
+    expiry_date = db.Column(db.DateTime, default=datetime.max, index=True)
 
-    def __init__(self, name, quantity, unit, expiry_date=datetime.max):
+    # every pantry query is scoped to one household
+    __table_args__ = (
+        db.Index('ix_pantry_item_household_name', 'household_id', 'name'),
+        db.Index('ix_pantry_item_household_expiry_date', 'household_id', 'expiry_date'),
+    )
+
+    def __init__(self, name, quantity, unit, expiry_date=datetime.max, household_id=DEFAULT_HOUSEHOLD_ID):
         self.name = name
         self.quantity = quantity
         self.unit = unit
         self.expiry_date = expiry_date
+        self.household_id = household_id
     
     def __repr__(self):
         return f"<PantryItem {self.name}>"
 
+class StagedPlan(db.Model):
+    # at most one staged plan per household; `version` moves on every restage and execution,
+    # so executing is a compare-and-set against the version that was read
+    id = db.Column(db.Integer, primary_key=True)
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'), nullable=False, unique=True)
+    recipes = db.Column(db.JSON, nullable=False)
+    executed = db.Column(db.Boolean, nullable=False, default=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    staged_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def __repr__(self):
+        return f"<StagedPlan {self.household_id} v{self.version}>"
+
+class PantryEvent(db.Model):
+    # append-only log of pantry changes, written in the same transaction as the change itself.
+    # Each household numbers its events 1, 2, 3, ... in commit order; ids only order them within
+    # a transaction, as other households' writers may commit ids out of order.
+    id = db.Column(db.Integer, primary_key=True)
+    household_id = db.Column(db.Integer, db.ForeignKey('household.id'), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    # 'add', 'update' or 'remove'; add and update carry the row as it now is
+    kind = db.Column(db.String(10), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(100))
+    quantity = db.Column(db.Float)
+    unit = db.Column(db.String(50))
+    expiry_date = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    # autoincrement so ids are never reused, even if the log is trimmed
+    __table_args__ = (
+        db.Index('ix_pantry_event_household_version', 'household_id', 'version', unique=True),
+        {'sqlite_autoincrement': True},
+    )
+
+    def __repr__(self):
+        return f"<PantryEvent {self.household_id} v{self.version} {self.kind} {self.name}>"
+
+def upgrade_schema(engine):
+    # create_all only creates missing tables; bring older pantry databases up to date
+    columns = {column['name'] for column in inspect(engine).get_columns('pantry_item')}
+    with engine.begin() as connection:
+        if 'household_id' not in columns:
+            connection.execute(text(f'ALTER TABLE pantry_item ADD COLUMN household_id INTEGER NOT NULL '
+                                    f'DEFAULT {DEFAULT_HOUSEHOLD_ID} REFERENCES household (id)'))
+        for index in PantryItem.__table__.indexes:
+            index.create(connection, checkfirst=True)
+        # event logs from before per-household versions were written by one SQLite writer at a
+        # time, so their ids are already in commit order
+        if 'version' not in {column['name'] for column in inspect(connection).get_columns('pantry_event')}:
+            connection.execute(text('ALTER TABLE pantry_event ADD COLUMN version INTEGER NOT NULL DEFAULT 0'))
+            connection.execute(text('UPDATE pantry_event SET version = id'))
+        if 'pantry_version' not in {column['name'] for column in inspect(connection).get_columns('household')}:
+            connection.execute(text('ALTER TABLE household ADD COLUMN pantry_version INTEGER NOT NULL DEFAULT 0'))
+            connection.execute(text('UPDATE household SET pantry_version = COALESCE((SELECT MAX(version) FROM pantry_event '
+                                    'WHERE pantry_event.household_id = household.id), 0)'))
+        for index in PantryEvent.__table__.indexes:
+            index.create(connection, checkfirst=True)
+        if connection.execute(text('SELECT 1 FROM household WHERE id = :id'), {'id': DEFAULT_HOUSEHOLD_ID}).first() is None:
+            connection.execute(Household.__table__.insert().values(id=DEFAULT_HOUSEHOLD_ID, name=DEFAULT_HOUSEHOLD_NAME))
+
 class Ingredient:
+    __slots__ = ('quantity', 'unit', 'name')
+
     def __init__(self, quantity, unit, name):
         self.quantity = quantity
         self.unit = unit
@@ -30,6 +116,13 @@ class Ingredient:
     def __radd__(self, other):
         if other.unit == self.unit:
             return Ingredient(self.quantity + other.quantity, self.unit, self.name)
+
+    def accumulate(self, other):
+        # in-place add, for aggregating without a new Ingredient per step
+        if other.unit != self.unit:
+            raise ValueError(f'Cannot add {other.unit} of {other.name} to {self.unit} of {self.name}')
+        self.quantity += other.quantity
+        return self
     
     def __repr__(self):
         return f"<Ingredient {self.name} - {self.quantity} {self.unit}>"
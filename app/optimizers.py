@@ -0,0 +1,360 @@
+import math
+import time
+from collections import deque
+
+import numpy as np
+
+from app.cookbook_matrix import PlanEvaluator
+
+# sampled proposals a search rejects in a row before listing the swaps it may make instead;
+# tight nutrition limits can leave few of them, or none
+PROPOSAL_ATTEMPTS = 64
+
+
+class Budget:
+    # stops a search after a number of plan evaluations and/or a wall-clock limit in seconds.
+    # stop_after ends it at an evaluation count without changing what `iterations` means to a
+    # temperature schedule, which is how a recorded run is replayed to the point it stopped.
+    def __init__(self, iterations=None, time_limit=None, stop_after=None):
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.stop_after = stop_after
+        self.used = 0
+        self.start = time.perf_counter()
+        self.stopped = False
+        self._next_clock_check = 0
+
+    def spend(self, evaluations=1):
+        self.used += evaluations
+
+    def stop(self):
+        self.stopped = True
+
+    def exhausted(self):
+        if self.stopped:
+            return True
+        if self.iterations is not None and self.used >= self.iterations:
+            return True
+        if self.stop_after is not None and self.used >= self.stop_after:
+            return True
+        # reading the clock is cheap, but not free; check it every 32 evaluations
+        if self.time_limit is not None and self.used >= self._next_clock_check:
+            self._next_clock_check = self.used + 32
+            return time.perf_counter() - self.start >= self.time_limit
+        return False
+
+    def fraction(self):
+        # how far through the budget the search is, for temperature schedules
+        fractions = []
+        if self.iterations:
+            fractions.append(self.used / self.iterations)
+        if self.time_limit:
+            fractions.append((time.perf_counter() - self.start) / self.time_limit)
+        return min(max(fractions, default=0.0), 1.0)
+
+
+class AliasSampler:
+    # draws from a fixed discrete distribution in O(1) per sample (Vose's alias method)
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        scaled = (weights * n / weights.sum()).tolist()
+        self.size = n
+        self.probability = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, weight in enumerate(scaled) if weight < 1]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        # whatever is left is 1 up to rounding
+
+    def sample(self, rng):
+        # one uniform draw picks both the column and the coin flip within it
+        u = rng.random() * self.size
+        i = int(u)
+        return i if u - i < self.probability[i] else self.alias[i]
+
+def candidate_sampler(matrix, pantry):
+    if pantry.candidates is None:
+        pantry.candidates = AliasSampler(matrix.candidate_weights(pantry))
+    return pantry.candidates
+
+
+class Optimizer:
+    # a search strategy over plans of distinct recipe indices, scored by a shared PlanEvaluator;
+    # iterations counts plan evaluations so backends are compared on equal work
+    name = None
+    # whether the search path under a time limit depends on the clock rather than only on the
+    # rng and the evaluation count, in which case a replay can't follow it exactly
+    uses_clock = False
+
+    def __init__(self, iterations=100, time_limit=None):
+        self.iterations = iterations
+        self.time_limit = time_limit
+        # see Budget.stop_after
+        self.stop_after = None
+        # called as callback(plan, cost, evaluations) on every new best plan; a truthy
+        # return value stops the search
+        self.callback = None
+        # counters from the last optimize() call, see metrics.record_search
+        self.stats = None
+        self.trajectory = []
+        # the running search's Budget, so another thread can stop() it
+        self.budget = None
+
+    def optimize(self, matrix, pantry, wastage_weight, pantry_change_weight, num_meals, rng, constraints=None, spend_weight=0):
+        # `matrix` should already hold only recipes that pass the constraints' recipe-level limits
+        # (see constraints.constrained_matrix); the plan totals are kept in range swap by swap
+        evaluator = PlanEvaluator(matrix, pantry, wastage_weight, pantry_change_weight,
+                                  rng.sample(range(matrix.num_recipes), num_meals), constraints, spend_weight)
+        if not evaluator.repair():
+            raise ValueError('Could not find a meal plan within the nutrition limits')
+        if matrix.num_recipes <= num_meals:
+            self.run(evaluator, num_meals, rng, search=False)
+            return evaluator.plan, evaluator.cost
+        return self.run(evaluator, num_meals, rng)
+
+    def run(self, evaluator, num_meals, rng, search=True):
+        # search from the evaluator's current plan under this optimizer's budget, recording stats
+        budget = self.budget = Budget(self.iterations, self.time_limit, self.stop_after)
+        initial_cost = evaluator.cost
+        self.trajectory = []
+        if search:
+            plan, cost = self.search(evaluator, num_meals, budget, rng)
+        else:
+            plan, cost = evaluator.plan, evaluator.cost
+        self.stats = {
+            'evaluations': budget.used,
+            'accepted': evaluator.accepted,
+            'initial_cost': initial_cost,
+            'final_cost': cost,
+            # (evaluations so far, cost) at each new best plan
+            'trajectory': self.trajectory,
+            'seconds': time.perf_counter() - budget.start,
+        }
+        return plan, cost
+
+    def search(self, evaluator, num_meals, budget, rng):
+        raise NotImplementedError
+
+    def improved(self, plan, cost, budget):
+        self.trajectory.append((budget.used, cost))
+        if self.callback is not None and self.callback(list(plan), cost, budget.used):
+            budget.stop()
+
+    def propose(self, evaluator, num_meals, rng):
+        # a random slot and a recipe the evaluator allows there, favouring recipes that use up
+        # expiring stock; rejection instead of set rebuilds keeps this O(1) per proposal. When
+        # rejection keeps failing, one of the allowed swaps, uniformly, or None if there are none.
+        candidates = candidate_sampler(evaluator.matrix, evaluator.pantry)
+        num_slots = len(evaluator.plan)
+        for _ in range(PROPOSAL_ATTEMPTS):
+            recipe = candidates.sample(rng)
+            slot = rng.randrange(num_slots)
+            if evaluator.allows(slot, recipe):
+                return slot, recipe
+        slots, recipes = evaluator.allowed_swaps()
+        if not len(slots):
+            return None
+        i = rng.randrange(len(slots))
+        return int(slots[i]), int(recipes[i])
+
+
+class HillClimbing(Optimizer):
+    # accept only strictly improving swaps
+    name = 'hill_climb'
+
+    def search(self, evaluator, num_meals, budget, rng):
+        while not budget.exhausted():
+            move = self.propose(evaluator, num_meals, rng)
+            if move is None:
+                # the plan is the only one within its limits that a swap can reach
+                break
+            slot, recipe = move
+            new_cost = evaluator.try_swap(slot, recipe)
+            budget.spend()
+            if new_cost < evaluator.cost:
+                evaluator.accept()
+                self.improved(evaluator.plan, evaluator.cost, budget)
+        return evaluator.plan, evaluator.cost
+
+
+class SimulatedAnnealing(Optimizer):
+    # accept worse swaps with probability exp(-delta / T), cooling geometrically over the budget
+    name = 'annealing'
+    uses_clock = True
+
+    def __init__(self, iterations=100, time_limit=None, start_temperature=None, end_temperature=1e-3):
+        super().__init__(iterations, time_limit)
+        self.start_temperature = start_temperature
+        self.end_temperature = end_temperature
+
+    def calibrate(self, evaluator, num_meals, budget, rng, samples=20):
+        # pick a start temperature at which a typical uphill swap is accepted half the time
+        deltas = []
+        for _ in range(samples):
+            move = self.propose(evaluator, num_meals, rng)
+            if move is None:
+                return self.end_temperature
+            deltas.append(abs(evaluator.try_swap(*move) - evaluator.cost))
+            budget.spend()
+        return max(np.mean(deltas) / math.log(2), self.end_temperature)
+
+    def search(self, evaluator, num_meals, budget, rng):
+        start_temperature = self.start_temperature
+        if start_temperature is None:
+            start_temperature = self.calibrate(evaluator, num_meals, budget, rng)
+        ratio = self.end_temperature / start_temperature
+
+        best_plan, best_cost = evaluator.plan[:], evaluator.cost
+        while not budget.exhausted():
+            temperature = start_temperature * ratio ** budget.fraction()
+            move = self.propose(evaluator, num_meals, rng)
+            if move is None:
+                break
+            slot, recipe = move
+            delta = evaluator.try_swap(slot, recipe) - evaluator.cost
+            budget.spend()
+            if delta < 0 or rng.random() < math.exp(-delta / temperature):
+                evaluator.accept()
+                if evaluator.cost < best_cost:
+                    best_plan, best_cost = evaluator.plan[:], evaluator.cost
+                    self.improved(best_plan, best_cost, budget)
+        return best_plan, best_cost
+
+
+class TabuSearch(Optimizer):
+    # move to the best of a sampled neighbourhood every step, even uphill, while recipes that
+    # were recently swapped out may not come back unless that beats the best plan found
+    name = 'tabu'
+
+    def __init__(self, iterations=100, time_limit=None, neighbourhood=16, tenure=8):
+        super().__init__(iterations, time_limit)
+        self.neighbourhood = neighbourhood
+        self.tenure = tenure
+
+    def search(self, evaluator, num_meals, budget, rng):
+        recent = deque(maxlen=self.tenure)
+        best_plan, best_cost = evaluator.plan[:], evaluator.cost
+        while not budget.exhausted():
+            move = None
+            for _ in range(self.neighbourhood):
+                proposal = self.propose(evaluator, num_meals, rng)
+                if proposal is None:
+                    return best_plan, best_cost
+                slot, recipe = proposal
+                new_cost = evaluator.try_swap(slot, recipe)
+                budget.spend()
+                if not (recipe in recent and new_cost >= best_cost) and (move is None or new_cost < move[1]):
+                    # the scored swap is kept, so taking it costs no second evaluation
+                    move = (slot, new_cost, evaluator.pending_swap)
+                if budget.exhausted():
+                    break
+            if move is None:
+                continue
+
+            slot, _, swap = move
+            recent.append(evaluator.plan[slot])
+            evaluator.accept(swap)
+            if evaluator.cost < best_cost:
+                best_plan, best_cost = evaluator.plan[:], evaluator.cost
+                self.improved(best_plan, best_cost, budget)
+        return best_plan, best_cost
+
+
+class BranchAndBound(Optimizer):
+    # exact search over recipe combinations for small cookbooks; prunes a partial plan when no
+    # completion can beat the incumbent and returns the incumbent if the budget runs out first
+    name = 'exact'
+    uses_clock = True
+
+    def __init__(self, iterations=100, time_limit=None, warm_start=0.1):
+        super().__init__(iterations, time_limit)
+        self.warm_start = warm_start
+        self.complete = False
+
+    def lower_bound(self, evaluator, remaining, reach):
+        # cheapest possible cost once `remaining` more recipes are added, each adding at most
+        # `reach` per column. Below the pantry stock, a column's cost falls as it is used up;
+        # at or above it, leftover is never negative, so the column can't beat -weight * stock.
+        # Buying more never costs less, so what the partial plan already spends is a floor too.
+        pantry = evaluator.pantry
+        stock = pantry.stock
+        reachable = np.minimum(evaluator.need + remaining * reach, stock)
+        wastage = np.where(pantry.expiring, stock - reachable, 0)
+        column_cost = evaluator.wastage_weight * wastage - evaluator.pantry_change_weight * reachable
+        return evaluator.wastage_weight * pantry.base_wastage + column_cost.sum() + evaluator.spend_weight * evaluator.spend
+
+    def search(self, evaluator, num_meals, budget, rng):
+        matrix = evaluator.matrix
+        num_recipes = matrix.num_recipes
+
+        # a short hill climb gives an incumbent to prune against from the start
+        warm_iterations = int(budget.iterations * self.warm_start) if budget.iterations else None
+        warm_time_limit = budget.time_limit * self.warm_start if budget.time_limit else None
+        if warm_iterations is None and warm_time_limit is None:
+            warm_iterations = 1000
+        warm_budget = Budget(warm_iterations, warm_time_limit)
+        best_plan, best_cost = HillClimbing().search(evaluator, num_meals, warm_budget, rng)
+        budget.spend(warm_budget.used)
+        best_plan = best_plan[:]
+        self.improved(best_plan, best_cost, budget)
+
+        # the bound is only valid for non-negative weights; otherwise enumerate everything
+        prune = evaluator.wastage_weight >= 0 and evaluator.pantry_change_weight >= 0 and evaluator.spend_weight >= 0
+        # column-wise max over recipes i..R-1, the most any later recipe can add
+        suffix_reach = np.maximum.accumulate(matrix.quantities[::-1], axis=0)[::-1]
+
+        empty = PlanEvaluator(matrix, evaluator.pantry, evaluator.wastage_weight, evaluator.pantry_change_weight,
+                              constraints=evaluator.constraints, spend_weight=evaluator.spend_weight)
+        stack = [0]
+        self.complete = False
+        while stack:
+            if budget.exhausted():
+                return best_plan, best_cost
+            recipe = stack[-1]
+            depth = len(empty.plan)
+            if recipe > num_recipes - (num_meals - depth):
+                # nothing left to try at this depth: backtrack
+                stack.pop()
+                if empty.plan:
+                    empty.remove(len(empty.plan) - 1)
+                    stack[-1] += 1
+                continue
+
+            if depth == num_meals - 1:
+                # the last slot: score every remaining recipe in one batch
+                candidates = np.arange(recipe, num_recipes)
+                candidates = candidates[empty.within_limits(candidates)]
+                costs = empty.add_costs(candidates)
+                budget.spend(len(candidates))
+                best = int(np.argmin(costs)) if len(candidates) else None
+                if best is not None and costs[best] < best_cost:
+                    best_plan, best_cost = empty.plan + [int(candidates[best])], float(costs[best])
+                    self.improved(best_plan, best_cost, budget)
+                stack[-1] = num_recipes
+            elif (prune and
+                  self.lower_bound(empty, num_meals - depth, suffix_reach[recipe]) >= best_cost):
+                # no completion using recipes from here on can win
+                stack[-1] = num_recipes
+            elif not empty.within_limits([recipe], complete=False)[0]:
+                # already over a nutrition limit, and more recipes only add to it
+                stack[-1] += 1
+            else:
+                empty.add(recipe)
+                budget.spend()
+                if prune and self.lower_bound(empty, num_meals - depth - 1, suffix_reach[recipe + 1]) >= best_cost:
+                    empty.remove(depth)
+                    stack[-1] += 1
+                else:
+                    stack.append(recipe + 1)
+
+        self.complete = True
+        return best_plan, best_cost
+
+
+OPTIMIZERS = {optimizer.name: optimizer for optimizer in (HillClimbing, SimulatedAnnealing, TabuSearch, BranchAndBound)}
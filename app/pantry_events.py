@@ -0,0 +1,158 @@
+import threading
+
+from sqlalchemy import insert, select, update
+
+from app import app, db
+from app.models import Household, PantryEvent, PantryItem
+from app.metrics import metrics
+
+ADDED = 'add'
+UPDATED = 'update'
+REMOVED = 'remove'
+# a concurrent write landing between the version read and the row read makes a full load retry
+LOAD_ATTEMPTS = 3
+
+
+def item_event(kind, item_id, household_id, name=None, quantity=None, unit=None, expiry_date=None):
+    return {'kind': kind, 'item_id': item_id, 'household_id': household_id, 'name': name,
+            'quantity': quantity, 'unit': unit, 'expiry_date': expiry_date}
+
+def row_event(kind, item):
+    # the event for a PantryItem as it now is; a removal only needs the id
+    if kind == REMOVED:
+        return item_event(REMOVED, item.id, item.household_id)
+    return item_event(kind, item.id, item.household_id, item.name, item.quantity, item.unit, item.expiry_date)
+
+def record_events(events):
+    # goes into the caller's transaction, so the log and the pantry commit or roll back together.
+    # Each event takes the next of its household's versions. The UPDATE handing them out holds
+    # the household row's lock until commit, so one household's writers commit in version order
+    # on any database, and a reader that sees a version sees every event up to it.
+    if not events:
+        return
+    by_household = {}
+    for event in events:
+        by_household.setdefault(event['household_id'], []).append(event)
+    rows = []
+    # households in id order, so two bulk writes can't each hold a lock the other waits for
+    for household_id in sorted(by_household):
+        household_events = by_household[household_id]
+        db.session.execute(update(Household).where(Household.id == household_id)
+                           .values(pantry_version=Household.pantry_version + len(household_events))
+                           .execution_options(synchronize_session=False))
+        first = latest_version(household_id) - len(household_events) + 1
+        rows.extend({**event, 'version': first + i} for i, event in enumerate(household_events))
+    db.session.execute(insert(PantryEvent), rows)
+
+
+def _entry(units, name, quantity, unit, expiry_date):
+    # what load_digital_pantry makes of one row
+    return {'quantity': units.to_standard(name, quantity, unit), 'unit': 'stan', 'expiry_date': expiry_date}
+
+
+class PantrySnapshot:
+    # one household's digital pantry as of pantry event `version`, already standardized. A
+    # published snapshot is never changed: apply() builds the next one, sharing every entry the
+    # events didn't touch, so planners can hold on to `pantry` while writes carry on.
+    def __init__(self, household_id, version, items, names, units):
+        self.household_id = household_id
+        self.version = version
+        # the knowledge bank's unit registry the entries were converted with
+        self.units = units
+        # item id -> (name, entry) for each row
+        self.items = items
+        # name -> ids of the rows with that name
+        self.names = names
+        # name -> entry, as load_digital_pantry builds it: the newest row wins a shared name
+        self.pantry = {name: items[max(ids)][1] for name, ids in names.items()}
+
+    @property
+    def key(self):
+        # for keying cached plans and shopping lists on pantry state
+        return ('pantry', self.household_id, self.version)
+
+    @classmethod
+    def from_rows(cls, household_id, version, rows, units):
+        items = {}
+        names = {}
+        for item_id, name, quantity, unit, expiry_date in rows:
+            items[item_id] = (name, _entry(units, name, quantity, unit, expiry_date))
+            names.setdefault(name, set()).add(item_id)
+        return cls(household_id, version, items, {name: frozenset(ids) for name, ids in names.items()}, units)
+
+    def apply(self, events):
+        # the snapshot after `events`, which must follow on from this one in version order
+        units = self.units
+        items = dict(self.items)
+        names = dict(self.names)
+        touched = set()
+        for event in events:
+            old = items.pop(event.item_id, None)
+            if old is not None:
+                names[old[0]] = names[old[0]] - {event.item_id}
+                touched.add(old[0])
+            if event.kind != REMOVED:
+                items[event.item_id] = (event.name, _entry(units, event.name, event.quantity, event.unit, event.expiry_date))
+                names[event.name] = names.get(event.name, frozenset()) | {event.item_id}
+                touched.add(event.name)
+        snapshot = PantrySnapshot.__new__(PantrySnapshot)
+        snapshot.household_id = self.household_id
+        snapshot.version = events[-1].version if events else self.version
+        snapshot.units = units
+        snapshot.items = items
+        snapshot.names = {name: ids for name, ids in names.items() if ids}
+        pantry = dict(self.pantry)
+        for name in touched:
+            ids = snapshot.names.get(name)
+            if ids:
+                pantry[name] = items[max(ids)][1]
+            else:
+                pantry.pop(name, None)
+        snapshot.pantry = pantry
+        return snapshot
+
+
+def latest_version(household_id):
+    # one primary key lookup
+    return db.session.scalar(select(Household.pantry_version).where(Household.id == household_id)) or 0
+
+def _load_snapshot(household_id, units):
+    rows_query = select(PantryItem.id, PantryItem.name, PantryItem.quantity, PantryItem.unit,
+                        PantryItem.expiry_date).where(PantryItem.household_id == household_id).order_by(PantryItem.id)
+    for _ in range(LOAD_ATTEMPTS):
+        version = latest_version(household_id)
+        rows = db.session.execute(rows_query).all()
+        if latest_version(household_id) == version:
+            break
+    metrics.increment('chef_pantry_snapshot_loads_total')
+    return PantrySnapshot.from_rows(household_id, version, rows, units)
+
+
+# household id -> latest PantrySnapshot this process has built
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+def pantry_snapshot(household_id):
+    # the household's current snapshot: free when nothing changed, otherwise the events since
+    # the last one applied on top of it, and only the first time (or when the knowledge bank's
+    # units change) a full load of the rows. Imported here so the pantry routes that only record
+    # events don't pull in numpy.
+    from app.cookbook_cache import get_unit_registry
+
+    units = get_unit_registry(app.config['KNOWLEDGE_BANK_PATH'])
+    version = latest_version(household_id)
+    snapshot = _snapshots.get(household_id)
+    if snapshot is not None and snapshot.version == version and snapshot.units is units:
+        return snapshot
+    with _snapshots_lock:
+        snapshot = _snapshots.get(household_id)
+        if snapshot is None or snapshot.version > version or snapshot.units is not units:
+            # first use, the log was reset under us, or the conversions changed
+            snapshot = _load_snapshot(household_id, units)
+        elif snapshot.version < version:
+            events = PantryEvent.query.filter(PantryEvent.household_id == household_id,
+                                              PantryEvent.version > snapshot.version).order_by(PantryEvent.version).all()
+            snapshot = snapshot.apply(events)
+            metrics.increment('chef_pantry_snapshot_events_total', len(events))
+        _snapshots[household_id] = snapshot
+    return snapshot
@@ -0,0 +1,165 @@
+import random
+
+import numpy as np
+
+from app.cookbook_matrix import PlanEvaluator
+from app.meal_planner import build_cookbook_matrix, generate_shopping_list, prune_pantry
+from app.optimizers import Optimizer
+from app.constraints import constrained_matrix
+from app.metrics import record_search
+
+# what a Pareto search trades off, all minimized, in PlanEvaluator.objectives order; spend is
+# only reported when the knowledge bank has prices
+OBJECTIVES = ('wastage', 'pantry_change', 'purchases', 'spend')
+# most plans an archive keeps; past that the most crowded one makes room
+ARCHIVE_SIZE = 32
+# objectives closer than this are equal, so incremental rounding can't pass a plan off as better
+TOLERANCE = 1e-9
+
+
+class ParetoArchive:
+    # the non-dominated plans found so far. Objectives are rows of one array, so checking a new
+    # plan against the whole archive is two vectorized comparisons, and the archive is capped so
+    # that stays cheap however long the search runs.
+    def __init__(self, capacity=ARCHIVE_SIZE, num_objectives=len(OBJECTIVES)):
+        self.capacity = capacity
+        self.points = np.empty((capacity + 1, num_objectives))
+        self.plans = []
+        # recipe sets already archived, as reordering a plan changes nothing
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.plans)
+
+    def offer(self, plan, objectives):
+        # True if the plan joins the archive: nothing in it is at least as good on every objective
+        key = frozenset(plan)
+        if key in self.keys:
+            return False
+        point = np.asarray(objectives, dtype=np.float64)
+        points = self.points[:len(self.plans)]
+        if np.all(points <= point + TOLERANCE, axis=1).any():
+            return False
+        # anything the new plan is at least as good as on every objective is now dominated
+        dominated = np.all(point <= points + TOLERANCE, axis=1)
+        if dominated.any():
+            keep = np.flatnonzero(~dominated)
+            for i in np.flatnonzero(dominated):
+                self.keys.discard(frozenset(self.plans[i]))
+            self.points[:len(keep)] = points[keep]
+            self.plans = [self.plans[i] for i in keep]
+        self.points[len(self.plans)] = point
+        self.plans.append(list(plan))
+        self.keys.add(key)
+        if len(self.plans) > self.capacity:
+            return self._drop(self._most_crowded()) != len(self.plans)
+        return True
+
+    def _drop(self, index):
+        self.keys.discard(frozenset(self.plans.pop(index)))
+        size = len(self.plans)
+        self.points[index:size] = self.points[index + 1:size + 1]
+        return index
+
+    def _most_crowded(self):
+        # the plan with the smallest crowding distance (the normalized size of the box its
+        # neighbours on each objective span); the extremes of each objective are always kept
+        points = self.points[:len(self.plans)]
+        distance = np.zeros(len(points))
+        for objective in range(points.shape[1]):
+            order = np.argsort(points[:, objective], kind='stable')
+            values = points[order, objective]
+            spread = values[-1] - values[0]
+            distance[order[[0, -1]]] = np.inf
+            if spread > 0:
+                distance[order[1:-1]] += (values[2:] - values[:-2]) / spread
+        return int(np.argmin(distance))
+
+    def entries(self):
+        # [(plan, objectives)], least wastage first
+        points = self.points[:len(self.plans)]
+        order = np.lexsort(points.T[::-1])
+        return [(self.plans[i], tuple(float(value) for value in points[i])) for i in order]
+
+
+class ParetoSearch(Optimizer):
+    # Pareto local search: a random walk over swaps that moves whenever the swapped plan joins
+    # the archive, restarting from another archived plan when the walk stops finding any. The
+    # evaluator's weights only pick which archived plan optimize() returns.
+    name = 'pareto'
+
+    def __init__(self, iterations=100, time_limit=None, capacity=ARCHIVE_SIZE, patience=50):
+        super().__init__(iterations, time_limit)
+        self.capacity = capacity
+        self.patience = patience
+        self.archive = None
+
+    def search(self, evaluator, num_meals, budget, rng):
+        archive = ParetoArchive(self.capacity)
+        archive.offer(evaluator.plan, evaluator.objectives)
+        best_plan, best_cost = evaluator.plan[:], evaluator.cost
+        stale = 0
+        while not budget.exhausted():
+            move = self.propose(evaluator, num_meals, rng)
+            if move is None:
+                break
+            slot, recipe = move
+            evaluator.try_swap(slot, recipe)
+            budget.spend()
+            plan = evaluator.plan[:]
+            plan[slot] = recipe
+            if archive.offer(plan, evaluator.pending_objectives()):
+                evaluator.accept()
+                stale = 0
+                if evaluator.cost < best_cost:
+                    best_plan, best_cost = evaluator.plan[:], evaluator.cost
+                    self.improved(best_plan, best_cost, budget)
+            else:
+                stale += 1
+                if stale >= self.patience and len(archive) > 1:
+                    self.move_to(evaluator, archive.plans[rng.randrange(len(archive))], budget)
+                    stale = 0
+        self.archive = archive
+        return best_plan, best_cost
+
+    def move_to(self, evaluator, plan, budget):
+        # swap the evaluator over to an archived plan, one recipe it lacks at a time
+        slots = [slot for slot, recipe in enumerate(evaluator.plan) if recipe not in plan]
+        incoming = [recipe for recipe in plan if recipe not in evaluator.plan]
+        for slot, recipe in zip(slots, incoming):
+            evaluator.try_swap(slot, recipe)
+            evaluator.accept()
+            budget.spend()
+
+
+def plan_pareto_front(all_recipes, digital_pantry, knowledge_bank, iterations, wastage_weight, pantry_change_weight, num_meals=6, matrix=None, rng=None, time_limit=None, constraints=None, now=None, seed=None, spend_weight=0, capacity=ARCHIVE_SIZE):
+    # one search for the plans no other plan it found beats on every objective. Returns a list of
+    # {'recipes', 'objectives', 'cost', 'shopping_list', 'new_pantry'}, least wastage first, and
+    # the index of the one the weights would pick
+    if rng is None:
+        rng = random.Random(seed)
+    if matrix is None:
+        matrix = build_cookbook_matrix(all_recipes, knowledge_bank)
+    matrix, recipe_ids = constrained_matrix(matrix, constraints, num_meals)
+    pantry = matrix.pantry_vectors(digital_pantry, now)
+    search = ParetoSearch(iterations, time_limit, capacity)
+    plan, _ = search.optimize(matrix, pantry, wastage_weight, pantry_change_weight, num_meals, rng, constraints, spend_weight)
+    record_search(search.name, search.stats)
+    # a cookbook no bigger than one plan isn't searched, and has just that plan
+    plans = [plan] if search.archive is None else [plan for plan, _ in search.archive.entries()]
+
+    priced = matrix.purchases is not None
+    front = []
+    for plan in plans:
+        # rescore from scratch so incremental rounding never reaches the caller
+        evaluator = PlanEvaluator(matrix, pantry, wastage_weight, pantry_change_weight, plan, spend_weight=spend_weight)
+        objectives = {name: round(value, 2) for name, value in zip(OBJECTIVES, evaluator.objectives)
+                      if priced or name != 'spend'}
+        if recipe_ids is not None:
+            plan = [int(recipe_ids[i]) for i in plan]
+        recipes = [all_recipes[i] for i in plan]
+        shopping_list, new_pantry = generate_shopping_list(recipes, digital_pantry, knowledge_bank, now)
+        front.append({'recipes': recipes, 'objectives': objectives, 'cost': round(evaluator.cost, 1),
+                      'shopping_list': shopping_list, 'new_pantry': prune_pantry(new_pantry)})
+    chosen = min(range(len(front)), key=lambda i: front[i]['cost'])
+    return front, chosen
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+from datetime import date
+
+from app.meal_planner import generate_shopping_list, calculate_cost, shopping_spend
+
+_MISSING = object()
+
+
+class LRUCache:
+    # bounded mapping that evicts the least recently used entry once full
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+shopping_list_cache = LRUCache(max_size=256)
+cost_cache = LRUCache(max_size=4096)
+
+
+def plan_fingerprint(recipe_ids, pantry_version, cookbook_version):
+    # a plan is a set of recipes; the order they were picked in doesn't matter. What expires and
+    # what counts as expiring soon move with the calendar, so entries only hold for the day.
+    return (tuple(sorted(recipe_ids)), pantry_version, cookbook_version, date.today())
+
+# both caches hand out shared objects; callers must not mutate them
+def cached_shopping_list(recipe_ids, all_recipes, digital_pantry, knowledge_bank, pantry_version, cookbook_version):
+    key = plan_fingerprint(recipe_ids, pantry_version, cookbook_version)
+    return shopping_list_cache.get_or_compute(
+        key, lambda: generate_shopping_list([all_recipes[i] for i in recipe_ids], digital_pantry, knowledge_bank))
+
+def cached_cost(recipe_ids, all_recipes, digital_pantry, knowledge_bank, wastage_weight, pantry_change_weight,
+                spend_weight, pantry_version, cookbook_version):
+    key = plan_fingerprint(recipe_ids, pantry_version, cookbook_version) + (wastage_weight, pantry_change_weight, spend_weight)
+
+    def compute():
+        shopping_list, new_pantry = cached_shopping_list(recipe_ids, all_recipes, digital_pantry, knowledge_bank,
+                                                         pantry_version, cookbook_version)
+        return calculate_cost(digital_pantry, new_pantry, wastage_weight, pantry_change_weight,
+                              spend=shopping_spend(shopping_list), spend_weight=spend_weight)
+
+    return cost_cache.get_or_compute(key, compute)
+
+def cache_stats():
+    return {'shopping_list': shopping_list_cache.stats(), 'cost': cost_cache.stats()}
+
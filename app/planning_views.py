@@ -0,0 +1,447 @@
+from flask import render_template, request, redirect, url_for, jsonify, Response
+from markupsafe import Markup
+from app import app, db
+from app.models import PantryItem
+from app.meal_planner import OPTIMIZERS, load_digital_pantry, generate_meal_plans, replay_meal_plan, to_purchase_unit, prune_pantry, pantry_fingerprint
+from app.cookbook_cache import get_raw_cookbook, get_recipes, get_knowledge_bank, get_unit_registry, get_cookbook_matrix, get_recipe_ids, get_recipe_index, cookbook_version, file_version
+from app.cookbook_cache import cache_stats as cookbook_cache_stats
+from app.plan_cache import cached_shopping_list, cached_cost
+from app.plan_cache import cache_stats as plan_cache_stats
+from app.recipe_index import recipe_query, query_args, search_recipes, page_of, fragment_cache, NUMERIC_FILTERS
+from app.recipe_index import cache_stats as recipe_cache_stats
+from app.jobs import planning_jobs
+from app.horizon import plan_horizon
+from app.pareto import plan_pareto_front
+from app.constraints import PLAN_TOTALS, constraints_from_params
+from app.runs import RunRecord
+from app.runs import cache_stats as run_cache_stats
+from app.metrics import metrics
+from app.purchasing import priced_ingredients
+from app.pantry_events import ADDED, UPDATED, item_event, record_events, pantry_snapshot
+from app.households import current_household_id, household_items, get_staged_plan, claim_execution
+import hashlib
+import json
+import math
+import random
+from datetime import date, datetime
+from sqlalchemy import update, insert
+
+# the views that plan or read the cookbook; routes.py registers them and this module, with the
+# planner and numpy behind it, is only imported when one of them is first requested
+
+MAX_RESTARTS = 50
+PLANS_SHOWN = 5
+# evaluations per restart on the meal plans page, and how many restarts it runs by default
+MEAL_PLAN_ITERATIONS = 100
+MEAL_PLAN_RESTARTS = 5
+# a background job's limits; each runs in its own process, and at most two at once
+MAX_JOB_ITERATIONS = 200000
+MAX_JOB_SECONDS = 120
+MAX_JOB_RESTARTS = 20
+MAX_HORIZON_WEEKS = 8
+# horizon plans run inside the request, so they get a wall-clock cap
+HORIZON_SECONDS = 2
+PARETO_SECONDS = 2
+RECIPES_PER_PAGE = 50
+MAX_RECIPES_PER_PAGE = 200
+
+def show_recipes():
+    # one page of the (optionally filtered) cookbook; filters are ?ingredient= (repeatable) and
+    # min_/max_ calories, carbs, fat, protein and time
+    cookbook_path = app.config['COOKBOOK_PATH']
+    version = file_version(cookbook_path)
+    query = recipe_query(request.args)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', RECIPES_PER_PAGE, type=int), 1), MAX_RECIPES_PER_PAGE)
+
+    # the page only changes with the cookbook, so clients can revalidate without a render
+    etag = hashlib.sha1(repr((version, query, page, per_page)).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    cookbook = get_raw_cookbook(cookbook_path)
+    index = get_recipe_index(cookbook_path)
+    recipe_ids, total = page_of(index, search_recipes(index, query, version), page, per_page)
+    fragments = [fragment_cache.get_or_compute((version, i), lambda i=i: render_template('recipe_item.html', recipe=cookbook[i]))
+                 for i in recipe_ids]
+
+    filters = query_args(query)
+    pages = max((total + per_page - 1) // per_page, 1)
+    links = {}
+    if page > 1:
+        links['previous'] = url_for('show_recipes', page=min(page - 1, pages), per_page=per_page, **filters)
+    if page < pages:
+        links['next'] = url_for('show_recipes', page=page + 1, per_page=per_page, **filters)
+    with metrics.timer('chef_phase_seconds', phase='render'):
+        response = Response(render_template('recipes.html', recipes=Markup(''.join(fragments)), total=total, page=page,
+                                            pages=pages, links=links, args=request.args, ranges=NUMERIC_FILTERS))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def planning_weights(digital_pantry):
+    # (wastage_weight, pantry_weight, spend_weight)
+    spend_weight = app.config['SPEND_WEIGHT']
+    if len(digital_pantry) == 0:
+        return 1, 0, spend_weight
+    return 0.75, 0.25, spend_weight
+
+def planning_inputs(household_id=None):
+    if household_id is None:
+        household_id = current_household_id()
+    cookbook_path = app.config['COOKBOOK_PATH']
+    kb_path = app.config['KNOWLEDGE_BANK_PATH']
+    with metrics.timer('chef_phase_seconds', phase='load_recipes'):
+        all_recipes = get_recipes(cookbook_path, kb_path)
+    with metrics.timer('chef_phase_seconds', phase='load_pantry'):
+        snapshot = pantry_snapshot(household_id)
+        digital_pantry = snapshot.pantry
+    with metrics.timer('chef_phase_seconds', phase='load_knowledge_bank'):
+        knowledge_bank = get_knowledge_bank(kb_path)
+    with metrics.timer('chef_phase_seconds', phase='load_matrix'):
+        matrix = get_cookbook_matrix(cookbook_path, kb_path)
+    # keys for cached shopping lists and plan results: (pantry version, cookbook version)
+    versions = (snapshot.key, cookbook_version(cookbook_path, kb_path))
+    return all_recipes, digital_pantry, knowledge_bank, matrix, versions
+
+# household id -> (versions, seed) of the default meal plans search last run in the background
+_prewarmed = {}
+
+def prewarm_meal_plans(household_id):
+    # run the meal plans page's default search for the household's current pantry and cookbook,
+    # once per version, so its restarts and shopping lists are cached before anyone asks. Only
+    # households whose pantry, cookbook or date moved on are searched again; each of those costs
+    # a worker process start and MEAL_PLAN_RESTARTS searches of CPU, plus its shopping lists here
+    all_recipes, digital_pantry, knowledge_bank, matrix, versions = planning_inputs(household_id)
+    # cached plans are keyed on the date too, so a new day needs a new search
+    prewarmed = _prewarmed.get(household_id)
+    if prewarmed is not None and prewarmed[0] == (versions, date.today()):
+        return
+    wastage_weight, pantry_weight, spend_weight = planning_weights(digital_pantry)
+    seed = random.SystemRandom().getrandbits(32)
+    # one worker process, so the searches don't hold the GIL against this process's requests;
+    # their records come back into this process's run cache
+    generate_meal_plans(all_recipes, digital_pantry, knowledge_bank, MEAL_PLAN_ITERATIONS, wastage_weight, pantry_weight,
+                        num_plans=MEAL_PLAN_RESTARTS, matrix=matrix, processes=1, cache_versions=versions, seed=seed,
+                        spend_weight=spend_weight, isolate=True)
+    _prewarmed[household_id] = ((versions, date.today()), seed)
+
+def prewarmed_seed(household_id, versions, restarts, optimizer, constraints):
+    # the seed of the prewarmed search when a request asks for that same search, else a fresh one
+    prewarmed = _prewarmed.get(household_id)
+    if (prewarmed is not None and prewarmed[0] == (versions, date.today()) and restarts == MEAL_PLAN_RESTARTS
+            and optimizer == 'hill_climb' and not constraints):
+        return prewarmed[1]
+    return random.SystemRandom().getrandbits(32)
+
+def meal_plan_views(ranked_plans):
+    meal_plans = []
+    for plan, cost, shop_list, new_pantry in ranked_plans[:PLANS_SHOWN]:
+        recipe_names = [recipe['name'] for recipe in plan]
+        meal_plans.append({'plan': plan, 'cost': cost, 'recipes': recipe_names, 'shopping_list': shop_list, 'new_pantry': new_pantry})
+    return meal_plans
+
+def show_meal_plans():
+    all_recipes, digital_pantry, knowledge_bank, matrix, versions = planning_inputs()
+
+    # independent restarts run across a process pool; only the best distinct plans are shown
+    restarts = min(max(request.args.get('restarts', MEAL_PLAN_RESTARTS, type=int), 1), MAX_RESTARTS)
+    optimizer = request.args.get('optimizer', 'hill_climb')
+    if optimizer not in OPTIMIZERS:
+        optimizer = 'hill_climb'
+
+    wastage_weight, pantry_weight, spend_weight = planning_weights(digital_pantry)
+    # the same seed, pantry and cookbook give the same plans; the page shows the seed it used
+    seed = request.args.get('seed', type=int)
+    runs = []
+
+    # optional limits: min_/max_ calories, carbs, fat and protein over the whole plan, max_time
+    # per recipe and a comma-separated exclude list of ingredients
+    error = None
+    try:
+        constraints = constraints_from_params(request.args)
+        if seed is None:
+            seed = prewarmed_seed(current_household_id(), versions, restarts, optimizer, constraints)
+        meal_plans = meal_plan_views(generate_meal_plans(all_recipes,
+                                                         digital_pantry,
+                                                         knowledge_bank,
+                                                         MEAL_PLAN_ITERATIONS,
+                                                         wastage_weight,
+                                                         pantry_weight,
+                                                         num_plans=restarts,
+                                                         matrix=matrix,
+                                                         optimizer=optimizer,
+                                                         cache_versions=versions,
+                                                         constraints=constraints,
+                                                         seed=seed,
+                                                         records=runs,
+                                                         spend_weight=spend_weight))
+    except ValueError as e:
+        constraints = None
+        meal_plans = []
+        error = str(e)
+    if seed is None:
+        # the constraints were turned down before a seed was picked
+        seed = random.SystemRandom().getrandbits(32)
+
+    now = datetime.now()
+    with metrics.timer('chef_phase_seconds', phase='render'):
+        return render_template('meal_plans.html', meal_plans=meal_plans, now=now, error=error, plan_totals=PLAN_TOTALS,
+                               constraints=constraints.to_dict() if constraints else {}, seed=seed,
+                               rerun_url=url_for('show_meal_plans', **{**request.args.to_dict(), 'seed': seed}),
+                               runs=[run.to_dict() for run in runs], priced=priced_ingredients(knowledge_bank))
+
+def show_metrics():
+    # Prometheus text format; cache and job figures are read at scrape time
+    samples = []
+    for name, stats in cookbook_cache_stats().items():
+        samples.append(('chef_file_cache_hits_total', 'counter', {'cache': name}, stats['hits']))
+        samples.append(('chef_file_cache_misses_total', 'counter', {'cache': name}, stats['misses']))
+        samples.append(('chef_file_cache_entries', 'gauge', {'cache': name}, stats['entries']))
+    for name, stats in {**plan_cache_stats(), **recipe_cache_stats(), **run_cache_stats()}.items():
+        samples.append(('chef_plan_cache_hits_total', 'counter', {'cache': name}, stats['hits']))
+        samples.append(('chef_plan_cache_misses_total', 'counter', {'cache': name}, stats['misses']))
+        samples.append(('chef_plan_cache_evictions_total', 'counter', {'cache': name}, stats['evictions']))
+        samples.append(('chef_plan_cache_invalidations_total', 'counter', {'cache': name}, stats['invalidations']))
+        samples.append(('chef_plan_cache_entries', 'gauge', {'cache': name}, stats['size']))
+    for status, count in planning_jobs.status_counts().items():
+        samples.append(('chef_planning_jobs', 'gauge', {'status': status}, count))
+    return Response(metrics.render(samples), mimetype='text/plain; version=0.0.4')
+
+def show_horizon_plan():
+    # several consecutive weeks planned together, carrying leftovers from one week into the next
+    all_recipes, digital_pantry, knowledge_bank, matrix, _ = planning_inputs()
+    weeks = min(max(request.args.get('weeks', 4, type=int), 1), MAX_HORIZON_WEEKS)
+    iterations = min(max(request.args.get('iterations', 500 * weeks, type=int), 1), MAX_JOB_ITERATIONS)
+    seed = request.args.get('seed', type=int)
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(32)
+    wastage_weight, pantry_weight, spend_weight = planning_weights(digital_pantry)
+
+    schedule, cost = plan_horizon(all_recipes, digital_pantry, knowledge_bank, weeks, iterations, wastage_weight,
+                                  pantry_weight, matrix=matrix, time_limit=HORIZON_SECONDS, seed=seed,
+                                  spend_weight=spend_weight)
+    return jsonify(cost=cost, seed=seed, weeks=[{'start': week['start'].strftime('%Y-%m-%d'),
+                                      'recipes': [recipe['name'] for recipe in week['recipes']],
+                                      'shopping_list': week['shopping_list']} for week in schedule])
+
+def show_pareto_plans():
+    # the tradeoffs between wastage, pantry change, purchases and (with prices) spend from one
+    # search, rather than one plan per weighting; `chosen` is the plan the usual weights pick
+    all_recipes, digital_pantry, knowledge_bank, matrix, _ = planning_inputs()
+    iterations = min(max(request.args.get('iterations', 5000, type=int), 1), MAX_JOB_ITERATIONS)
+    seed = request.args.get('seed', type=int)
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(32)
+    wastage_weight, pantry_weight, spend_weight = planning_weights(digital_pantry)
+
+    try:
+        constraints = constraints_from_params(request.args)
+        front, chosen = plan_pareto_front(all_recipes, digital_pantry, knowledge_bank, iterations, wastage_weight,
+                                          pantry_weight, matrix=matrix, time_limit=PARETO_SECONDS,
+                                          constraints=constraints, seed=seed, spend_weight=spend_weight)
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    return jsonify(success=True, seed=seed, chosen=chosen,
+                   plans=[{'recipes': [recipe['name'] for recipe in plan['recipes']], 'objectives': plan['objectives'],
+                           'cost': plan['cost'], 'shopping_list': plan['shopping_list']} for plan in front])
+
+def job_param(params, name, convert, default):
+    # a job parameter from JSON or a form; missing or blank means the default
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} {value!r} is not a valid number') from None
+
+def start_meal_plan_job():
+    # long searches run in the background; poll the job or subscribe to its events
+    params = request.get_json(silent=True) or request.form
+    optimizer = params.get('optimizer', 'annealing')
+    if optimizer not in OPTIMIZERS:
+        return jsonify(success=False, message=f"Unknown optimizer {optimizer}."), 400
+
+    try:
+        restarts = min(max(job_param(params, 'restarts', int, 5), 1), MAX_JOB_RESTARTS)
+        iterations = min(max(job_param(params, 'iterations', int, 10000), 1), MAX_JOB_ITERATIONS)
+        time_limit = job_param(params, 'time_limit', float, None)
+        if time_limit is not None:
+            if not math.isfinite(time_limit) or time_limit <= 0:
+                raise ValueError(f'time_limit must be a positive number of seconds, not {time_limit}')
+            time_limit = min(time_limit, MAX_JOB_SECONDS)
+        constraints = constraints_from_params(params)
+        # unseeded jobs may share results with any identical one; seeded ones only with the same seed
+        seed = job_param(params, 'seed', int, None)
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+
+    all_recipes, digital_pantry, knowledge_bank, matrix, versions = planning_inputs()
+    wastage_weight, pantry_weight, spend_weight = planning_weights(digital_pantry)
+    key = versions + (wastage_weight, pantry_weight, spend_weight, optimizer, iterations, time_limit, restarts, constraints.key(), seed)
+
+    job = planning_jobs.submit(key, all_recipes, digital_pantry, knowledge_bank, matrix, iterations,
+                               wastage_weight, pantry_weight, num_plans=restarts, optimizer=optimizer, constraints=constraints,
+                               time_limit=time_limit, cache_versions=versions, seed=seed, spend_weight=spend_weight)
+    return jsonify(success=True, job_id=job.id, status=job.status,
+                   status_url=url_for('meal_plan_job', job_id=job.id),
+                   events_url=url_for('meal_plan_job_events', job_id=job.id)), 202
+
+def meal_plan_job(job_id):
+    job = planning_jobs.get(job_id)
+    if job is None:
+        return jsonify(success=False, message="No such job."), 404
+    return jsonify(job.to_dict())
+
+def meal_plan_job_events(job_id):
+    job = planning_jobs.get(job_id)
+    if job is None:
+        return jsonify(success=False, message="No such job."), 404
+
+    def stream():
+        # one event per change; the wait timeout doubles as a keep-alive
+        version = None
+        while True:
+            version = job.wait(version, timeout=15)
+            yield f"data: {json.dumps(job.to_dict())}\n\n"
+            if job.finished:
+                break
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+def cancel_meal_plan_job(job_id):
+    job = planning_jobs.get(job_id)
+    if job is None:
+        return jsonify(success=False, message="No such job."), 404
+    job.cancel()
+    return jsonify(success=True, status=job.status)
+
+def meal_plan_job_result(job_id):
+    job = planning_jobs.get(job_id)
+    if job is None or job.meal_plans is None:
+        return redirect(url_for('show_meal_plans'))
+    now = datetime.now()
+    return render_template('meal_plans.html', meal_plans=meal_plan_views(job.meal_plans), now=now, plan_totals=PLAN_TOTALS)
+
+def replay_run():
+    # rerun a run record (from a job's runs or the meal plans page) against this household's
+    # current pantry and cookbook, and say whether it took the same path
+    data = request.get_json(silent=True) or {}
+    try:
+        record = RunRecord.from_dict(data)
+    except (KeyError, TypeError, ValueError):
+        return jsonify(success=False, message="Expected a run record."), 400
+
+    all_recipes, digital_pantry, knowledge_bank, matrix, _ = planning_inputs()
+    try:
+        replayed = replay_meal_plan(record, all_recipes, digital_pantry, knowledge_bank, matrix)
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 409
+    return jsonify(success=True, reproduced=record.same_search(replayed), reproducible=record.reproducible,
+                   run=replayed.to_dict())
+
+def current_meal_plan():
+    cookbook_path = app.config['COOKBOOK_PATH']
+    kb_path = app.config['KNOWLEDGE_BANK_PATH']
+    all_recipes = get_recipes(cookbook_path, kb_path)
+    snapshot = pantry_snapshot(current_household_id())
+    digital_pantry = snapshot.pantry
+    knowledge_bank = get_knowledge_bank(kb_path)
+    staged = get_staged_plan()
+    if staged is None or not staged.recipes:
+        staged_plan = None  # Handle the case where no plan is staged
+    else:
+        recipe_names = set(staged.recipes)
+        recipe_ids = get_recipe_ids(cookbook_path, recipe_names)
+        selected_recipes = [all_recipes[i] for i in recipe_ids]
+        cost = None
+        if staged.executed:
+            shopping_list = None
+            new_pantry = None
+        else:
+            versions = (snapshot.key, cookbook_version(cookbook_path, kb_path))
+            shopping_list, new_pantry = cached_shopping_list(recipe_ids, all_recipes, digital_pantry, knowledge_bank, *versions)
+            new_pantry = prune_pantry(new_pantry)
+            cost = round(cached_cost(recipe_ids, all_recipes, digital_pantry, knowledge_bank,
+                                     *planning_weights(digital_pantry), *versions), 1)
+        staged_plan = {'plan': selected_recipes, 'recipes': recipe_names, 'cost': cost, 'shopping_list': shopping_list, 'new_pantry': new_pantry}
+
+    now = datetime.now()
+    return render_template('current_meal_plan.html', meal_plan=staged_plan, now=now)
+
+def execute_staged_plan():
+    try:
+        cookbook_path = app.config['COOKBOOK_PATH']
+        kb_path = app.config['KNOWLEDGE_BANK_PATH']
+        household_id = current_household_id()
+        all_recipes = get_recipes(cookbook_path, kb_path)
+        unit_registry = get_unit_registry(kb_path)
+        pantry_items = household_items(household_id).all()
+        digital_pantry = load_digital_pantry(pantry_items, unit_registry)
+        knowledge_bank = get_knowledge_bank(kb_path)
+        staged = get_staged_plan(household_id)
+        if staged is None or not staged.recipes:
+            return jsonify(success=False, message="No meal plan staged.")
+        if staged.executed:
+            return jsonify(success=False, message="The staged meal plan was already executed.")
+        recipe_names = set(staged.recipes)
+
+        # from the rows this execution writes against rather than the snapshot, which a
+        # concurrent write may already have moved past
+        recipe_ids = get_recipe_ids(cookbook_path, recipe_names)
+        versions = (pantry_fingerprint(digital_pantry), cookbook_version(cookbook_path, kb_path))
+        _, new_pantry_state = cached_shopping_list(recipe_ids, all_recipes, digital_pantry, knowledge_bank, *versions)
+        remaining = prune_pantry(new_pantry_state)
+
+        # the rows were already loaded above, so match them by name instead of querying per ingredient
+        rows_by_name = {}
+        for pantry_item in pantry_items:
+            rows_by_name.setdefault(pantry_item.name, pantry_item)
+        rows_by_id = {pantry_item.id: pantry_item for pantry_item in pantry_items}
+
+        updates = []
+        inserts = []
+        for name, item in remaining.items():
+            pantry_item = rows_by_name.get(name)
+            if name in knowledge_bank:
+                purchase_unit = knowledge_bank[name]['increment']['unit']
+            elif pantry_item:
+                # not in the knowledge bank: the row keeps its own unit
+                purchase_unit = pantry_item.unit
+            else:
+                continue
+            rem_quantity = to_purchase_unit(item['quantity'], purchase_unit, name, unit_registry)
+            if pantry_item:
+                if pantry_item.quantity == rem_quantity and pantry_item.unit == purchase_unit:
+                    continue
+                updates.append({'id': pantry_item.id, 'quantity': rem_quantity, 'unit': purchase_unit})
+            else:
+                inserts.append({'household_id': household_id, 'name': name, 'quantity': rem_quantity,
+                                'unit': purchase_unit, 'expiry_date': item['expiry_date']})
+        # one transaction, one executemany per statement, however large the pantry; the claim on
+        # the staged plan goes first so a concurrent execution of the same plan writes nothing
+        if not claim_execution(staged):
+            db.session.rollback()
+            return jsonify(success=False, message="The staged meal plan changed or was already executed.")
+        events = []
+        if updates:
+            db.session.execute(update(PantryItem), updates)
+            for change in updates:
+                row = rows_by_id[change['id']]
+                events.append(item_event(UPDATED, row.id, household_id, row.name, change['quantity'], change['unit'], row.expiry_date))
+        if inserts:
+            # ids in parameter order, for the events
+            new_ids = db.session.scalars(insert(PantryItem).returning(PantryItem.id, sort_by_parameter_order=True), inserts).all()
+            for new_id, row in zip(new_ids, inserts):
+                events.append(item_event(ADDED, new_id, household_id, row['name'], row['quantity'], row['unit'], row['expiry_date']))
+        record_events(events)
+        db.session.commit()
+
+        return jsonify(success=True, message="Meal plan executed successfully and pantry updated.")
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify(success=False, message=str(e))
@@ -0,0 +1,173 @@
+import math
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+
+from app.units import entry_units
+
+# knowledge bank entries may list the package sizes an ingredient is sold in, e.g.
+#   "purchase_options": [{"quantity": 8, "unit": "oz", "price": 2.49}, {"quantity": 32, "unit": "oz", "price": 6.99}]
+# and are then bought as the cheapest mix of those that covers what's needed; ingredients
+# without them are bought in their single `increment`, at no known price
+
+# buckets per tabulated ingredient; amounts past the end get extra packs of the option that's
+# cheapest per unit, which is what the cheapest mix for a large amount consists of anyway
+MAX_BUCKETS = 512
+# when the sizes share no common step that keeps the largest of them within MAX_BUCKETS // 4
+# buckets, a bucket is this fraction of the smallest size, and sizes are rounded down to whole
+# buckets so a tabulated mix always covers its bucket
+BUCKETS_PER_PACKAGE = 8
+
+
+def priced_ingredients(knowledge_bank):
+    # how many ingredients the spend weight applies to; with none, plans are never told apart by price
+    return sum(1 for entry in knowledge_bank.values() if entry.get('purchase_options'))
+
+def purchase_options(name, entry):
+    # [(size in standard units, price, option)] for a knowledge bank entry, or None without options
+    options = entry.get('purchase_options')
+    if not options:
+        return None
+    units = entry_units(name, entry)
+    result = []
+    for option in options:
+        if option.get('price') is None or option['quantity'] <= 0:
+            raise ValueError(f'Purchase option {option} for {name} needs a positive quantity and a price')
+        result.append((units.to_standard(name, option['quantity'], option['unit']), float(option['price']), option))
+    return result
+
+def _bucket_step(sizes):
+    # the largest step that divides every size, if that keeps the table short, else a fraction
+    # of the smallest size
+    fractions = [Fraction(size).limit_denominator(1000) for size in sizes]
+    if all(abs(float(fraction) - size) <= 1e-9 * size for fraction, size in zip(fractions, sizes)):
+        denominator = math.lcm(*(fraction.denominator for fraction in fractions))
+        step = Fraction(math.gcd(*(int(fraction * denominator) for fraction in fractions)), denominator)
+        if max(sizes) / step <= MAX_BUCKETS // 4:
+            return float(step)
+    return min(sizes) / BUCKETS_PER_PACKAGE
+
+
+class PurchaseTables:
+    # the cheapest mix of packages for every amount of some ingredients, tabulated by unbounded
+    # min-cost covering: entry [r, b] is the mix for ingredient row r that covers b buckets of
+    # step[r] standard units for the least money, and among those the one that buys least.
+    # Looking an amount up is then a handful of array operations however many options there are.
+    def __init__(self, options_by_row):
+        num_rows = len(options_by_row)
+        width = max(len(options) for options in options_by_row)
+        self.step = np.empty(num_rows)
+        # per row and option: size in buckets, actual size (standard units) and price; missing
+        # options cost infinitely much
+        self.option_buckets = np.ones((num_rows, width), dtype=np.int64)
+        self.option_sizes = np.zeros((num_rows, width))
+        self.option_prices = np.full((num_rows, width), np.inf)
+        for row, options in enumerate(options_by_row):
+            sizes = [size for size, _, _ in options]
+            self.step[row] = step = _bucket_step(sizes)
+            for i, (size, price, _) in enumerate(options):
+                self.option_buckets[row, i] = max(int(math.floor(size / step + 1e-9)), 1)
+                self.option_sizes[row, i] = size
+                self.option_prices[row, i] = price
+
+        self.cost = np.zeros((num_rows, MAX_BUCKETS))
+        self.bought = np.zeros((num_rows, MAX_BUCKETS))
+        self.count = np.zeros((num_rows, MAX_BUCKETS))
+        # the option a mix ends with, to walk back for the packages it's made of
+        self.choice = np.zeros((num_rows, MAX_BUCKETS), dtype=np.int64)
+        rows = np.arange(num_rows)
+        for bucket in range(1, MAX_BUCKETS):
+            previous = np.maximum(bucket - self.option_buckets, 0)
+            cost = self.cost[rows[:, None], previous] + self.option_prices
+            cheapest = cost.min(axis=1, keepdims=True)
+            bought = np.where(cost <= cheapest + 1e-9, self.bought[rows[:, None], previous] + self.option_sizes, np.inf)
+            choice = bought.argmin(axis=1)
+            self.cost[:, bucket] = cost[rows, choice]
+            self.bought[:, bucket] = bought[rows, choice]
+            self.count[:, bucket] = self.count[rows, previous[rows, choice]] + 1
+            self.choice[:, bucket] = choice
+
+        # the option with the lowest price per bucket, for amounts past the end of the table
+        value = np.argmin(self.option_prices / self.option_buckets, axis=1)
+        self.value_option = value
+        self.value_buckets = self.option_buckets[rows, value].astype(np.float64)
+        self.value_size = self.option_sizes[rows, value]
+        self.value_price = self.option_prices[rows, value]
+
+    def _buckets(self, rows, required):
+        # (table bucket, extra packs of the value option) for required standard units
+        buckets = np.ceil(np.round(required / self.step[rows], 3))
+        extra = np.ceil(np.maximum(buckets - (MAX_BUCKETS - 1), 0) / self.value_buckets[rows])
+        # a value pack larger than the whole table can cover more than the remainder on its own
+        return np.maximum(buckets - extra * self.value_buckets[rows], 0).astype(np.int64), extra
+
+    def buy(self, rows, required):
+        # (packages, standard units bought, price) of the cheapest mix covering each required
+        # amount of row rows[j]; required may have leading batch dimensions
+        index, extra = self._buckets(rows, required)
+        flat = rows * MAX_BUCKETS + index
+        return (self.count.ravel()[flat] + extra, self.bought.ravel()[flat] + extra * self.value_size[rows],
+                self.cost.ravel()[flat] + extra * self.value_price[rows])
+
+    def packages(self, row, required):
+        # (packs of each option, standard units bought, price) of the mix buy() picks, for one amount
+        index, extra = self._buckets(np.array([row]), np.array([required]))
+        bucket, extra = int(index[0]), int(extra[0])
+        counts = [0] * int(np.isfinite(self.option_prices[row]).sum())
+        counts[self.value_option[row]] += extra
+        while bucket > 0:
+            choice = self.choice[row, bucket]
+            counts[choice] += 1
+            bucket = max(bucket - self.option_buckets[row, choice], 0)
+        return counts, float(self.bought[row, index[0]] + extra * self.value_size[row]), float(self.cost[row, index[0]] + extra * self.value_price[row])
+
+
+class ColumnPurchases:
+    # PurchaseTables for the priced ingredients among a CookbookMatrix's columns
+    def __init__(self, column_rows, tables):
+        # table row of each column, -1 for ingredients bought by their increment
+        self.column_rows = column_rows
+        self.tables = tables
+
+    def buy(self, columns, required):
+        # (priced positions among `columns`, and buy() for them); required is aligned with columns
+        rows = self.column_rows[columns]
+        priced = np.flatnonzero(rows >= 0)
+        if not len(priced):
+            return priced, None
+        return priced, self.tables.buy(rows[priced], required[..., priced])
+
+    def fingerprint_arrays(self):
+        return (self.column_rows, self.tables.step, self.tables.option_sizes, self.tables.option_prices)
+
+def column_purchases(ingredient_names, knowledge_bank):
+    # ColumnPurchases for a matrix's columns, or None when no ingredient has purchase options
+    column_rows = np.full(len(ingredient_names), -1, dtype=np.int64)
+    options_by_row = []
+    for col, name in enumerate(ingredient_names):
+        options = purchase_options(name, knowledge_bank[name])
+        if options is not None:
+            column_rows[col] = len(options_by_row)
+            options_by_row.append(options)
+    if not options_by_row:
+        return None
+    return ColumnPurchases(column_rows, PurchaseTables(options_by_row))
+
+
+@lru_cache(maxsize=1024)
+def _ingredient_table(sizes, prices):
+    return PurchaseTables([[(size, price, None) for size, price in zip(sizes, prices)]])
+
+def cheapest_packages(options, required):
+    # (packs of each option, standard units bought, price) for one ingredient's options, from a
+    # table built on first use; the same mix a CookbookMatrix built on these options would pick
+    table = _ingredient_table(tuple(size for size, _, _ in options), tuple(price for _, price, _ in options))
+    return table.packages(0, required)
+
+def priced_purchase(options, required, increment):
+    # (shopping list entry, standard units bought) for `required` standard units of an ingredient
+    # with purchase options; count is the total number of packs, packages what they are
+    counts, bought, price = cheapest_packages(options, required)
+    packages = [{'count': count, **option} for count, (_, _, option) in zip(counts, options) if count]
+    return {'count': sum(counts), 'increment': increment, 'packages': packages, 'price': round(price, 2)}, bought
@@ -0,0 +1,102 @@
+import numpy as np
+
+from app.plan_cache import LRUCache
+
+# query parameter -> recipe field; each one filters with min_<param> and max_<param>
+NUMERIC_FILTERS = {
+    'calories': 'total_calories',
+    'carbs': 'grams_carbs',
+    'fat': 'grams_fat',
+    'protein': 'grams_protein',
+    'time': 'cooking_time',
+}
+_NO_RECIPES = np.zeros(0, dtype=np.int64)
+
+
+class RecipeIndex:
+    # the listing fields of a cookbook as columns, plus ingredient -> recipes, so a filter is a
+    # few vectorized comparisons instead of a walk over every recipe dict
+    def __init__(self, recipes):
+        self.num_recipes = len(recipes)
+        # a recipe missing a field never matches a filter on it
+        self.fields = {field: np.array([_number(recipe.get(field)) for recipe in recipes], dtype=np.float64)
+                       for field in NUMERIC_FILTERS.values()}
+        ingredient_recipes = {}
+        for i, recipe in enumerate(recipes):
+            for name in {ingredient['name'].strip().lower() for ingredient in recipe['ingredients']}:
+                ingredient_recipes.setdefault(name, []).append(i)
+        self.ingredient_recipes = {name: np.array(ids, dtype=np.int64) for name, ids in ingredient_recipes.items()}
+        self.ingredient_names = sorted(self.ingredient_recipes)
+
+    def search(self, query):
+        # cookbook indices matching a RecipeQuery, in cookbook order
+        ingredients, ranges = query
+        matches = None
+        for name in ingredients:
+            ids = self.ingredient_recipes.get(name, _NO_RECIPES)
+            matches = ids if matches is None else np.intersect1d(matches, ids, assume_unique=True)
+        if matches is None:
+            matches = np.arange(self.num_recipes)
+        for field, low, high in ranges:
+            values = self.fields[field][matches]
+            keep = np.ones(len(matches), dtype=bool)
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high
+            matches = matches[keep]
+        return matches
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def recipe_query(args):
+    # (ingredients, ranges) from request args, normalized so equivalent URLs share cache entries
+    ingredients = tuple(sorted({name.strip().lower() for name in args.getlist('ingredient') if name.strip()}))
+    ranges = []
+    for param, field in NUMERIC_FILTERS.items():
+        low = args.get(f'min_{param}', type=float)
+        high = args.get(f'max_{param}', type=float)
+        if low is not None or high is not None:
+            ranges.append((field, low, high))
+    return ingredients, tuple(ranges)
+
+def query_args(query):
+    # the inverse of recipe_query, for building page links
+    ingredients, ranges = query
+    fields = {field: param for param, field in NUMERIC_FILTERS.items()}
+    args = {'ingredient': list(ingredients)} if ingredients else {}
+    for field, low, high in ranges:
+        if low is not None:
+            args[f'min_{fields[field]}'] = low
+        if high is not None:
+            args[f'max_{fields[field]}'] = high
+    return args
+
+
+# matching ids per (cookbook version, query), and rendered <li> per (cookbook version, recipe);
+# keyed by version, so entries for an old cookbook just age out
+search_cache = LRUCache(max_size=256)
+fragment_cache = LRUCache(max_size=4096)
+
+def search_recipes(index, query, version):
+    if not query[0] and not query[1]:
+        return None
+    return search_cache.get_or_compute((version, query), lambda: index.search(query))
+
+def page_of(index, matches, page, per_page):
+    # (recipe ids on the page, total matches); None means the whole cookbook, which is sliced
+    # without materializing an id per recipe
+    total = index.num_recipes if matches is None else len(matches)
+    start = (page - 1) * per_page
+    end = min(start + per_page, total)
+    if matches is None:
+        return list(range(start, end)), total
+    return matches[start:end].tolist(), total
+
+def cache_stats():
+    return {'recipe_search': search_cache.stats(), 'recipe_fragments': fragment_cache.stats()}
@@ -0,0 +1,81 @@
+import hashlib
+import json
+from datetime import datetime
+
+from app.plan_cache import LRUCache
+
+
+class RunRecord:
+    # one optimizer run, small enough to log or hand back with the plan: the seed and budget
+    # that drove it, a fingerprint of everything it read, and how the best cost fell. With inputs
+    # that still match the fingerprint, meal_planner.replay_meal_plan reruns it exactly.
+    def __init__(self, seed, fingerprint, optimizer, iterations, time_limit, evaluations, plan, cost, trajectory, seconds, now, params, reproducible=True):
+        self.seed = seed
+        self.fingerprint = fingerprint
+        self.optimizer = optimizer
+        self.iterations = iterations
+        self.time_limit = time_limit
+        # what the run actually used, which a replay stops at
+        self.evaluations = evaluations
+        # cookbook indices
+        self.plan = list(plan)
+        self.cost = cost
+        # (evaluations so far, cost) at each new best plan
+        self.trajectory = [tuple(point) for point in trajectory]
+        self.seconds = seconds
+        # the clock reading expiry was judged against
+        self.now = now
+        # the weights, num_meals and the constraints as request params
+        self.params = params
+        # False when a time limit let the clock steer the search, so a replay may diverge
+        self.reproducible = reproducible
+
+    def to_dict(self):
+        return {
+            'seed': self.seed,
+            'fingerprint': self.fingerprint,
+            'optimizer': self.optimizer,
+            'iterations': self.iterations,
+            'time_limit': self.time_limit,
+            'evaluations': self.evaluations,
+            'plan': self.plan,
+            'cost': self.cost,
+            'trajectory': [list(point) for point in self.trajectory],
+            'seconds': round(self.seconds, 4),
+            'now': self.now.isoformat(),
+            'params': self.params,
+            'reproducible': self.reproducible,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['seed'], data['fingerprint'], data['optimizer'], data.get('iterations'), data.get('time_limit'),
+                   int(data['evaluations']), data['plan'], data['cost'], data.get('trajectory', []), data.get('seconds', 0.0),
+                   datetime.fromisoformat(data['now']), data['params'], data.get('reproducible', True))
+
+    def same_search(self, other):
+        # whether two runs took the same path: same plan, cost and improvements along the way
+        return (sorted(self.plan) == sorted(other.plan) and self.evaluations == other.evaluations
+                and self.trajectory == other.trajectory and self.cost == other.cost)
+
+
+def inputs_fingerprint(matrix, pantry, wastage_weight, pantry_change_weight, num_meals, constraints=None, spend_weight=0):
+    # content hash of what a search reads: the (possibly constrained) matrix, the pantry as the
+    # matrix sees it, the weights and the constraints
+    digest = hashlib.sha1(matrix.fingerprint().encode('utf-8'))
+    digest.update(pantry.stock.tobytes())
+    digest.update(pantry.expiring.tobytes())
+    digest.update(json.dumps([float(pantry.base_wastage), wastage_weight, pantry_change_weight, spend_weight, num_meals,
+                              constraints.key() if constraints else None]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# RunRecords of finished runs by (fingerprint, seed, optimizer, iterations). Only runs without a
+# time limit go in, since only those are a pure function of their key.
+run_cache = LRUCache(max_size=1024)
+
+def run_key(fingerprint, seed, optimizer, iterations):
+    return (fingerprint, seed, optimizer, iterations)
+
+def cache_stats():
+    return {'runs': run_cache.stats()}
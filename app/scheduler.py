@@ -0,0 +1,135 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from sqlalchemy import select
+
+from app import app, db
+from app.metrics import metrics
+
+# seconds between runs of the built-in tasks
+EXPIRY_ALERTS_INTERVAL = 60
+PREWARM_INTERVAL = 300
+# the first prewarm waits this long, so it doesn't compete with a worker's first requests
+PREWARM_DELAY = 5
+
+
+class Scheduler:
+    # periodic tasks on one daemon thread, kept in a heap by when they're next due. A task runs
+    # inside an app context; one that raises is logged and runs again at its next slot.
+    def __init__(self):
+        self.tasks = []
+        self.sequence = itertools.count()
+        self.wakeup = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def every(self, seconds, name, fn, delay=0):
+        with self.wakeup:
+            heapq.heappush(self.tasks, (time.monotonic() + delay, next(self.sequence), seconds, name, fn))
+            self.wakeup.notify()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='chef-scheduler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.wakeup:
+            self.stopped = True
+            self.wakeup.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            with self.wakeup:
+                while not self.stopped and (not self.tasks or self.tasks[0][0] > time.monotonic()):
+                    self.wakeup.wait(self.tasks[0][0] - time.monotonic() if self.tasks else None)
+                if self.stopped:
+                    return
+                due, _, interval, name, fn = heapq.heappop(self.tasks)
+            self._run_task(name, fn)
+            with self.wakeup:
+                # a task that overran its interval runs again straight away rather than catching up
+                heapq.heappush(self.tasks, (max(due + interval, time.monotonic()), next(self.sequence), interval, name, fn))
+
+    def _run_task(self, name, fn):
+        try:
+            with app.app_context(), metrics.timer('chef_scheduler_seconds', task=name):
+                fn()
+            metrics.increment('chef_scheduler_runs_total', task=name)
+        except Exception:
+            metrics.increment('chef_scheduler_errors_total', task=name)
+            app.logger.exception('Scheduled task %s failed', name)
+
+
+def household_ids():
+    from app.models import Household
+
+    return db.session.scalars(select(Household.id)).all()
+
+def refresh_expiry_alerts():
+    from app.expiry import expiry_alerts
+
+    for household_id in household_ids():
+        expiry_alerts(household_id)
+
+# (pid, open lock file) while this process is the one that prewarms
+_prewarm_lock = None
+
+def holds_prewarm_lock():
+    # prewarming every household in every worker multiplies the work by the number of workers,
+    # so only the process holding an exclusive lock on PREWARM_LOCK does it; another takes over
+    # at its next run if that one goes away. Without flock (Windows) every process prewarms.
+    global _prewarm_lock
+    if fcntl is None:
+        return True
+    if _prewarm_lock is not None and _prewarm_lock[0] == os.getpid():
+        return True
+    # a lock inherited over a fork still belongs to the parent
+    f = open(app.config['PREWARM_LOCK'], 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _prewarm_lock = (os.getpid(), f)
+    return True
+
+def prewarm_meal_plans():
+    from app.planning_views import prewarm_meal_plans as prewarm
+
+    if not holds_prewarm_lock():
+        return
+    for household_id in household_ids():
+        prewarm(household_id)
+
+
+scheduler = Scheduler()
+_started_pid = None
+_start_lock = threading.Lock()
+
+def start_scheduler():
+    # once per process; a worker forked from a process that had one running starts its own
+    global scheduler, _started_pid
+    if _started_pid == os.getpid() or not app.config['SCHEDULER']:
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        if _started_pid is not None:
+            # forked from a process that had one running; its thread didn't come along
+            scheduler = Scheduler()
+        scheduler.every(EXPIRY_ALERTS_INTERVAL, 'expiry_alerts', refresh_expiry_alerts)
+        if app.config['PREWARM']:
+            scheduler.every(PREWARM_INTERVAL, 'prewarm_meal_plans', prewarm_meal_plans, delay=PREWARM_DELAY)
+        scheduler.start()
+        _started_pid = os.getpid()
@@ -0,0 +1,73 @@
+import gc
+import importlib
+import os
+import threading
+
+from sqlalchemy import select
+
+from app import app, db
+from app.metrics import metrics
+
+# 'lazy' starts fast and does the work on first use; 'preload' does it all up front, for servers
+# that import the app once and then fork workers (gunicorn --preload and the like)
+WARMUP_MODES = ('lazy', 'preload')
+
+_database_ready = False
+_database_lock = threading.Lock()
+
+
+def prepare_database():
+    # schema creation and upgrades plus the one-off staged plan import, once per process. Lazy
+    # apps run this before their first request; anything touching the database outside a request
+    # should call it first.
+    global _database_ready
+    if _database_ready:
+        return
+    with _database_lock:
+        if _database_ready:
+            return
+        from app import models
+        from app.households import import_staged_plan_file
+
+        with metrics.timer('chef_startup_seconds', phase='database'), app.app_context():
+            db.create_all()
+            models.upgrade_schema(db.engine)
+            # plans staged before they moved into the database
+            import_staged_plan_file(os.path.join(app.root_path, 'staged_meal_plan.json'))
+        _database_ready = True
+
+def start_background_tasks():
+    # the scheduler, from a worker's first request rather than at import, so preloading servers
+    # don't fork away from its thread
+    from app.scheduler import start_scheduler
+
+    start_scheduler()
+
+def preload():
+    # everything a first planning request would otherwise build: the planning and API views and the
+    # modules behind them, the cookbook in each form the routes read it, and a pantry snapshot
+    # and the expiry alerts per household. Done before the fork, workers share all of it copy-on-write.
+    prepare_database()
+    importlib.import_module('app.planning_views')
+    importlib.import_module('app.api')
+    from app.cookbook_cache import get_raw_cookbook, get_recipes, get_knowledge_bank, get_cookbook_matrix, get_recipe_index, cookbook_version
+    from app.models import Household
+    from app.expiry import expiry_alerts
+
+    cookbook_path = app.config['COOKBOOK_PATH']
+    kb_path = app.config['KNOWLEDGE_BANK_PATH']
+    with metrics.timer('chef_startup_seconds', phase='preload'), app.app_context():
+        get_raw_cookbook(cookbook_path)
+        get_recipes(cookbook_path, kb_path)
+        get_knowledge_bank(kb_path)
+        get_cookbook_matrix(cookbook_path, kb_path)
+        get_recipe_index(cookbook_path)
+        cookbook_version(cookbook_path, kb_path)
+        for household_id in db.session.scalars(select(Household.id)).all():
+            # builds the household's pantry snapshot on the way
+            expiry_alerts(household_id)
+        # each worker opens its own SQLite connections rather than inheriting these
+        db.engine.dispose()
+    # nothing loaded so far is ever collected, so a worker's collector needn't touch (and copy)
+    # the pages it sits on
+    gc.freeze()
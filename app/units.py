@@ -0,0 +1,80 @@
+import numpy as np
+
+# how many of each unit make one standard unit;
+# assume standard unit is 4 oz == 4 fl oz == 1 unit (of tomato, zucchini, lime, etc.)
+UNITS_PER_STANDARD = {
+    'unit': 1,
+    'oz': 4,
+    'lb': 4/16,
+    'cup': 4/8,
+    'tbsp': 4*2,
+    'tsp': 4*6,
+    'ml': 4*30,
+    'clove': 10,
+}
+
+
+class UnitRegistry:
+    # unit -> factor table with per-ingredient overrides, e.g. {'garlic': {'clove': 12}}
+    def __init__(self, factors=UNITS_PER_STANDARD, overrides=None):
+        self.factors = dict(factors)
+        self.overrides = {}
+        for name, units in (overrides or {}).items():
+            for unit, per_standard in units.items():
+                self.register(name, unit, per_standard)
+
+    def register(self, name, unit, per_standard):
+        self.overrides.setdefault(name, {})[unit] = per_standard
+
+    def factor(self, name, unit):
+        override = self.overrides.get(name)
+        if override is not None and unit in override:
+            return override[unit]
+        try:
+            return self.factors[unit]
+        except KeyError:
+            if name is None:
+                raise NotImplementedError(f'Unit {unit} not converted!') from None
+            raise NotImplementedError(f'Unit {unit} for item {name} not converted!') from None
+
+    def knows(self, name, unit):
+        return unit in self.factors or unit in self.overrides.get(name, ())
+
+    def to_standard(self, name, quantity, unit):
+        return quantity / self.factor(name, unit)
+
+    def from_standard(self, name, quantity, unit):
+        return quantity * self.factor(name, unit)
+
+    def factors_for(self, names, units):
+        # one factor per (name, unit) pair, looking each distinct pair up only once
+        seen = {}
+        factors = np.empty(len(units))
+        for i, key in enumerate(zip(names, units)):
+            factor = seen.get(key)
+            if factor is None:
+                factor = seen[key] = self.factor(*key)
+            factors[i] = factor
+        return factors
+
+    def to_standard_bulk(self, names, quantities, units):
+        return np.asarray(quantities, dtype=np.float64) / self.factors_for(names, units)
+
+    def from_standard_bulk(self, names, quantities, units):
+        return np.asarray(quantities, dtype=np.float64) * self.factors_for(names, units)
+
+
+# shared registry of the plain factors; knowledge bank entries may add per-ingredient overrides
+# under 'conversions', e.g. "conversions": {"clove": 12}, which apply wherever that knowledge
+# bank is in use and nowhere else
+registry = UnitRegistry()
+
+def knowledge_bank_units(knowledge_bank):
+    # the registry a knowledge bank's conversions make; the shared one when it has none
+    overrides = {name: entry['conversions'] for name, entry in knowledge_bank.items() if entry.get('conversions')}
+    return UnitRegistry(overrides=overrides) if overrides else registry
+
+def entry_units(name, entry):
+    # the same for a single knowledge bank entry, without going over the whole knowledge bank
+    conversions = entry.get('conversions')
+    return UnitRegistry(overrides={name: conversions}) if conversions else registry
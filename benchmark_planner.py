@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+RECIPE_UNITS = ['unit', 'oz', 'cup', 'tbsp', 'tsp', 'ml', 'clove']
+PURCHASE_UNITS = ['unit', 'oz', 'lb', 'clove']
+SHELF_LIVES = [1, 2, 3, 4, 8, 12, 26, 52]
+# share of ingredients sold in several priced package sizes rather than a single increment
+PRICED_FRACTION = 0.3
+
+
+# synthetic data, in the same shapes as app/cookbook.json, app/knowledge_bank.json and the pantry table
+
+def synthetic_knowledge_bank(num_ingredients, rng):
+    knowledge_bank = {}
+    for i in range(num_ingredients):
+        increment = {'quantity': rng.choice([1, 2, 3, 4, 6, 8, 10, 12, 16, 20]), 'unit': rng.choice(PURCHASE_UNITS)}
+        entry = {'shelf_life': rng.choice(SHELF_LIVES), 'increment': increment}
+        if rng.random() < PRICED_FRACTION:
+            # bigger packs are cheaper per unit
+            price = round(rng.uniform(0.5, 6.0), 2)
+            entry['purchase_options'] = [{'quantity': increment['quantity'] * multiple, 'unit': increment['unit'],
+                                          'price': round(price * multiple ** 0.85, 2)}
+                                         for multiple in sorted(rng.sample([1, 2, 3, 4, 6], rng.randint(1, 3)))]
+        knowledge_bank[f'ingredient {i:05d}'] = entry
+    return knowledge_bank
+
+def synthetic_cookbook(num_recipes, ingredient_names, rng):
+    # a few staples show up in most recipes, like real cookbooks
+    weights = [1 / (rank + 1) for rank in range(len(ingredient_names))]
+    recipes = []
+    for i in range(num_recipes):
+        names = set(rng.choices(ingredient_names, weights, k=rng.randint(6, 12)))
+        recipes.append({
+            'name': f'Recipe {i:06d}',
+            'cooking_time': rng.randint(15, 60),
+            'total_calories': rng.randint(400, 1100),
+            'grams_carbs': float(rng.randint(20, 120)),
+            'grams_fat': float(rng.randint(10, 60)),
+            'grams_protein': float(rng.randint(10, 60)),
+            'ingredients': [{'quantity': rng.choice([0.25, 0.5, 1.0, 2.0, 4.0, 10.0]), 'unit': rng.choice(RECIPE_UNITS), 'name': name}
+                            for name in sorted(names)],
+        })
+    return recipes
+
+def synthetic_pantry(num_items, ingredient_names, rng):
+    now = datetime.now()
+    return [(name, rng.choice([0.5, 1.0, 2.0, 4.0, 8.0]), rng.choice(PURCHASE_UNITS), now + timedelta(days=rng.randint(1, 60)))
+            for name in rng.sample(ingredient_names, min(num_items, len(ingredient_names)))]
+
+
+class PantryRow:
+    def __init__(self, name, quantity, unit, expiry_date):
+        self.name = name
+        self.quantity = quantity
+        self.unit = unit
+        self.expiry_date = expiry_date
+
+
+# measurement helpers
+
+def latency_stats(samples):
+    samples = np.asarray(samples) * 1000
+    return {'p50_ms': round(float(np.percentile(samples, 50)), 4), 'p99_ms': round(float(np.percentile(samples, 99)), 4),
+            'calls': len(samples)}
+
+def measure(fn):
+    # (result, seconds, peak traced MB)
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, round(peak / 2**20, 2)
+
+def repeat(fn, times):
+    samples = []
+    for _ in range(times):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+# benchmarks
+
+def bench_loading(workdir, recipes, knowledge_bank):
+    from app.meal_planner import load_all_recipes, load_knowledge_bank, build_cookbook_matrix
+    from app.cookbook_binary import write_binary_cookbook, load_binary_cookbook
+
+    cookbook_path = os.path.join(workdir, 'cookbook.json')
+    kb_path = os.path.join(workdir, 'knowledge_bank.json')
+    binary_path = os.path.join(workdir, 'cookbook.bin')
+    with open(cookbook_path, 'w') as f:
+        json.dump(recipes, f)
+    with open(kb_path, 'w') as f:
+        json.dump(knowledge_bank, f)
+    write_binary_cookbook(recipes, binary_path)
+
+    results = {}
+    (all_recipes, kb), seconds, peak = measure(lambda: (load_all_recipes(cookbook_path), load_knowledge_bank(kb_path)))
+    results['json_load'] = {'seconds': round(seconds, 4), 'peak_mb': peak}
+    matrix, seconds, peak = measure(lambda: build_cookbook_matrix(all_recipes, kb))
+    results['matrix_build'] = {'seconds': round(seconds, 4), 'peak_mb': peak}
+    _, seconds, peak = measure(lambda: load_binary_cookbook(binary_path).to_matrix(kb))
+    results['binary_load'] = {'seconds': round(seconds, 4), 'peak_mb': peak}
+    return results, all_recipes, kb, matrix, cookbook_path, kb_path
+
+def bench_evaluation(all_recipes, digital_pantry, knowledge_bank, matrix, calls, rng):
+    from app.meal_planner import generate_shopping_list, calculate_cost, shopping_spend
+    from app.cookbook_matrix import PlanEvaluator
+
+    num_recipes = len(all_recipes)
+    plans = [rng.sample(range(num_recipes), 6) for _ in range(calls)]
+    pantry = matrix.pantry_vectors(digital_pantry)
+
+    def dict_path(plan):
+        shopping_list, new_pantry = generate_shopping_list([all_recipes[i] for i in plan], digital_pantry, knowledge_bank)
+        return calculate_cost(digital_pantry, new_pantry, 0.75, 0.25, spend=shopping_spend(shopping_list), spend_weight=0.25)
+
+    plan_iter = iter(plans)
+    results = {'shopping_list': latency_stats(repeat(lambda: dict_path(next(plan_iter)), calls))}
+    plan_iter = iter(plans)
+    results['matrix_cost'] = latency_stats(repeat(lambda: matrix.calculate_cost(next(plan_iter), pantry, 0.75, 0.25, spend_weight=0.25), calls))
+
+    evaluator = PlanEvaluator(matrix, pantry, 0.75, 0.25, plans[0], spend_weight=0.25)
+    swaps = [(rng.randrange(6), rng.randrange(num_recipes)) for _ in range(calls)]
+    swaps = [(slot, recipe) for slot, recipe in swaps if recipe not in evaluator.plan]
+    swap_iter = iter(swaps)
+    results['incremental_swap'] = latency_stats(repeat(lambda: evaluator.try_swap(*next(swap_iter)), len(swaps)))
+    return results
+
+def bench_optimizers(matrix, digital_pantry, optimizers, iterations, restarts):
+    from app.meal_planner import optimize_meal_plan
+
+    pantry = matrix.pantry_vectors(digital_pantry)
+    results = {}
+    for name in optimizers:
+        costs = []
+        start = time.perf_counter()
+        for seed in range(restarts):
+            _, cost = optimize_meal_plan(matrix, pantry, iterations, 0.75, 0.25, rng=random.Random(seed), optimizer=name,
+                                         spend_weight=0.25)
+            costs.append(cost)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            'iterations_per_sec': round(iterations * restarts / elapsed, 1),
+            'seconds_per_run': round(elapsed / restarts, 4),
+            'best_cost': round(min(costs), 3),
+            'mean_cost': round(sum(costs) / len(costs), 3),
+        }
+    return results
+
+def bench_pareto(matrix, digital_pantry, iterations, restarts):
+    # one Pareto search against the weighted runs it replaces
+    from app.pareto import ParetoSearch
+
+    pantry = matrix.pantry_vectors(digital_pantry)
+    sizes = []
+    start = time.perf_counter()
+    for seed in range(restarts):
+        search = ParetoSearch(iterations)
+        search.optimize(matrix, pantry, 0.75, 0.25, 6, random.Random(seed), spend_weight=0.25)
+        sizes.append(len(search.archive))
+    elapsed = time.perf_counter() - start
+    return {
+        'iterations_per_sec': round(iterations * restarts / elapsed, 1),
+        'seconds_per_run': round(elapsed / restarts, 4),
+        'mean_front_size': round(sum(sizes) / len(sizes), 1),
+    }
+
+def bench_routes(pantry_rows, cookbook_path, kb_path, calls):
+    from app import app, db
+    from app.models import PantryItem
+    from app.pantry_events import ADDED, row_event, record_events
+    from app.startup import prepare_database
+
+    app.config['COOKBOOK_PATH'] = cookbook_path
+    app.config['KNOWLEDGE_BANK_PATH'] = kb_path
+    prepare_database()
+    with app.app_context():
+        items = [PantryItem(name, quantity, unit, expiry_date) for name, quantity, unit, expiry_date in pantry_rows]
+        db.session.add_all(items)
+        db.session.flush()
+        # through the event log like the routes, so a snapshot from an earlier size sees the rows
+        record_events([row_event(ADDED, item) for item in items])
+        db.session.commit()
+
+    client = app.test_client()
+    results = {}
+    for url in ['/', '/recipes', '/meal_plans', '/current_meal_plan']:
+        first, _, _ = measure(lambda: client.get(url).status_code)
+        results[url] = latency_stats(repeat(lambda: client.get(url), calls))
+        results[url]['status'] = first
+    return results
+
+# run in a fresh interpreter per warmup mode: import and set up the app, then time one request per URL
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+app = create_app(sys.argv[1], {'COOKBOOK_PATH': sys.argv[2], 'KNOWLEDGE_BANK_PATH': sys.argv[3]})
+ready = time.perf_counter()
+client = app.test_client()
+first_request = {}
+for url in sys.argv[4:]:
+    request_start = time.perf_counter()
+    status = client.get(url).status_code
+    first_request[url] = {'ms': round((time.perf_counter() - request_start) * 1000, 2), 'status': status}
+print(json.dumps({'startup_ms': round((ready - start) * 1000, 2), 'first_request': first_request}))
+'''
+
+def bench_startup(cookbook_path, kb_path, urls=('/', '/recipes', '/meal_plans')):
+    # per warmup mode: process wall time, app setup time and each URL's first request
+    results = {}
+    # importing the package sets the app up lazily; create_app then applies the mode under test
+    env = {**os.environ, 'CHEF_WARMUP': 'lazy'}
+    for mode in ['lazy', 'preload']:
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, mode, cookbook_path, kb_path, *urls], env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+        results[mode]['process_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    return results
+
+def run(args):
+    rng = random.Random(args.seed)
+    report = {'python': sys.version.split()[0], 'cpus': os.cpu_count(), 'sizes': []}
+    for num_recipes in args.recipes:
+        num_ingredients = args.ingredients or min(max(50, num_recipes // 20), 2000)
+        knowledge_bank = synthetic_knowledge_bank(num_ingredients, rng)
+        ingredient_names = list(knowledge_bank)
+        recipes = synthetic_cookbook(num_recipes, ingredient_names, rng)
+        pantry_rows = synthetic_pantry(args.pantry, ingredient_names, rng)
+
+        from app.meal_planner import load_digital_pantry
+        digital_pantry = load_digital_pantry([PantryRow(*row) for row in pantry_rows])
+
+        with tempfile.TemporaryDirectory() as workdir:
+            loading, all_recipes, kb, matrix, cookbook_path, kb_path = bench_loading(workdir, recipes, knowledge_bank)
+            size = {
+                'recipes': num_recipes,
+                'ingredients': num_ingredients,
+                'pantry_items': len(pantry_rows),
+                'loading': loading,
+                'evaluation': bench_evaluation(all_recipes, digital_pantry, kb, matrix, args.calls, rng),
+                'optimization': bench_optimizers(matrix, digital_pantry, args.optimizers, args.iterations, args.restarts),
+                'pareto': bench_pareto(matrix, digital_pantry, args.iterations, args.restarts),
+            }
+            # routes share one app and database, so only the first size is timed through Flask
+            if not args.skip_routes and not report['sizes']:
+                size['routes'] = bench_routes(pantry_rows, cookbook_path, kb_path, args.route_calls)
+                size['startup'] = bench_startup(cookbook_path, kb_path)
+        report['sizes'].append(size)
+        print(f'{num_recipes} recipes done', file=sys.stderr)
+
+    report['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time meal planning on synthetic cookbooks and pantries.')
+    parser.add_argument('--recipes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='cookbook sizes to generate (up to 100000)')
+    parser.add_argument('--ingredients', type=int, default=None, help='distinct ingredients (default scales with recipes)')
+    parser.add_argument('--pantry', type=int, default=30, help='pantry items')
+    parser.add_argument('--calls', type=int, default=500, help='plans scored per evaluation benchmark')
+    parser.add_argument('--iterations', type=int, default=2000, help='evaluations per optimizer run')
+    parser.add_argument('--restarts', type=int, default=5, help='optimizer runs per backend')
+    parser.add_argument('--optimizers', nargs='+', default=['hill_climb', 'annealing', 'tabu'])
+    parser.add_argument('--route-calls', type=int, default=5, help='requests per route')
+    parser.add_argument('--skip-routes', action='store_true', help='skip the Flask test-client timings')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    # the routes run against a throwaway database; this must be set before the app is imported
+    db_dir = tempfile.mkdtemp()
+    os.environ.setdefault('CHEF_DATABASE_URI', f"sqlite:///{os.path.join(db_dir, 'bench.db')}")
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
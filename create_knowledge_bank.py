@@ -1,57 +1,12 @@
 import json
-import os
-import csv
+import sys
 
-class Ingredient:
-
-    def __init__(self, quantity, unit, name):
-        self.quantity = quantity
-        self.unit = unit
-        self.name = name
-        
-
-class Recipe:
-    def __init__(self, name, cooking_time, total_calories, grams_carbs, grams_fat, grams_protein):
-        self.name = name
-        self.cooking_time = cooking_time
-        self.total_calories = total_calories
-        self.grams_carbs = grams_carbs
-        self.grams_fat = grams_fat
-        self.grams_protein = grams_protein
-        self.ingredients = []
-    
-    def add_ingredient(self, ingredient):
-        self.ingredients.append(ingredient)
-
-def parse_recipe_file(filepath):
-    with open(filepath, 'r') as file:
-        reader = csv.reader(file)
-        header = next(reader)  # Read the first row with recipe details
-
-        # Create a Recipe object
-        recipe = Recipe(name=header[0], cooking_time=int(header[1]),
-                        total_calories=int(header[2]), grams_carbs=float(header[3]),
-                        grams_fat=float(header[4]), grams_protein=float(header[5]))
-
-        # Add ingredients to the Recipe object
-        for row in reader:
-            if row:  # Ensure the row isn't empty
-                ingredient = Ingredient(quantity=float(row[0]), unit=row[1], name=row[2])
-                recipe.add_ingredient(ingredient)
-
-    return recipe
+from app.ingest import folder_recipes
 
 def gather_ingredients(recipes_folder):
-    ingredients = set()
-    for filename in os.listdir(recipes_folder):
-        if filename.endswith('.csv'):
-            recipe_path = os.path.join(recipes_folder, filename)
-            recipe = parse_recipe_file(recipe_path)
-            for ingredient in recipe.ingredients:
-                if ingredient.name == 'southwest spice blend':
-                    print(recipe.name)
-                ingredients.add(ingredient.name)
-    return ingredients
+    # reuses the output of the last parse_recipes.py run; only changed files are read. Includes
+    # recipes skipped for units the knowledge bank doesn't convert yet
+    return {ingredient['name'] for recipe in folder_recipes(recipes_folder) for ingredient in recipe['ingredients']}
 
 
 def input_ingredient_data(ingredient):
@@ -66,7 +21,30 @@ def input_ingredient_data(ingredient):
     unit = input("Enter the unit: ")
     increment = {"quantity": int(quantity), "unit": str(unit)}
 
-    return {"shelf_life": int(shelf_life), "increment": increment}, True
+    data = {"shelf_life": int(shelf_life), "increment": increment}
+    purchase_options = input_purchase_options(ingredient)
+    if purchase_options:
+        data["purchase_options"] = purchase_options
+    return data, True
+
+def input_purchase_options(ingredient):
+    # package sizes and prices, e.g. "8 oz 2.49, 32 oz 6.99"; without them the planner can't
+    # weigh what a plan costs to buy for this ingredient
+    while True:
+        text = input(f"Enter package sizes and prices for {ingredient} as 'quantity unit price', comma-separated (blank to skip): ")
+        try:
+            return [parse_purchase_option(option) for option in text.split(',') if option.strip()]
+        except ValueError as e:
+            print(e)
+
+def parse_purchase_option(text):
+    parts = text.split()
+    if len(parts) != 3:
+        raise ValueError(f"Expected 'quantity unit price', got '{text.strip()}'")
+    quantity, unit, price = parts
+    if float(quantity) <= 0 or float(price) < 0:
+        raise ValueError(f"Quantity must be positive and price not negative in '{text.strip()}'")
+    return {"quantity": float(quantity), "unit": unit, "price": float(price)}
 
 def load_existing_knowledge_bank(knowledge_bank_file):
     try:
@@ -75,7 +53,16 @@ def load_existing_knowledge_bank(knowledge_bank_file):
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
-def create_knowledge_bank(recipes_folder, knowledge_bank_file):
+def add_purchase_options(knowledge_bank):
+    # prices for ingredients already in the knowledge bank that have none yet
+    for ingredient in sorted(knowledge_bank):
+        if knowledge_bank[ingredient].get("purchase_options"):
+            continue
+        purchase_options = input_purchase_options(ingredient)
+        if purchase_options:
+            knowledge_bank[ingredient]["purchase_options"] = purchase_options
+
+def create_knowledge_bank(recipes_folder, knowledge_bank_file, prices=False):
     ingredients = gather_ingredients(recipes_folder)
     knowledge_bank = load_existing_knowledge_bank(knowledge_bank_file)
 
@@ -89,6 +76,8 @@ def create_knowledge_bank(recipes_folder, knowledge_bank_file):
             knowledge_bank[ingredient] = data
         else:
             break
+    if prices:
+        add_purchase_options(knowledge_bank)
 
     with open(knowledge_bank_file, 'w') as f:
         json.dump(knowledge_bank, f, indent=4)
@@ -96,4 +85,5 @@ def create_knowledge_bank(recipes_folder, knowledge_bank_file):
 if __name__ == '__main__':
     recipes_folder = 'app/cookbook'  # Update with the actual path
     knowledge_bank_file = 'app/knowledge_bank.json'  # Update with the desired path
-    create_knowledge_bank(recipes_folder, knowledge_bank_file)
\ No newline at end of file
+    # --prices also asks for package prices for the ingredients already in it
+    create_knowledge_bank(recipes_folder, knowledge_bank_file, prices='--prices' in sys.argv)
\ No newline at end of file
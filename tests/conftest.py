@@ -0,0 +1,84 @@
+import copy
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the repo has no packaging, so make `app` importable however pytest is started
+sys.path.insert(0, ROOT)
+
+# the app reads these on import: a throwaway database, and no background threads
+_tmpdir = tempfile.mkdtemp(prefix='chef-tests-')
+os.environ['CHEF_DATABASE_URI'] = f"sqlite:///{os.path.join(_tmpdir, 'pantry.db')}"
+os.environ['CHEF_SCHEDULER'] = '0'
+os.environ['CHEF_PREWARM'] = '0'
+os.environ['CHEF_PREWARM_LOCK'] = os.path.join(_tmpdir, 'prewarm.lock')
+
+from app import app as flask_app, db  # noqa: E402
+from app.meal_planner import load_all_recipes, load_knowledge_bank, build_cookbook_matrix  # noqa: E402
+
+APP_DIR = os.path.join(ROOT, 'app')
+COOKBOOK_PATH = os.path.join(APP_DIR, 'cookbook.json')
+KNOWLEDGE_BANK_PATH = os.path.join(APP_DIR, 'knowledge_bank.json')
+NOW = datetime(2024, 3, 1, 12, 0)
+
+
+@pytest.fixture(scope='session')
+def knowledge_bank():
+    return load_knowledge_bank(KNOWLEDGE_BANK_PATH)
+
+@pytest.fixture(scope='session')
+def priced_knowledge_bank(knowledge_bank):
+    # every third ingredient sold in two package sizes, so spend and the package tables take part
+    priced = copy.deepcopy(knowledge_bank)
+    for i, name in enumerate(sorted(priced)):
+        if i % 3 == 0:
+            unit = priced[name]['increment']['unit']
+            priced[name]['purchase_options'] = [{'quantity': 1, 'unit': unit, 'price': 1.5 + i % 5},
+                                                {'quantity': 4, 'unit': unit, 'price': 4.0 + i % 7}]
+    return priced
+
+@pytest.fixture(scope='session')
+def recipes():
+    return load_all_recipes(COOKBOOK_PATH)
+
+@pytest.fixture(scope='session')
+def matrix(recipes, knowledge_bank):
+    return build_cookbook_matrix(recipes, knowledge_bank)
+
+@pytest.fixture(scope='session')
+def priced_matrix(recipes, priced_knowledge_bank):
+    return build_cookbook_matrix(recipes, priced_knowledge_bank)
+
+def make_pantry(names, rng, now=NOW):
+    # a digital pantry over some of `names`: a mix of stock going off within the wastage window,
+    # stock that keeps, and stock already past its date
+    pantry = {}
+    for name in rng.sample(sorted(names), len(names) // 2):
+        days = rng.choice([-3, 2, 5, 10, 30, 90])
+        pantry[name] = {'quantity': rng.uniform(0.5, 40), 'unit': 'stan', 'expiry_date': now + timedelta(days=days)}
+    return pantry
+
+@pytest.fixture
+def digital_pantry(knowledge_bank):
+    return make_pantry(knowledge_bank, random.Random(7))
+
+@pytest.fixture
+def client():
+    # the app on an empty database, with the per-process pantry and household caches dropped
+    from app import models, households, pantry_events, expiry, startup
+
+    startup.prepare_database()
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        models.upgrade_schema(db.engine)
+    pantry_events._snapshots.clear()
+    expiry._alerts.clear()
+    households._household_ids.clear()
+    households._household_ids[models.DEFAULT_HOUSEHOLD_NAME] = models.DEFAULT_HOUSEHOLD_ID
+    return flask_app.test_client()
@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+from app.cookbook_matrix import PlanEvaluator
+from app.meal_planner import generate_shopping_list, calculate_cost, shopping_spend
+from conftest import NOW, make_pantry
+
+WEIGHTS = [(1, 0, 0), (0.75, 0.25, 0), (0.75, 0.25, 0.5)]
+
+
+def dict_cost(recipes, plan, digital_pantry, knowledge_bank, weights):
+    # the original, dict-based scoring the matrix path replaced
+    wastage_weight, pantry_change_weight, spend_weight = weights
+    shopping_list, new_pantry = generate_shopping_list([recipes[i] for i in plan], digital_pantry, knowledge_bank, NOW)
+    return calculate_cost(digital_pantry, new_pantry, wastage_weight, pantry_change_weight, NOW,
+                          shopping_spend(shopping_list), spend_weight)
+
+@pytest.mark.parametrize('priced', [False, True])
+@pytest.mark.parametrize('weights', WEIGHTS)
+def test_matrix_cost_matches_dict_cost(recipes, knowledge_bank, priced_knowledge_bank, matrix, priced_matrix, priced, weights):
+    kb, m = (priced_knowledge_bank, priced_matrix) if priced else (knowledge_bank, matrix)
+    rng = random.Random(1)
+    for _ in range(20):
+        digital_pantry = make_pantry(kb, rng)
+        pantry = m.pantry_vectors(digital_pantry, NOW)
+        plan = rng.sample(range(m.num_recipes), 6)
+        # shopping list prices are rounded to cents, the matrix's aren't
+        assert m.calculate_cost(plan, pantry, *weights) == pytest.approx(
+            dict_cost(recipes, plan, digital_pantry, kb, weights), abs=0.01 * len(plan) * weights[2] + 1e-9)
+
+@pytest.mark.parametrize('priced', [False, True])
+def test_plan_evaluator_swaps_do_not_drift(matrix, priced_matrix, knowledge_bank, priced):
+    m = priced_matrix if priced else matrix
+    rng = random.Random(2)
+    pantry = m.pantry_vectors(make_pantry(knowledge_bank, rng), NOW)
+    evaluator = PlanEvaluator(m, pantry, 0.75, 0.25, rng.sample(range(m.num_recipes), 6), spend_weight=0.5)
+    for _ in range(2000):
+        slot, recipe = rng.randrange(6), rng.randrange(m.num_recipes)
+        if not evaluator.allows(slot, recipe):
+            continue
+        cost = evaluator.try_swap(slot, recipe)
+        if rng.random() < 0.5:
+            evaluator.accept()
+            assert evaluator.cost == cost
+    full = m.calculate_cost(evaluator.plan, pantry, 0.75, 0.25, 0.5)
+    assert abs(evaluator.cost - full) <= 1e-12 * max(1.0, abs(full))
+
+def test_pending_swap_can_be_accepted_later(matrix, knowledge_bank):
+    rng = random.Random(3)
+    pantry = matrix.pantry_vectors(make_pantry(knowledge_bank, rng), NOW)
+    evaluator = PlanEvaluator(matrix, pantry, 0.75, 0.25, [0, 1, 2, 3, 4, 5])
+    kept = evaluator.try_swap(0, 10)
+    swap = evaluator.pending_swap
+    evaluator.try_swap(3, 11)
+    evaluator.accept(swap)
+    assert evaluator.plan == [10, 1, 2, 3, 4, 5]
+    assert evaluator.cost == pytest.approx(kept, abs=1e-9)
+    assert evaluator.cost == pytest.approx(matrix.calculate_cost(evaluator.plan, pantry, 0.75, 0.25), abs=1e-9)
@@ -0,0 +1,40 @@
+import random
+
+import numpy as np
+import pytest
+
+from app.horizon import HorizonPantry, HorizonEvaluator, random_week_plans
+from conftest import NOW, make_pantry
+
+
+@pytest.mark.parametrize('priced', [False, True])
+def test_one_week_horizon_matches_plan_cost(matrix, priced_matrix, knowledge_bank, priced):
+    m = priced_matrix if priced else matrix
+    rng = random.Random(4)
+    for _ in range(10):
+        digital_pantry = make_pantry(knowledge_bank, rng)
+        plan = rng.sample(range(m.num_recipes), 6)
+        evaluator = HorizonEvaluator(m, HorizonPantry(m, digital_pantry, 1, NOW), 1, 6, 0.75, 0.25, [plan], 0.5)
+        expected = m.calculate_cost(plan, m.pantry_vectors(digital_pantry, NOW), 0.75, 0.25, 0.5)
+        assert evaluator.cost == pytest.approx(expected, abs=1e-9)
+
+@pytest.mark.parametrize('priced', [False, True])
+def test_horizon_swaps_match_full_resimulation(matrix, priced_matrix, knowledge_bank, priced):
+    m = priced_matrix if priced else matrix
+    rng = random.Random(5)
+    weeks, num_meals = 3, 4
+    pantry = HorizonPantry(m, make_pantry(knowledge_bank, rng), weeks, NOW)
+    evaluator = HorizonEvaluator(m, pantry, weeks, num_meals, 0.75, 0.25,
+                                 random_week_plans(m.num_recipes, weeks, num_meals, rng), 0.5)
+    for _ in range(300):
+        slot, recipe = rng.randrange(weeks * num_meals), rng.randrange(m.num_recipes)
+        if not evaluator.allows(slot, recipe):
+            continue
+        evaluator.try_swap(slot, recipe)
+        if rng.random() < 0.5:
+            evaluator.accept()
+
+    fresh = HorizonEvaluator(m, pantry, weeks, num_meals, 0.75, 0.25, evaluator.week_plans(), 0.5)
+    assert evaluator.cost == pytest.approx(fresh.cost, abs=1e-9)
+    for name in ('stock', 'expiry', 'discarded', 'count', 'bought', 'spent'):
+        np.testing.assert_allclose(getattr(evaluator, name), getattr(fresh, name), atol=1e-9, err_msg=name)
@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+from app import app as flask_app, db
+from app.households import claim_execution, get_staged_plan, stage_plan
+
+
+def read_staged_plan(household_id):
+    # what a request holds after reading the staged plan: its id and the version it saw
+    staged = get_staged_plan(household_id)
+    return SimpleNamespace(id=staged.id, version=staged.version)
+
+
+def test_only_one_claim_on_a_staged_plan_wins(client):
+    with flask_app.app_context():
+        stage_plan(['a', 'b'], 1)
+        first, second = read_staged_plan(1), read_staged_plan(1)
+        assert claim_execution(first)
+        db.session.commit()
+        assert not claim_execution(second)
+        db.session.rollback()
+        db.session.expire_all()
+        assert get_staged_plan(1).executed
+
+def test_restaging_fails_a_stale_claim(client):
+    with flask_app.app_context():
+        stage_plan(['a'], 1)
+        stale = read_staged_plan(1)
+        stage_plan(['b'], 1)
+        assert not claim_execution(stale)
+        db.session.rollback()
+        fresh = read_staged_plan(1)
+        assert claim_execution(fresh)
+        db.session.commit()
+        db.session.expire_all()
+        assert get_staged_plan(1).recipes == ['b']
+
+def test_a_staged_plan_executes_once(client, recipes):
+    names = [recipe['name'] for recipe in recipes[:2]]
+    client.post('/stage_meal_plan', json={'recipeNames': names})
+    assert client.post('/execute_staged_plan').get_json()['success']
+    second = client.post('/execute_staged_plan').get_json()
+    assert not second['success']
+    assert 'already executed' in second['message']
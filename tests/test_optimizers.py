@@ -0,0 +1,54 @@
+import itertools
+import random
+
+import pytest
+
+from app.constraints import constraints_from_params
+from app.cookbook_matrix import PlanEvaluator
+from app.meal_planner import get_optimizer
+from app.optimizers import Budget, BranchAndBound
+from conftest import NOW, make_pantry
+
+
+@pytest.mark.parametrize('weights', [(1, 0, 0), (0.75, 0.25, 0), (0.75, 0.25, 0.5)])
+@pytest.mark.parametrize('priced', [False, True])
+def test_branch_and_bound_matches_brute_force(matrix, priced_matrix, knowledge_bank, priced, weights):
+    m = (priced_matrix if priced else matrix).subset(list(range(12)))
+    rng = random.Random(6)
+    for _ in range(3):
+        pantry = m.pantry_vectors(make_pantry(knowledge_bank, rng), NOW)
+        optimizer = BranchAndBound(iterations=20000)
+        plan, cost = optimizer.optimize(m, pantry, *weights[:2], 4, rng, spend_weight=weights[2])
+        assert optimizer.complete
+        best = min(m.calculate_cost(list(plan), pantry, *weights) for plan in itertools.combinations(range(m.num_recipes), 4))
+        assert cost == pytest.approx(best, abs=1e-9)
+        assert m.calculate_cost(plan, pantry, *weights) == pytest.approx(best, abs=1e-9)
+
+def test_branch_and_bound_respects_constraints(matrix, knowledge_bank):
+    m = matrix.subset(list(range(12)))
+    pantry = m.pantry_vectors(make_pantry(knowledge_bank, random.Random(8)), NOW)
+    constraints = constraints_from_params({'max_calories': 2500})
+    optimizer = BranchAndBound(iterations=20000)
+    plan, cost = optimizer.optimize(m, pantry, 0.75, 0.25, 3, random.Random(0), constraints)
+    allowed = [plan for plan in itertools.combinations(range(m.num_recipes), 3)
+               if PlanEvaluator(m, pantry, 0.75, 0.25, list(plan), constraints).violation <= 0]
+    assert optimizer.complete
+    assert cost == pytest.approx(min(m.calculate_cost(list(plan), pantry, 0.75, 0.25) for plan in allowed), abs=1e-9)
+
+@pytest.mark.parametrize('name', ['hill_climb', 'annealing', 'tabu'])
+def test_optimizers_spend_exactly_their_budget(matrix, knowledge_bank, name):
+    rng = random.Random(9)
+    pantry = matrix.pantry_vectors(make_pantry(knowledge_bank, rng), NOW)
+    evaluator = PlanEvaluator(matrix, pantry, 0.75, 0.25, rng.sample(range(matrix.num_recipes), 6))
+    budget = Budget(500)
+    plan, cost = get_optimizer(name, 500).search(evaluator, 6, budget, rng)
+    assert budget.used == 500
+    assert cost == pytest.approx(matrix.calculate_cost(plan, pantry, 0.75, 0.25), abs=1e-9)
+
+@pytest.mark.parametrize('name', ['hill_climb', 'annealing', 'tabu'])
+def test_search_ends_when_no_swap_is_allowed(matrix, knowledge_bank, name):
+    # every recipe is already in the plan, so there is nothing to swap in
+    m = matrix.subset(list(range(6)))
+    pantry = m.pantry_vectors(make_pantry(knowledge_bank, random.Random(10)), NOW)
+    plan, cost = get_optimizer(name, 1000).optimize(m, pantry, 0.75, 0.25, 6, random.Random(0))
+    assert sorted(plan) == list(range(6))
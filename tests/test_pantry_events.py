@@ -0,0 +1,117 @@
+import random
+
+from sqlalchemy import create_engine, inspect, select, text
+
+from app import app as flask_app, db
+from app.cookbook_cache import get_unit_registry
+from app.meal_planner import load_digital_pantry
+from app.models import Household, PantryEvent, PantryItem, upgrade_schema
+from app import pantry_events
+from conftest import KNOWLEDGE_BANK_PATH
+
+
+def full_reload(household_id):
+    rows = PantryItem.query.filter_by(household_id=household_id).order_by(PantryItem.id).all()
+    return load_digital_pantry(rows, get_unit_registry(KNOWLEDGE_BANK_PATH))
+
+def item_ids(household_id):
+    return [item.id for item in PantryItem.query.filter_by(household_id=household_id).order_by(PantryItem.id)]
+
+def add(client, knowledge_bank, name, quantity, household, expiry_date=None):
+    form = {'name': name, 'quantity': quantity, 'unit': knowledge_bank[name]['increment']['unit']}
+    if expiry_date is None:
+        form['non_perishable'] = 'on'
+    else:
+        form['expiry_date'] = expiry_date
+    assert client.post('/add', data=form, headers={'X-Household': household}).status_code == 302
+
+
+def test_snapshot_matches_full_reload(client, knowledge_bank, recipes):
+    rng = random.Random(11)
+    names = sorted(knowledge_bank)
+    # a few names on purpose more than once: the newest row wins a shared name
+    pool = rng.sample(names, 12)
+    # the default household is 1, and 'other' becomes 2 on its first request
+    households = {'default': 1, 'other': 2}
+    with flask_app.app_context():
+        for step in range(80):
+            household = rng.choice(list(households))
+            action = rng.random()
+            if action < 0.5 or step < 10:
+                expiry_date = rng.choice([None, '2024-03-04', '2024-05-01'])
+                add(client, knowledge_bank, rng.choice(pool), round(rng.uniform(0.5, 20), 2), household, expiry_date)
+            else:
+                ids = item_ids(households[household])
+                if not ids:
+                    continue
+                item = db.session.get(PantryItem, rng.choice(ids))
+                if action < 0.8:
+                    quantity = rng.choice([0, round(rng.uniform(0.5, 20), 2)])
+                    client.post(f'/update/{item.id}', data={'name': rng.choice(pool), 'quantity': quantity, 'unit': item.unit,
+                                                            'expiry_date': '2024-04-01'}, headers={'X-Household': household})
+                else:
+                    client.post(f'/remove/{item.id}', headers={'X-Household': household})
+            db.session.expire_all()
+            for household_id in households.values():
+                # built incrementally from the previous snapshot, event by event
+                assert pantry_events.pantry_snapshot(household_id).pantry == full_reload(household_id)
+
+        # executing a plan writes its updates and inserts in bulk
+        client.post('/stage_meal_plan', json={'recipeNames': [recipe['name'] for recipe in recipes[:3]]})
+        assert client.post('/execute_staged_plan').get_json()['success']
+        db.session.expire_all()
+        assert pantry_events.pantry_snapshot(1).pantry == full_reload(1)
+
+        incremental = pantry_events.pantry_snapshot(1)
+        pantry_events._snapshots.clear()
+        loaded = pantry_events.pantry_snapshot(1)
+        assert loaded.version == incremental.version
+        assert loaded.pantry == incremental.pantry
+
+def test_unchanged_pantry_reuses_its_snapshot(client, knowledge_bank):
+    name = sorted(knowledge_bank)[0]
+    with flask_app.app_context():
+        add(client, knowledge_bank, name, 2, 'default')
+        snapshot = pantry_events.pantry_snapshot(1)
+        assert pantry_events.pantry_snapshot(1) is snapshot
+        add(client, knowledge_bank, name, 3, 'default', '2024-03-04')
+        assert pantry_events.pantry_snapshot(1).version > snapshot.version
+
+def test_event_versions_count_up_per_household(client, knowledge_bank):
+    rng = random.Random(12)
+    names = sorted(knowledge_bank)
+    with flask_app.app_context():
+        for _ in range(30):
+            add(client, knowledge_bank, rng.choice(names), 1, rng.choice(['default', 'other']))
+        # a write that rolls back gives its version back
+        pantry_events.record_events([pantry_events.item_event(pantry_events.REMOVED, 0, 1)])
+        db.session.rollback()
+        add(client, knowledge_bank, names[0], 1, 'default')
+
+        for household_id in (1, 2):
+            versions = db.session.scalars(select(PantryEvent.version).where(PantryEvent.household_id == household_id)
+                                          .order_by(PantryEvent.id)).all()
+            assert versions == list(range(1, len(versions) + 1))
+            assert db.session.get(Household, household_id).pantry_version == len(versions)
+            assert pantry_events.pantry_snapshot(household_id).version == len(versions)
+
+def test_upgrade_numbers_an_existing_event_log(tmp_path):
+    # a database from before per-household versions: events only had ids
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE household (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL UNIQUE)'))
+        connection.execute(text('CREATE TABLE pantry_event (id INTEGER PRIMARY KEY AUTOINCREMENT, household_id INTEGER NOT NULL, '
+                                'kind VARCHAR(10) NOT NULL, item_id INTEGER NOT NULL, name VARCHAR(100), quantity FLOAT, '
+                                'unit VARCHAR(50), expiry_date DATETIME, created_at DATETIME NOT NULL)'))
+        connection.execute(text("INSERT INTO household (id, name) VALUES (1, 'default'), (2, 'other'), (3, 'empty')"))
+        for household_id in (1, 2, 1, 1, 2):
+            connection.execute(text("INSERT INTO pantry_event (household_id, kind, item_id, created_at) "
+                                    "VALUES (:household_id, 'add', 1, '2024-03-01')"), {'household_id': household_id})
+    db.metadata.create_all(engine)
+    upgrade_schema(engine)
+
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT id, pantry_version FROM household ORDER BY id')).all() == [(1, 4), (2, 5), (3, 0)]
+        assert connection.execute(text('SELECT id, version FROM pantry_event ORDER BY id')).all() == [(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)]
+    assert 'ix_pantry_event_household_version' in {index['name'] for index in inspect(engine).get_indexes('pantry_event')}
+    engine.dispose()
@@ -0,0 +1,59 @@
+import itertools
+import math
+
+import pytest
+
+from app.purchasing import MAX_BUCKETS, PurchaseTables, cheapest_packages
+
+# sizes in standard units that share an exact step (0.25), so the table is exact
+OPTIONS = [(0.5, 1.0, 'small'), (1.25, 2.2, 'medium'), (2.0, 3.1, 'large')]
+
+
+def brute_force(options, required):
+    # (price, bought) of the cheapest covering mix, least bought among equally cheap ones
+    best = None
+    limits = [math.ceil(required / size) + 1 for size, _, _ in options]
+    for counts in itertools.product(*(range(limit + 1) for limit in limits)):
+        bought = sum(count * size for count, (size, _, _) in zip(counts, options))
+        if bought < required - 1e-9:
+            continue
+        price = sum(count * price for count, (_, price, _) in zip(counts, options))
+        if best is None or (price, bought) < (best[0] - 1e-9, best[1]):
+            best = (price, bought)
+    return best
+
+
+@pytest.mark.parametrize('required', [0, 0.1, 0.5, 0.6, 1.25, 1.3, 2.0, 2.4, 3.75, 5.0, 6.1, 9.99, 12.5])
+def test_cheapest_packages_matches_brute_force(required):
+    counts, bought, price = cheapest_packages(OPTIONS, required)
+    best_price, best_bought = brute_force(OPTIONS, required)
+    assert price == pytest.approx(best_price, abs=1e-9)
+    assert bought == pytest.approx(best_bought, abs=1e-9)
+    assert bought == pytest.approx(sum(count * size for count, (size, _, _) in zip(counts, OPTIONS)), abs=1e-9)
+    assert price == pytest.approx(sum(count * price for count, (_, price, _) in zip(counts, OPTIONS)), abs=1e-9)
+
+@pytest.mark.parametrize('options', [
+    # no step that keeps the table short: buckets are a fraction of the smallest size
+    [(0.3, 1.0, 'a'), (0.7071, 2.0, 'b')],
+    [(1.0, 1.0, 'a'), (333.0, 200.0, 'b')],
+    [(0.5, 1.0, 'small'), (1.25, 2.2, 'medium'), (2.0, 3.1, 'large')],
+])
+def test_cheapest_packages_always_covers(options):
+    for required in [0.01, 0.29, 0.31, 1.0, 7.7, 100.0, 1000.0, 12345.6]:
+        counts, bought, price = cheapest_packages(options, required)
+        assert bought >= required - 1e-9
+        assert bought == pytest.approx(sum(count * size for count, (size, _, _) in zip(counts, options)))
+        assert price == pytest.approx(sum(count * price for count, (_, price, _) in zip(counts, options)))
+
+def test_table_lookups_match_packages():
+    # the batched lookups a CookbookMatrix uses pick the same mix as a shopping list does
+    import numpy as np
+
+    tables = PurchaseTables([OPTIONS, [(0.3, 1.0, 'a'), (0.7071, 2.0, 'b')]])
+    required = np.array([[0.0, 0.2], [3.3, 7.9], [40.0, 0.71], [MAX_BUCKETS * 0.3, 500.0]])
+    count, bought, price = tables.buy(np.array([0, 1]), required)
+    for i, j in np.ndindex(required.shape):
+        counts, expected_bought, expected_price = tables.packages(j, required[i, j])
+        assert count[i, j] == sum(counts)
+        assert bought[i, j] == pytest.approx(expected_bought)
+        assert price[i, j] == pytest.approx(expected_price)
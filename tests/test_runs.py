@@ -0,0 +1,39 @@
+import json
+import random
+
+import pytest
+
+from app.constraints import constraints_from_params
+from app.meal_planner import generate_meal_plan, replay_meal_plan
+from app.runs import RunRecord
+from conftest import NOW, make_pantry
+
+
+def recorded_run(recipes, digital_pantry, knowledge_bank, matrix, optimizer, constraints=None, spend_weight=0):
+    records = []
+    generate_meal_plan(recipes, digital_pantry, knowledge_bank, 400, 0.75, 0.25, matrix=matrix, optimizer=optimizer,
+                       constraints=constraints, seed=1234, now=NOW, records=records, spend_weight=spend_weight)
+    return records[0]
+
+
+@pytest.mark.parametrize('optimizer', ['hill_climb', 'annealing', 'tabu'])
+def test_replay_round_trips(recipes, knowledge_bank, matrix, digital_pantry, optimizer):
+    record = recorded_run(recipes, digital_pantry, knowledge_bank, matrix, optimizer)
+    # through JSON, as a record handed back by the API would be
+    stored = RunRecord.from_dict(json.loads(json.dumps(record.to_dict())))
+    replayed = replay_meal_plan(stored, recipes, digital_pantry, knowledge_bank, matrix)
+    assert replayed.same_search(record)
+    assert replayed.fingerprint == record.fingerprint
+    assert replayed.evaluations == record.evaluations
+
+def test_replay_round_trips_with_constraints_and_prices(recipes, priced_knowledge_bank, priced_matrix, digital_pantry):
+    constraints = constraints_from_params({'max_calories': 6000})
+    record = recorded_run(recipes, digital_pantry, priced_knowledge_bank, priced_matrix, 'hill_climb', constraints, 0.5)
+    stored = RunRecord.from_dict(json.loads(json.dumps(record.to_dict())))
+    assert replay_meal_plan(stored, recipes, digital_pantry, priced_knowledge_bank, priced_matrix).same_search(record)
+
+def test_replay_refuses_a_changed_pantry(recipes, knowledge_bank, matrix, digital_pantry):
+    record = recorded_run(recipes, digital_pantry, knowledge_bank, matrix, 'hill_climb')
+    changed = make_pantry(knowledge_bank, random.Random(99))
+    with pytest.raises(ValueError):
+        replay_meal_plan(record, recipes, changed, knowledge_bank, matrix)